@@ -0,0 +1,57 @@
+"""Time threading a single 10k message thread
+
+Run with: python benchmarks/bench_graft.py [messages]
+
+Replies are delivered newest first and only carry In-Reply-To, so every
+message arrives as the parent of the tree built so far and has to be
+grafted onto it.  With list based authors/children and a graft that walks
+the absorbed tree this used to be quadratic.
+"""
+import sys
+import time
+
+from mailtree import MailForest
+from mailtree.scanner import MessageHeaders
+
+
+def message(n, parent=None):
+    headers = {
+        'message-id': '<msg%d@example.com>' % n,
+        'from': 'Author %d <author%d@example.com>' % (n, n),
+        'subject': 'Re: benchmark',
+    }
+    if parent is not None:
+        headers['in-reply-to'] = '<msg%d@example.com>' % parent
+
+    return MessageHeaders(headers, 0, 0)
+
+
+def reversed_chain(count):
+    return [message(n, n - 1 if n else None) for n in xrange(count - 1, -1, -1)]
+
+
+def flat_thread(count):
+    return [message(n, 0 if n else None) for n in xrange(count - 1, -1, -1)]
+
+
+def run(name, messages):
+    start = time.time()
+    mf = MailForest()
+    mf.fill_tree(messages)
+    elapsed = time.time() - start
+
+    assert len(mf) == 1
+    assert len(mf['msg0@example.com'].nodes) == len(messages)
+    print "%-16s %6d messages %8.3fs %10.0f msg/s" % (
+        name, len(messages), elapsed, len(messages) / elapsed)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+
+    run('reversed chain', reversed_chain(count))
+    run('flat thread', flat_thread(count))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+"""Time delivering messages to IngestService over SMTP
+
+Run with: python benchmarks/bench_ingest.py [messages] [batch size]
+
+A stand-in MTA in a second thread pipelines every message over one SMTP
+session while the service polls in the main thread.  Reports messages
+per second and the worst delay between a batch being started and its
+changes being published.
+"""
+import socket
+import sys
+import threading
+import time
+
+from mailtree.daemon import IngestService
+
+
+def message(n):
+    parent = n // 3 if n % 20 else None
+    lines = ['From: Author %d <author%d@example.com>' % (n % 50, n % 50),
+             'Message-Id: <m%d@example.com>' % n,
+             'Subject: Re: benchmark %d' % (n // 20)]
+    if parent is not None:
+        lines.append('In-Reply-To: <m%d@example.com>' % parent)
+    lines += ['', 'body line'] * 10
+
+    return '\r\n'.join(lines)
+
+
+def send(address, count, done):
+    sock = socket.create_connection(address)
+    sock.sendall('EHLO bench\r\n')
+    for start in xrange(0, count, 100):
+        commands = []
+        for n in xrange(start, min(start + 100, count)):
+            commands += ['MAIL FROM:<a@example.com>', 'RCPT TO:<list@example.com>', 'DATA',
+                         message(n) + '\r\n.']
+        sock.sendall('\r\n'.join(commands) + '\r\n')
+    sock.sendall('QUIT\r\n')
+
+    while sock.recv(65536):
+        pass
+    sock.close()
+    done.set()
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    batch_size = int(argv[2]) if len(argv) > 2 else 500
+
+    service = IngestService(batch_size=batch_size, max_delay=0.05)
+    server = service.listen(('127.0.0.1', 0))
+
+    delays = []
+    def published(changes):
+        delays.append(time.time() - service.batch_started)
+
+    # Remember when the batch being threaded was started
+    flush = service.flush
+    def timed_flush():
+        service.batch_started = service.first
+        return flush()
+    service.flush = timed_flush
+    service.subscribers.append(published)
+
+    done = threading.Event()
+    sender = threading.Thread(target=send, args=(server.address, count, done))
+    start = time.time()
+    sender.start()
+    while not done.is_set() or service.received < count:
+        service.poll(0.01)
+    service.close()
+    elapsed = time.time() - start
+
+    print "%d messages in %.2fs, %.0f messages/s" % (service.received, elapsed,
+                                                     service.received / elapsed)
+    print "%d batches, worst publish delay %.1fms" % (len(delays), max(delays) * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,52 @@
+"""Report how much memory a MailForest needs per message
+
+Run with: python benchmarks/bench_memory.py [messages]
+
+Builds a forest of threads of 50 messages in which every reply carries
+full References, so each thread also holds placeholder nodes for the
+messages it references before they arrive.  The growth of the peak
+resident set size is divided by the number of messages.
+"""
+import resource
+import sys
+
+from mailtree import MailForest
+from mailtree.scanner import MessageHeaders
+
+
+def messages(count, thread_size=50):
+    for n in xrange(count - 1, -1, -1):
+        thread, pos = divmod(n, thread_size)
+        headers = {
+            'message-id': '<msg%d.%d@example.com>' % (thread, pos),
+            'from': 'Author %d <author%d@example.com>' % (n % 300, n % 300),
+            'subject': 'Re: thread %d' % thread,
+        }
+        if pos:
+            refs = ['<msg%d.%d@example.com>' % (thread, p) for p in xrange(0, pos, 5)]
+            headers['references'] = ' '.join(refs)
+            headers['in-reply-to'] = '<msg%d.%d@example.com>' % (thread, pos - 1)
+
+        yield MessageHeaders(headers, 0, 0)
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+
+    before = peak_rss()
+    mf = MailForest()
+    mf.fill_tree(messages(count))
+    used = peak_rss() - before
+
+    nodes = sum(len(tree.nodes) for tree in mf.trees.itervalues())
+    print "%d messages, %d trees, %d nodes" % (count, len(mf), nodes)
+    print "%.0f bytes per message" % (float(used) / count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+"""Compare parse_message_ids with the string.find based parser it replaced
+
+Run with: python benchmarks/bench_parse_ids.py [rounds]
+
+The headers are shaped like the References and In-Reply-To headers of
+busy development lists: long folded chains of ids, some with comments.
+
+Per header the new parser does more work (comments, quoted strings,
+folding, interning).  Per message it comes out ahead because threading
+used to parse Message-Id and In-Reply-To twice each, where message_ids
+now tokenizes every header once.
+"""
+import string
+import sys
+import timeit
+
+from mailtree import parse_message_ids, message_ids
+
+HEADERS = [
+    '<20100601123456.GA1234@host.example.org>',
+    '<4C05A1B2.3040506@example.com> (Joe Bloggs\'s message of "Tue, 01 Jun 2010")',
+    '<1275392132-2345-1-git-send-email-someone@example.org>\n'
+    '\t<1275392132-2345-2-git-send-email-someone@example.org>\n'
+    '\t<20100601123456.GA1234@host.example.org>\n'
+    '\t<4C05A1B2.3040506@example.com>',
+    ' '.join('<%d.%d.camel@laptop.example.net>' % (n, n * 7) for n in range(20)),
+    '\n\t'.join('<CAH%dx=ABCdefGHI%d@mail.gmail.com>' % (n, n) for n in range(60)),
+]
+
+
+def legacy_parse_message_ids(references):
+    idx = 0
+    ret = []
+    idx = string.find(references, '<', idx)
+
+    while idx != -1:
+        end = string.find(references, '>', idx)
+        ret.append(references[idx+1: end])
+
+        idx = string.find(references, '<', idx + 1)
+
+    return ret
+
+
+MESSAGES = [
+    {'Message-Id': HEADERS[0]},
+    {'Message-Id': '<4C05A1B3.1@example.com>', 'In-Reply-To': HEADERS[1],
+     'References': HEADERS[3]},
+    {'Message-Id': '<4C05A1B3.2@example.com>', 'In-Reply-To': HEADERS[0],
+     'References': HEADERS[2]},
+    {'Message-Id': '<4C05A1B3.3@example.com>', 'In-Reply-To': HEADERS[0],
+     'References': HEADERS[4]},
+]
+
+
+def legacy_per_message(message):
+    # What fill_tree, addChild and MailTreeNode.hydrate used to parse
+    legacy_parse_message_ids(message.get('Message-Id'))
+    legacy_parse_message_ids(message.get('References', ''))
+    legacy_parse_message_ids(message.get('In-Reply-To', ''))
+    legacy_parse_message_ids(message.get('Message-Id'))
+    if message.get('In-Reply-To'):
+        legacy_parse_message_ids(message.get('In-Reply-To'))
+
+
+def bench(func, items, rounds):
+    def run():
+        for item in items:
+            func(item)
+
+    return min(timeit.repeat(run, number=rounds, repeat=3))
+
+
+def main(argv):
+    rounds = int(argv[1]) if len(argv) > 1 else 5000
+    ids = sum(len(parse_message_ids(h)) for h in HEADERS)
+
+    for name, func in (('legacy', legacy_parse_message_ids),
+                       ('parse_message_ids', parse_message_ids)):
+        elapsed = bench(func, HEADERS, rounds)
+        print "%-18s %8.3fs %10.0f ids/s" % (name, elapsed, ids * rounds / elapsed)
+
+    for name, func in (('legacy', legacy_per_message),
+                       ('message_ids', message_ids)):
+        elapsed = bench(func, MESSAGES, rounds)
+        print "%-18s %8.3fs %10.0f messages/s" % (name, elapsed,
+                                                  len(MESSAGES) * rounds / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,196 @@
+"""Generate synthetic mailing list archives in mbox format
+
+Run with: python benchmarks/corpus.py [options] output.mbox
+
+The same options and seed always give the same file.  Threads are grown
+a few at a time, so messages from different threads are interleaved the
+way they are on a real list, and only the threads that are still active
+are kept in memory, which makes multi-million message corpora cheap to
+generate.
+"""
+import base64
+import heapq
+import optparse
+import random
+import sys
+import time
+
+from email.utils import formatdate
+
+START = 946684800  # 2000-01-01
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Frank', 'Grace',
+               'Heidi', 'Ivan', 'Judy', 'Mallory', 'Oscar', 'Peggy', 'Trent']
+LAST_NAMES = ['Smith', 'Jones', 'Garcia', 'Nguyen', 'Kowalski', 'Tanaka',
+              'M\xc3\xbcller', '\xc3\x98stergaard', 'Dvo\xc5\x99\xc3\xa1k']
+WORDS = ['patch', 'build', 'fails', 'release', 'question', 'about', 'the',
+         'parser', 'memory', 'leak', 'proposal', 'docs', 'fix', 'thread']
+
+
+class Options(object):
+    """The shape of a generated corpus
+
+    messages    number of messages written
+    depth       maximum depth of a reply below the thread root
+    fanout      maximum number of replies to one message
+    thread_size average number of messages in a thread
+    active      number of threads receiving replies at the same time
+    disorder    fraction of messages delivered late
+    window      how many messages late a delayed message can be
+    missing     fraction of messages that are referenced but never delivered
+    irt_only    fraction of replies with In-Reply-To but no References
+    encoded     fraction of From and Subject headers using encoded-words
+    authors     number of distinct authors
+    seed        random seed
+    """
+    def __init__(self, messages=10000, depth=10, fanout=6, thread_size=15,
+                 active=40, disorder=0.1, window=200, missing=0.02,
+                 irt_only=0.2, encoded=0.1, authors=500, seed=0):
+        self.messages = messages
+        self.depth = depth
+        self.fanout = fanout
+        self.thread_size = thread_size
+        self.active = active
+        self.disorder = disorder
+        self.window = window
+        self.missing = missing
+        self.irt_only = irt_only
+        self.encoded = encoded
+        self.authors = authors
+        self.seed = seed
+
+    def __repr__(self):
+        return "<Options: %r>" % self.__dict__
+
+
+def _author(rnd, n, encoded):
+    name = '%s %s' % (FIRST_NAMES[n % len(FIRST_NAMES)],
+                      LAST_NAMES[(n // len(FIRST_NAMES)) % len(LAST_NAMES)])
+    address = 'user%d@example%d.org' % (n, n % 17)
+
+    if encoded:
+        return '=?utf-8?b?%s?= <%s>' % (base64.b64encode(name), address)
+
+    return '"%s" <%s>' % (name.decode('utf-8').encode('ascii', 'replace'), address)
+
+
+def _subject(rnd, thread, encoded):
+    words = ' '.join(WORDS[(thread * 7 + i) % len(WORDS)] for i in range(4))
+    subject = '[list] %s #%d' % (words, thread)
+
+    if encoded:
+        return '=?iso-8859-1?q?%s_=E9t=E9?=' % subject.replace(' ', '_')
+
+    return subject
+
+
+def _message(n, msg_id, refs, thread, opts, rnd):
+    encoded = rnd.random() < opts.encoded
+    author = rnd.randrange(opts.authors)
+
+    lines = ['From user%d@example.org %s' % (author, time.asctime(time.gmtime(START + n * 60))),
+             'From: %s' % _author(rnd, author, encoded),
+             'Date: %s' % formatdate(START + n * 60 + rnd.randrange(60)),
+             'Message-Id: <%s>' % msg_id]
+
+    subject = _subject(rnd, thread, encoded)
+    if refs:
+        subject = 'Re: ' + subject
+        if rnd.random() >= opts.irt_only:
+            lines.append('References: ' + '\n\t'.join('<%s>' % r for r in refs))
+        lines.append('In-Reply-To: <%s>' % refs[-1])
+    lines.append('Subject: %s' % subject)
+    lines.append('')
+
+    for i in range(rnd.randrange(2, 12)):
+        lines.append(' '.join(rnd.choice(WORDS) for w in range(10)))
+    lines.append('')
+    lines.append('')
+
+    return '\n'.join(lines)
+
+
+def messages(opts):
+    """Yield (message id, mbox text) for the corpus described by opts"""
+    rnd = random.Random(opts.seed)
+    threads = []
+    started = 0
+    delayed = []
+
+    for n in xrange(opts.messages):
+        if len(threads) < opts.active or rnd.random() < 1.0 / opts.thread_size:
+            # Start a new thread; nodes are [message id, ancestors, children]
+            thread = [started, [['t%d.0@%d.example.org' % (started, opts.seed), [], 0]]]
+            started += 1
+            if len(threads) >= opts.active:
+                threads.pop(rnd.randrange(len(threads)))
+            threads.append(thread)
+            msg_id, refs = thread[1][0][0], []
+        else:
+            thread = rnd.choice(threads)
+            nodes = thread[1]
+            parent = None
+            for attempt in range(5):
+                candidate = rnd.choice(nodes)
+                if len(candidate[1]) < opts.depth and candidate[2] < opts.fanout:
+                    parent = candidate
+                    break
+            if parent is None:
+                parent = nodes[0]
+
+            parent[2] += 1
+            refs = parent[1] + [parent[0]]
+            msg_id = 't%d.%d@%d.example.org' % (thread[0], len(nodes), opts.seed)
+            nodes.append([msg_id, refs, 0])
+
+        text = _message(n, msg_id, refs, thread[0], opts, rnd)
+
+        if rnd.random() < opts.missing:
+            continue
+
+        if rnd.random() < opts.disorder:
+            heapq.heappush(delayed, (n + rnd.randrange(1, opts.window + 1), n, msg_id, text))
+        else:
+            yield msg_id, text
+
+        while delayed and delayed[0][0] <= n:
+            yield heapq.heappop(delayed)[2:]
+
+    while delayed:
+        yield heapq.heappop(delayed)[2:]
+
+
+def write_corpus(path, opts):
+    """Write the corpus described by opts to path, return the message count"""
+    count = 0
+    with open(path, 'wb') as f:
+        for msg_id, text in messages(opts):
+            f.write(text)
+            count += 1
+
+    return count
+
+
+def option_parser(usage):
+    parser = optparse.OptionParser(usage=usage)
+    defaults = Options()
+    for name in sorted(defaults.__dict__):
+        value = getattr(defaults, name)
+        parser.add_option('--' + name.replace('_', '-'), dest=name, default=value,
+                          type='float' if isinstance(value, float) else 'int')
+
+    return parser
+
+
+def main(argv):
+    parser = option_parser("usage: %prog [options] output.mbox")
+    values, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("an output path is needed")
+
+    count = write_corpus(args[0], Options(**values.__dict__))
+    print "%d messages written to %s" % (count, args[0])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
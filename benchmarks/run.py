@@ -0,0 +1,171 @@
+"""Time the threading pipeline on a synthetic or existing mbox
+
+Run with: python benchmarks/run.py [options]
+
+A corpus is generated with corpus.py (see its options, e.g. --messages
+100000) unless --mbox points at an existing file.  Each phase is timed
+separately:
+
+    scan             scan_mbox over the whole file, headers only
+    thread           MailForest.fill_tree on the scanned headers
+    walk             walk_tree over every tree of the forest
+    graft            merging four partial forests with MailForest.merge
+    create_mailtree  create_mailtree on the mbox, parsing whole messages
+
+The report is printed as JSON: per phase the wall time, messages per
+second and resident set size afterwards, plus the peak resident set size
+of the run.  Pass a previous report with --compare to see the speed-up or
+slow-down of every phase.
+"""
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from corpus import Options, option_parser, write_corpus
+
+from mailtree import MailForest, create_mailtree
+from mailtree.scanner import scan_mbox
+
+PHASES = ['scan', 'thread', 'walk', 'graft', 'create_mailtree']
+
+
+def rss():
+    """Return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return peak_rss()
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_phases(path, phases):
+    state = {}
+
+    def scan():
+        state['records'] = list(scan_mbox(path))
+        return len(state['records'])
+
+    def thread():
+        state['forest'] = forest = MailForest()
+        forest.fill_tree(state['records'])
+        return len(state['records'])
+
+    def walk():
+        count = 0
+        for tree in state['forest'].trees.itervalues():
+            for node in tree.walk_tree():
+                count += 1
+        return count
+
+    def graft():
+        records = state['records']
+        step = len(records) // 4 + 1
+        parts = []
+        for start in xrange(0, len(records), step):
+            part = MailForest()
+            part.fill_tree(records[start:start + step])
+            parts.append(part)
+
+        begin = time.time()
+        forest = MailForest()
+        for part in parts:
+            forest.merge(part)
+        state['graft_time'] = time.time() - begin
+        return len(records)
+
+    def full():
+        return sum(len(t.nodes) for t in create_mailtree(path).trees.itervalues())
+
+    funcs = {'scan': scan, 'thread': thread, 'walk': walk, 'graft': graft,
+             'create_mailtree': full}
+
+    results = {}
+    for name in phases:
+        if name != 'scan' and 'records' not in state:
+            scan()
+        if name == 'walk' and 'forest' not in state:
+            thread()
+
+        start = time.time()
+        count = funcs[name]()
+        elapsed = state.pop('graft_time', time.time() - start)
+
+        results[name] = {
+            'seconds': round(elapsed, 4),
+            'items': count,
+            'per_second': round(count / elapsed, 1) if elapsed else None,
+            'rss': rss(),
+        }
+        print >>sys.stderr, "%-16s %9.3fs %12.0f/s" % (name, elapsed, count / (elapsed or 1))
+
+    return results
+
+
+def compare(report, old):
+    print >>sys.stderr, "\n%-16s %10s %10s %8s" % ('phase', 'before', 'after', 'speed-up')
+    for name, phase in sorted(report['phases'].items()):
+        if name in old.get('phases', {}):
+            before = old['phases'][name]['seconds']
+            print >>sys.stderr, "%-16s %9.3fs %9.3fs %7.2fx" % (
+                name, before, phase['seconds'], before / (phase['seconds'] or 1e-9))
+
+
+def main(argv):
+    parser = option_parser("usage: %prog [options]")
+    parser.add_option('--mbox', help="benchmark an existing mbox instead")
+    parser.add_option('--keep', help="keep the generated corpus at this path")
+    parser.add_option('--phases', default=','.join(PHASES),
+                      help="comma separated phases to run [%default]")
+    parser.add_option('--output', help="write the report here instead of stdout")
+    parser.add_option('--compare', help="a previous report to compare with")
+    values, args = parser.parse_args(argv[1:])
+
+    phases = values.phases.split(',')
+    for name in phases:
+        if name not in PHASES:
+            parser.error("unknown phase %s" % name)
+
+    report = {'python': sys.version.split()[0]}
+
+    if values.mbox:
+        path = values.mbox
+        report['mbox'] = os.path.abspath(path)
+    else:
+        opts = Options(**dict((k, getattr(values, k)) for k in Options().__dict__))
+        path = values.keep or tempfile.mktemp(suffix='.mbox')
+        start = time.time()
+        write_corpus(path, opts)
+        report['corpus'] = opts.__dict__
+        print >>sys.stderr, "%-16s %9.3fs" % ('generate', time.time() - start)
+
+    try:
+        report['bytes'] = os.path.getsize(path)
+        report['phases'] = run_phases(path, phases)
+        report['messages'] = report['phases'].get('scan', {}).get('items')
+        report['peak_rss'] = peak_rss()
+    finally:
+        if not values.mbox and not values.keep:
+            os.unlink(path)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if values.output:
+        with open(values.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+    if values.compare:
+        with open(values.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
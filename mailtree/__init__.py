@@ -1,92 +1,353 @@
-import mailbox
-import string
+import codecs
+import itertools
+import os
+import re
+import time
 
-from email.header import decode_header
+from collections import deque, namedtuple
+
+# mailbox and email are imported where they are used, they take longer to
+# import than the rest of the package and the command doesn't need them
+# to answer --help
+from mailtree.scanner import scan_mbox, read_message
+
+class OrderedSet(object):
+    """A list which ignores duplicates, with O(1) membership tests
+
+    Small sets are only kept as a list, the index is built once they grow
+    past INDEX_THRESHOLD items.
+    """
+    __slots__ = ('_items', '_index')
+
+    INDEX_THRESHOLD = 8
+
+    def __init__(self, items=()):
+        self._items = []
+        self._index = None
+        self.update(items)
+
+    def add(self, item):
+        """Add item unless it is already present, return the stored item"""
+        index = self._index
+        if index is None:
+            items = self._items
+            if item in items:
+                return items[items.index(item)]
+
+            items.append(item)
+            if len(items) > self.INDEX_THRESHOLD:
+                self._index = dict((i, i) for i in items)
+
+            return item
+
+        if item in index:
+            return index[item]
+
+        index[item] = item
+        self._items.append(item)
+
+        return item
+
+    append = add
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def insert(self, idx, item):
+        """Insert item, which must not be present yet, before position idx"""
+        self._items.insert(idx, item)
+        if self._index is not None:
+            self._index[item] = item
+        elif len(self._items) > self.INDEX_THRESHOLD:
+            self._index = dict((i, i) for i in self._items)
+
+    def remove(self, item):
+        self._items.remove(item)
+        if self._index is not None:
+            del self._index[item]
+
+    def __contains__(self, item):
+        if self._index is None:
+            return item in self._items
+
+        return item in self._index
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, idx):
+        return self._items[idx]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return self._items
+
+    def __setstate__(self, items):
+        self._items = []
+        self._index = None
+        self.update(items)
+
+    def __repr__(self):
+        return "OrderedSet(%r)" % self._items
+
+
+class MailTreeNode(object):
+    """A message in a MailTree
+
+    Nodes which have not been hydrated yet are placeholders for messages
+    that were referenced but not seen.  There is one of these per message
+    id, so they are kept small: no instance dict, the children set is only
+    created once a node gets a child, and message ids are interned.
+
+    seq numbers nodes in the order they were hydrated, and the Date header
+    is only parsed the first time date is looked at.  Nodes hydrated from
+    scan_mbox records remember where their message is, in source, offset
+    and length, so the message itself doesn't have to be kept around.
+    """
+    __slots__ = ('isEmpty', 'message_id', 'author', 'subject', '_children',
+                 '_date', 'seq', 'source', 'offset', 'length')
 
-class MailTreeNode:
     def __init__(self, message_id):
         self.isEmpty = True
-        self.children = []
-        self.message_id = message_id
+        self._children = None
+        self.message_id = _intern(message_id)
         self.author = ''
         self.subject = ''
+        self._date = None
+        self.seq = None
+        self.source = None
+        self.offset = None
+        self.length = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = OrderedSet()
+        return self._children
 
-    def hydrate(self, message, tree):
-        self.author = get_header(message.get('From', ''))
+    @property
+    def date(self):
+        """The Date header as a UTC timestamp, None if missing or invalid"""
+        date = self._date
+        if isinstance(date, basestring):
+            date = self._date = _parse_date(date)
+        return date
+
+    def hydrate(self, message, tree, author=None, ids=None, seq=None):
+        if author is None:
+            author = get_header(message.get('From', ''))
+        self.author = author
         self.subject = get_header(message.get('Subject'))
-        if message.get('In-reply-to'):
+        self._date = message.get('Date')
+        self.seq = next(_arrival) if seq is None else seq
+
+        source = getattr(message, 'source', None)
+        if source is not None:
+            self.source = _intern(source)
+            self.offset = message.offset
+            self.length = message.length
+
+        if ids is None:
             in_reply_to = parse_message_ids(message.get('In-Reply-To'))
-            if len(in_reply_to):
-                tree.nodes[in_reply_to[0]].children.append(self)
+        else:
+            in_reply_to = ids.in_reply_to
+        if len(in_reply_to):
+            tree.nodes[in_reply_to[0]].children.append(self)
 
         self.isEmpty = False
 
+    def raw_message(self, reader=None):
+        """
+        Read the text of this node's message, "From " line included
+
+        The message is read from its mbox with a seek, or out of reader, an
+        MboxReader, if one is given.  Raises ValueError if the node wasn't
+        hydrated from an mbox record, or the mbox has changed since.
+        """
+        if self.source is None:
+            raise ValueError("the location of %s is unknown" % self.message_id)
+
+        if reader is not None:
+            return reader.read(self.source, self.offset, self.length)
+
+        return read_message(self.source, self.offset, self.length)
+
+    def message(self, reader=None):
+        """Read and parse this node's message into a mailbox.mboxMessage"""
+        import mailbox
+
+        from_line, sep, text = self.raw_message(reader).partition('\n')
+        msg = mailbox.mboxMessage(text)
+        msg.set_from(from_line[5:].rstrip('\r'))
+
+        return msg
+
+    def __getstate__(self):
+        return (self.isEmpty, self.message_id, self.author, self.subject,
+                self._children, self.date, self.seq, self.source, self.offset,
+                self.length)
+
+    def __setstate__(self, state):
+        (self.isEmpty, self.message_id, self.author, self.subject,
+         self._children, self._date, self.seq, self.source, self.offset,
+         self.length) = state
+
     def __repr__(self):
         return "<MailTreeNode: %s>" % self.message_id
 
 
 class MailTree:
+    """
+    A thread, its nodes by message id and its authors
+
+    Authors are listed in the order of their first message in the tree.
+    """
     def __init__(self, message_id, message = None):
         self.parent = MailTreeNode(message_id)
-        self.nodes = {message_id: self.parent}
-        self.authors = []
-        self.message_id = message_id
+        self.nodes = {self.parent.message_id: self.parent}
+        self.authors = OrderedSet()
+        self.message_id = self.parent.message_id
+        self._first = None
         if message:
             self.hydrate(message)
 
-    def hydrate(self, message, references=None):
+    def hydrate(self, message, references=None, ids=None, seq=None):
+        if ids is None:
+            ids = message_ids(message)
         if references is None:
-            references = parse_message_ids(message.get('References', ""))
+            references = ids.references
 
         for ref in references:
             if ref not in self.nodes:
-                self.nodes[ref] = MailTreeNode(ref)
+                self._add_node(ref)
 
+        author = self.add_author(message.get('From'))
         if self.parent.isEmpty:
-            self.parent.hydrate(message, self)
+            self.parent.hydrate(message, self, author, ids, seq)
+            self._first_message(author, self.parent)
 
-        mid = parse_message_ids(message.get('Message-Id'))
-        if len(mid) > 0:
-            self.message_id = mid[0]
+        if ids.message_id is not None:
+            self.message_id = ids.message_id
 
-        self.add_author(message.get('From'))
+    def _add_node(self, message_id):
+        node = MailTreeNode(message_id)
+        self.nodes[node.message_id] = node
 
     def add_author(self, author):
-        formatted = get_header(author)
-        if formatted not in self.authors:
-            self.authors.append(formatted)
+        """Add the decoded author header, return the instance kept in authors"""
+        return self.authors.add(get_header(author))
+
+    def _first_seqs(self):
+        """Return the arrival number of the first message of every author"""
+        first = self._first
+        if first is None:
+            # Trees read back from a file only have their nodes
+            first = self._first = {}
+            for node in self.nodes.itervalues():
+                if not node.isEmpty and node.seq is not None:
+                    if node.seq < first.get(node.author, node.seq + 1):
+                        first[node.author] = node.seq
+
+        return first
+
+    def _first_message(self, author, node):
+        first = self._first_seqs()
+        if author not in first:
+            first[author] = node.seq
 
     def graft(self, other):
-        for author in other.authors:
-            if author not in self.authors:
-                self.authors.append(author)
+        """Merge the nodes and authors of other into this tree
+
+        The containers of the larger tree are kept and the smaller tree is
+        merged into them, so the cost is proportional to the smaller tree.
+        Authors and the children of the messages found in both trees end
+        up in arrival order, so trees grafted in any order come out the
+        same.
+        """
+        authors, extra = self.authors, other.authors
+        first, seqs = self._first_seqs(), other._first_seqs()
+        if len(extra) > len(authors):
+            authors, extra = extra, authors
+            first, seqs = seqs, first
+        if extra:
+            _merge_authors(authors, first, extra, seqs)
+
+        if len(seqs) > len(first):
+            first, seqs = seqs, first
+        for author, seq in seqs.iteritems():
+            if seq < first.get(author, seq + 1):
+                first[author] = seq
+        self._first = first
 
-        for node in other.nodes:
-            if node not in self.nodes:
-                self.nodes[node] = other.nodes[node]
-            elif not other.nodes[node].isEmpty:
-                self.nodes[node] = other.nodes[node]
+        swapped = len(other.nodes) > len(self.nodes)
+        if swapped:
+            nodes, extra = other.nodes, self.nodes
+        else:
+            nodes, extra = self.nodes, other.nodes
 
-            for child in other.nodes[node].children:
-                if child not in self.nodes[node].children:
-                    self.nodes[node].children.append(child)
+        both = False
+        joined = []
+        for key, node in extra.iteritems():
+            if key not in nodes:
+                nodes[key] = node
+                continue
+
+            if swapped:
+                ours, theirs = node, nodes[key]
+            else:
+                ours, theirs = nodes[key], node
+
+            # A hydrated node from other replaces a placeholder of ours,
+            # keeping both sets of children
+            if ours.isEmpty and not theirs.isEmpty:
+                ours, theirs = theirs, ours
+            if theirs._children:
+                ours.children.update(theirs._children)
+                joined.append(key)
+            nodes[key] = ours
+            both = both or not theirs.isEmpty
+
+        # A message hydrated on both sides, such as a copy threaded in
+        # another forest, is among the children of its parent twice
+        for key in extra if both else joined:
+            node = nodes[key]
+            if node._children:
+                kids = OrderedSet(nodes[c.message_id] for c in node._children)
+                node._children = OrderedSet(sorted(kids, key=_arrival_key))
+
+        self.authors = authors
+        self.nodes = nodes
+        self.parent = nodes[self.parent.message_id]
 
         other.message_id = self.message_id
 
-    def addChild(self, message, references=None):
-        self.add_author(message.get('From'))
+    def addChild(self, message, references=None, ids=None, seq=None):
+        author = self.add_author(message.get('From'))
 
         for ref in references or []:
             if ref not in self.nodes:
-                self.nodes[ref] = MailTreeNode(ref)
+                self._add_node(ref)
+
+        if ids is None:
+            ids = message_ids(message)
 
-        mid = message.get('Message-id')
-        mid = parse_message_ids(mid)[0]
+        mid = ids.message_id
         if mid not in self.nodes:
-            self.nodes[mid] = MailTreeNode(mid)
+            self._add_node(mid)
         
-        if self.nodes[mid].isEmpty:
-            self.nodes[mid].hydrate(message, self)
+        node = self.nodes[mid]
+        if node.isEmpty:
+            node.hydrate(message, self, author, ids, seq)
+            self._first_message(author, node)
 
     def addTree(self, tree):
         """This is dead code"""
@@ -96,39 +357,255 @@ class MailTree:
                 self.authors.append(author)
 
     def walk_tree(self):
-        """Go through the list of messages in this email tree depth-first
+        """Go through the list of messages in this email tree depth-first"""
+        for depth, node in self.depth_first():
+            yield node
+
+    def depth_first(self, order=None, start=None):
+        """
+        Yield (depth, node) for every node below start, pre-order depth-first
+
+        start defaults to the root of the tree.  order sorts the children of
+        each node: 'date', 'arrival' or a key function, otherwise they come
+        in the order they were threaded.  A node is only visited once, so a
+        cycle in malformed References is cut where it closes.
+        """
+        key = _child_key(order)
+        if start is None:
+            start = self.parent
+        seen = set([start.message_id])
+        stack = [(0, start)]
+
+        while stack:
+            depth, node = stack.pop()
+            yield depth, node
+
+            children = node._children
+            if not children:
+                continue
+            if key is None:
+                children = children._items
+            else:
+                children = sorted(children, key=key)
+
+            depth += 1
+            for child in reversed(children):
+                if child.message_id not in seen:
+                    seen.add(child.message_id)
+                    stack.append((depth, child))
+
+    def breadth_first(self, order=None, start=None):
+        """Yield (depth, node) for every node below start, level by level
+
+        Takes the same arguments as depth_first.
+        """
+        key = _child_key(order)
+        if start is None:
+            start = self.parent
+        seen = set([start.message_id])
+        queue = deque([(0, start)])
+
+        while queue:
+            depth, node = queue.popleft()
+            yield depth, node
+
+            children = node._children
+            if not children:
+                continue
+            if key is not None:
+                children = sorted(children, key=key)
+
+            depth += 1
+            for child in children:
+                if child.message_id not in seen:
+                    seen.add(child.message_id)
+                    queue.append((depth, child))
+
+    def cycles(self):
+        """Return the (node, child) links which close a cycle of replies"""
+        ret = []
+        done = set()
+
+        for top in [self.parent] + sorted(self.nodes.itervalues(),
+                                          key=lambda n: n.message_id):
+            if top.message_id in done:
+                continue
+
+            # Nodes on the current path are in path, the iterators hold the
+            # children still to visit for each of them
+            path = set([top.message_id])
+            stack = [(top, iter(top._children or ()))]
+            done.add(top.message_id)
+
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if child.message_id in path:
+                        ret.append((node, child))
+                    elif child.message_id not in done:
+                        done.add(child.message_id)
+                        path.add(child.message_id)
+                        stack.append((child, iter(child._children or ())))
+                        break
+                else:
+                    stack.pop()
+                    path.discard(node.message_id)
+
+        return ret
+
+    def orphans(self, order=None):
+        """
+        Return the first node of every part of the tree the root can't reach
+
+        These are left over when a message references a parent which was
+        never seen.  Each of them can be passed as start to depth_first.
+        order sorts them like children, by default they are sorted by
+        message id.
+        """
+        seen = set(node.message_id for depth, node in self.depth_first())
+        if len(seen) == len(self.nodes):
+            return []
+
+        lost = sorted((node for key, node in self.nodes.iteritems() if key not in seen),
+                      key=_child_key(order) or (lambda n: n.message_id))
+
+        children = set()
+        for node in lost:
+            children.update(c.message_id for c in node._children or ())
+
+        # Nodes which are someone's child only make the list when they are
+        # part of a detached cycle
+        ret = []
+        for heads in ([n for n in lost if n.message_id not in children], lost):
+            for node in heads:
+                if node.message_id not in seen:
+                    ret.append(node)
+                    seen.update(n.message_id for d, n in self.depth_first(start=node))
 
-        TODO:  it may be possible for orphan nodes to exist.
+        return ret
+
+    def walk(self, order=None):
+        """
+        Yield (depth, node) for every node of the tree, depth-first from
+        the root and then from each of its orphans
+
+        Depths below an orphan start over at 0.  order is passed on to
+        depth_first and orphans.
         """
-        stack = [self.parent]
+        count = 0
+        for depth, node in self.depth_first(order):
+            count += 1
+            yield depth, node
+
+        if count < len(self.nodes):
+            for orphan in self.orphans(order):
+                for depth, node in self.depth_first(order, start=orphan):
+                    yield depth, node
 
-        while stack != []:
-            current = stack.pop()
-            yield current
+    def __getstate__(self):
+        # Children are stored as message ids so that pickling a deep thread
+        # doesn't recurse once per level
+        nodes = []
+        for node in self.nodes.itervalues():
+            children = [c.message_id for c in node._children or ()]
+            nodes.append((node.message_id, node.isEmpty, node.author,
+                          node.subject, children, node.date, node.seq,
+                          node.source, node.offset, node.length))
 
-            for x in current.children:
-                stack.insert(0, x)
+        return (self.message_id, self.parent.message_id, list(self.authors), nodes)
 
+    def __setstate__(self, state):
+        self.message_id, parent, authors, nodes = state
+        self.authors = OrderedSet(authors)
+        self._first = None
+        self.nodes = {}
+
+        for (message_id, empty, author, subject, children, date, seq,
+             source, offset, length) in nodes:
+            node = MailTreeNode(message_id)
+            node.isEmpty, node.author, node.subject = empty, author, subject
+            node._date, node.seq = date, seq
+            node.source, node.offset, node.length = source, offset, length
+            self.nodes[node.message_id] = node
+
+        for record in nodes:
+            if record[4]:
+                self.nodes[record[0]].children.update(self.nodes[c] for c in record[4])
+
+        self.parent = self.nodes[parent]
 
 
 class MailForest(dict):
-    def __init__(self):
+    """A set of MailTrees, indexed by every message id they contain
+
+    keys is a disjoint-set forest: each message id points towards the key
+    its tree is stored under in trees.  Lookups compress the paths they
+    walk, and sizes holds the number of message ids under each tree key so
+    that merging two trees hangs the smaller set under the larger one.
+    roots holds the same trees under the message id of their root.
+
+    Callables in listeners are told about every change as it happens, with
+    listener(event, tree, other):
+
+        'created', tree, None      a new tree was started
+        'added', tree, node        a message was threaded into tree, node
+                                   is None when a whole tree was merged in
+        'grafted', tree, other     the tree other was grafted into tree
+
+    arrival numbers the messages as they are threaded, it defaults to one
+    counter shared by every forest of the process.
+    """
+    def __init__(self, arrival=None):
+        self.arrival = arrival
         self.trees = {}
         self.keys = {}
+        self.sizes = {}
+        self.roots = {}
+        self.listeners = []
+        self.dedup = None
+        self.stats = None
+
+    def notify(self, event, tree, other=None):
+        for listener in self.listeners:
+            listener(event, tree, other)
 
     def pruned_trees(self):
-        trees = {}
-        for k in self.keys():
-            if self[k].message_id == k:
-                trees[k] = self[k]
+        """Return a dict of every tree by the message id of its root
 
-        return trees
+        The dict is a copy of roots, changing it leaves the forest alone.
+        """
+        return dict(self.roots)
 
     def parent_key(self, key):
-        while key != self.keys[key]:
-            key = self.keys[key]
+        keys = self.keys
+        root = key
+        links = 0
+        while root != keys[root]:
+            root = keys[root]
+            links += 1
 
-        return key
+        while key != root:
+            keys[key], key = root, keys[key]
+
+        if self.stats is not None:
+            counters = self.stats.counters
+            counters['lookups'] += 1
+            counters['chain_links'] += links
+
+        return root
+
+    def union(self, a, b):
+        """Join the sets stored under the keys a and b, return the new key"""
+        if a == b:
+            return a
+
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+
+        self.keys[b] = a
+        self.sizes[a] += self.sizes.pop(b)
+
+        return a
 
     def __getitem__(self, key):
         if key not in self.keys:
@@ -140,71 +617,500 @@ class MailForest(dict):
     def __len__(self):
         return len(self.trees)
 
+    def node(self, message_id):
+        """Return the MailTreeNode of message_id"""
+        return self[message_id].nodes[message_id]
+
+    def raw_message(self, message_id, reader=None):
+        """Read the text of a message back from its mbox, see MailTreeNode"""
+        return self.node(message_id).raw_message(reader)
+
+    def message(self, message_id, reader=None):
+        """Read a message back from its mbox as a mailbox.mboxMessage"""
+        return self.node(message_id).message(reader)
+
+    def _tree_key(self, key):
+        if key in self.keys:
+            return self.parent_key(key)
+
+        key = _intern(key)
+        self.keys[key] = key
+        self.sizes[key] = 1
+        tree = self.trees[key] = self.roots[key] = MailTree(key)
+        if self.listeners:
+            self.notify('created', tree)
+
+        return key
+
+    def _add_key(self, key, tree_key):
+        if key not in self.keys:
+            self.keys[_intern(key)] = tree_key
+            self.sizes[tree_key] += 1
+            return tree_key
+
+        other = self.parent_key(key)
+        if other == tree_key:
+            return tree_key
+
+        return self._graft(tree_key, other)
+
+    def _graft(self, tree_key, other, adopt=False):
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+            stats.counters['grafts'] += 1
+            stats.counters['graft_nodes'] += min(self.sizes[tree_key], self.sizes[other])
+
+        tree = self.trees.pop(tree_key)
+        grafted = self.trees.pop(other)
+        root = grafted.parent.message_id
+        del self.roots[root]
+        tree.graft(grafted)
+        if adopt:
+            tree.parent.children.append(tree.nodes[root])
+
+        tree_key = self.union(tree_key, other)
+        self.trees[tree_key] = tree
+        if self.listeners:
+            self.notify('grafted', tree, grafted)
+
+        if stats is not None:
+            stats.timers['graft'] += time.time() - start
+
+        return tree_key
+
+    def graft(self, key, other):
+        """
+        Graft the tree holding the message id other into the tree holding
+        key, its root becoming a child of the root of that tree
+
+        This joins threads which belong together without any reference
+        between them.  Returns the tree.
+        """
+        if key not in self.keys or other not in self.keys:
+            raise IndexError
+
+        tree_key = self.parent_key(key)
+        other = self.parent_key(other)
+        if other != tree_key:
+            tree_key = self._graft(tree_key, other, adopt=True)
+
+        return self.trees[tree_key]
+
+    def merge(self, other):
+        """Graft every tree of the forest other into this forest
+
+        Trees are merged in a deterministic order.  A tree whose root is
+        already known here is grafted into the tree holding that message,
+        otherwise it keeps its own root and absorbs any tree here that
+        shares a message id with it.  Merging the forests built from
+        consecutive parts of a mailbox gives the same threads as threading
+        the whole mailbox at once.
+        """
+        for key in sorted(other.trees):
+            tree = other.trees[key]
+            root = tree.parent.message_id
+            members = tree.nodes.keys()
+
+            if root in self.keys:
+                tree_key = self.parent_key(root)
+                self.trees[tree_key].graft(tree)
+                event = 'added'
+            else:
+                tree_key = self.keys[root] = root
+                self.sizes[root] = 1
+                self.trees[root] = self.roots[root] = tree
+                event = 'created'
+
+            for message_id in members:
+                tree_key = self._add_key(message_id, tree_key)
+
+            if self.listeners:
+                self.notify(event, self.trees[tree_key])
+
     def fill_tree(self, box):
-        for m in box:
-            msg_id = m.get('Message-id')
-            msg_id = parse_message_ids(msg_id)[0]
-
-            references = parse_message_ids(m.get('References', ''))
-            references.extend(parse_message_ids(m.get('In-Reply-To', '')))
-
-            if len(references) > 0:
-                tree_key = references[0]
-                if tree_key in self.keys:
-                    tree_key = self.parent_key(tree_key)
-
-                if tree_key not in self.trees:
-                    self.trees[tree_key] = MailTree(tree_key)
-
-                for ref in references:
-                    if ref not in self.keys:
-                        self.keys[ref] = tree_key
-
-                if msg_id not in self.keys:
-                    self.keys[msg_id] = tree_key
-                    self.trees[tree_key].addChild(m, references)
-                elif msg_id in self.trees:
-                    self.trees[msg_id].hydrate(m, references)
-                    self.trees[tree_key].graft(self.trees[msg_id])
-                    del self.trees[msg_id]
-                    self.keys[msg_id] = tree_key
-                else:
-                    self.trees[tree_key].addChild(m, references)
+        """Thread every message of box into the forest
+
+        box can be a mailbox.mbox, any iterable of email.message.Message or
+        the MessageHeaders records yielded by scan_mbox.  Messages go
+        through the Deduplicator in dedup first, which skips copies of
+        messages already in the forest and makes up a Message-Id for those
+        without one.
+        """
+        if self.dedup is None:
+            from mailtree.dedup import Deduplicator
+            self.dedup = Deduplicator(self)
 
+        if self.stats is not None:
+            self.stats.fill(self, box)
+            return
+
+        for m, ids in self.dedup.filter(box):
+            self.add_message(m, ids)
+
+    def add_message(self, m, ids=None):
+        """Thread a single message into the forest, return its tree
+
+        ids is the MessageIds of m, if they were already parsed.
+        """
+        if ids is None:
+            ids = message_ids(m)
+        msg_id = ids.message_id
+        if msg_id is None:
+            raise ValueError("message has no Message-Id")
+
+        references = ids.references
+        seq = None if self.arrival is None else next(self.arrival)
+
+        if len(references) > 0:
+            tree_key = self._tree_key(references[0])
+
+            # The tree of the first reference keeps its root, anything else
+            # this message ties it to gets grafted in
+            for ref in references[1:]:
+                tree_key = self._add_key(ref, tree_key)
+            tree_key = self._add_key(msg_id, tree_key)
+
+            tree = self.trees[tree_key]
+            tree.addChild(m, references, ids, seq)
+
+        elif msg_id in self.keys:
+            tree = self[msg_id]
+            if tree.parent.message_id == msg_id:
+                tree.hydrate(m, ids=ids, seq=seq)
             else:
-                self.keys[msg_id] = msg_id
-                if msg_id in self.trees:
-                    self.trees[msg_id].hydrate(m)
-                else:
-                    self.trees[msg_id] = MailTree(msg_id, m)
+                tree.addChild(m, ids=ids, seq=seq)
+
+        else:
+            msg_id = _intern(msg_id)
+            self.keys[msg_id] = msg_id
+            self.sizes[msg_id] = 1
+            tree = self.trees[msg_id] = self.roots[msg_id] = MailTree(msg_id)
+            tree.hydrate(m, ids=ids, seq=seq)
+            if self.listeners:
+                self.notify('created', tree)
+
+        if self.listeners:
+            self.notify('added', tree, tree.nodes[msg_id])
+
+        return tree
+
+class HeaderCache(object):
+    """A bounded LRU cache of decoded header values
+
+    Mailing lists keep seeing the same few authors and subjects, so the
+    decoded value of a raw header is kept around for the next time it
+    shows up.  hits and misses count the lookups, a size of 0 turns the
+    cache off.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.stats = None
+        self.clear()
+
+    def clear(self):
+        # Links are [previous, next, header, value], the root link sits
+        # between the most and the least recently used ones
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._links = {}
+
+    def resize(self, size):
+        self.size = size
+        while len(self._links) > max(size, 0):
+            self._evict()
+
+    def _evict(self):
+        root = self._root
+        oldest = root[1]
+        root[1] = oldest[1]
+        oldest[1][0] = root
+        del self._links[oldest[2]]
+
+    def get(self, header):
+        link = self._links.get(header)
+        if link is not None:
+            self.hits += 1
+            previous, following, key, value = link
+            previous[1] = following
+            following[0] = previous
+
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+
+            return value
+
+        self.misses += 1
+        if self.stats is None:
+            value = _decode_header(header)
+        else:
+            start = time.time()
+            value = _decode_header(header)
+            self.stats.timers['decode'] += time.time() - start
+
+        if self.size > 0:
+            if len(self._links) >= self.size:
+                self._evict()
+
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._links[header] = [last, root, header, value]
+
+        return value
+
+    def __len__(self):
+        return len(self._links)
+
+    def __repr__(self):
+        return "<HeaderCache: %d/%d, %d hits, %d misses>" % (
+            len(self), self.size, self.hits, self.misses)
+
+
+header_cache = HeaderCache()
+
+_codecs = {}
+
+# Names of the codecs for character sets.  Python has others, such as hex,
+# zlib or rot-13, which turn bytes into bytes or can't decode every string,
+# and a charset in a header must not pick one of those.
+_CHARSET_CODEC = re.compile(r'(ascii|utf-(7|8|16|32)(-[bl]e|-sig)?|iso8859-\d+|iso2022_\w+|'
+                            r'cp\d+|mac-\w+|koi8-[ru]|(euc|shift)_\w+|big5(hkscs)?|gb\w+|'
+                            r'hz|johab|ptcp154|tis-620|hp-roman8|palmos)$')
+
+def _codec(charset, default='ascii'):
+    """
+    Return the codec to decode charset with, falling back to default for
+    unknown charsets and codecs which aren't for a character set
+    """
+    try:
+        return _codecs[charset] or default
+    except KeyError:
+        pass
+
+    try:
+        name = codecs.lookup(charset).name
+    except LookupError:
+        name = None
+
+    if name is not None and not _CHARSET_CODEC.match(name):
+        name = None
+
+    _codecs[charset] = name
+    return name or default
+
+def _decode_header(header):
+    if header is None:
+        return u''
+
+    from email.errors import HeaderParseError
+    from email.header import decode_header
+
+    try:
+        dh = decode_header(header)
+    except HeaderParseError:
+        dh = [(header, None)]
+
+    return u''.join([ t[0] if isinstance(t[0], unicode)
+                      else t[0].decode(_codec(t[1] or 'ASCII'), 'replace')
+                      for t in dh ])
+
+_arrival = itertools.count()
+_NO_SEQ = float('inf')
+
+def _merge_authors(authors, first, extra, seqs):
+    """
+    Merge extra into authors, both ordered by the arrival number of the
+    first message of each author, in first and seqs
+
+    Only the authors of extra are placed, with a binary search each, and
+    first is updated for them.
+    """
+    items = authors._items
+    for author in extra:
+        seq = seqs.get(author, _NO_SEQ)
+        if author in authors:
+            if not seq < first.get(author, _NO_SEQ):
+                continue
+            # An earlier first message in extra moves the author forward
+            authors.remove(author)
+
+        lo, hi = 0, len(items)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if seq < first.get(items[mid], _NO_SEQ):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        authors.insert(lo, author)
+        if seq is not _NO_SEQ:
+            first[author] = seq
+
+def _parse_date(header):
+    from email.utils import mktime_tz, parsedate_tz
+
+    parsed = parsedate_tz(header)
+    if parsed is None:
+        return None
+
+    try:
+        return float(mktime_tz(parsed))
+    except (OverflowError, ValueError):
+        return None
+
+def _date_key(node):
+    date = node.date
+    return (date is None, date, node.seq)
+
+def _arrival_key(node):
+    return (node.seq is None, node.seq)
+
+_child_keys = {'date': _date_key, 'arrival': _arrival_key}
+
+def _child_key(order):
+    """Return the sort key for the order argument of the tree walks"""
+    if order is None or callable(order):
+        return order
+
+    try:
+        return _child_keys[order]
+    except KeyError:
+        raise ValueError("unknown order %r" % (order,))
+
+def _intern(s):
+    if type(s) is str:
+        return intern(s)
+
+    return s
 
 def get_header(header):
-    dh = decode_header(header)
-    return ''.join([ unicode(t[0], t[1] or 'ASCII') for t in dh ])
+    """Decode a header which may contain RFC 2047 encoded-words
+
+    Decoded values come out of header_cache.  Unknown charsets and bytes
+    which aren't valid in their charset are replaced instead of raising.
+    """
+    return header_cache.get(header)
+
+_message_id_re = re.compile(r'''
+      \( [^()\\]* (?: (?: \\. | \( [^()\\]* (?: \\. [^()\\]* )* \) ) [^()\\]* )* \)   # comment
+    | " [^"\\]* (?: \\. [^"\\]* )* "                                                # quoted string
+    | < ( [^<>"]* (?: " [^"\\]* (?: \\. [^"\\]* )* " [^<>"]* )* ) (>?)              # message id
+''', re.X | re.S)
+
+# Ids without whitespace, comments or quoting, and with a lower-case domain
+_plain_id_re = re.compile(r'<([^<>\s@]+(?:@[^<>\s@A-Z]*)?)>')
 
 def parse_message_ids(references):
     """
     Return a list of message ids, given a header string with message ids
 
-    TODO: comments are not being parsed which means things will break if
-    there's a < or > within a comment.
+    Comments and quoted strings outside of angle brackets are skipped.
+    Whitespace within an id is dropped and the domain part is lower-cased.
+    An id missing its closing > ends at the next whitespace or <.
     """
-    idx = 0
     ret = []
-    idx = string.find(references, '<', idx)
+    if not references:
+        return ret
 
-    while idx != -1:
-        end = string.find(references, '>', idx)
-        ret.append(references[idx+1: end])
+    # Most headers are nothing but well-formed ids, which a single findall
+    # can deal with
+    if '(' not in references and '"' not in references:
+        ids = _plain_id_re.findall(references)
+        if len(ids) == references.count('<'):
+            return ids
 
-        idx = string.find(references, '<', idx + 1)
+    for match in _message_id_re.finditer(references):
+        mid, closed = match.group(1, 2)
+        if not mid:
+            continue
+
+        parts = mid.split()
+        if not parts:
+            continue
+        mid = ''.join(parts) if closed else parts[0]
+
+        at = mid.rfind('@')
+        if at != -1 and not mid[at + 1:].islower():
+            mid = mid[:at + 1] + mid[at + 1:].lower()
+
+        ret.append(mid)
 
     return ret
 
-def create_mailtree(path):
-    box = mailbox.mbox(path)
+MessageIds = namedtuple('MessageIds', 'message_id references in_reply_to')
+
+def message_ids(message):
+    """
+    Tokenize the Message-Id, References and In-Reply-To headers of message
+
+    references is the References ids followed by the In-Reply-To ones, as
+    used to thread the message.  The message's own id is left out of both.
+    message_id is None if the message has no usable Message-Id.
+    """
+    mid = parse_message_ids(message.get('Message-Id'))
+    mid = mid[0] if mid else None
 
+    references = parse_message_ids(message.get('References'))
+    in_reply_to = parse_message_ids(message.get('In-Reply-To'))
+    references.extend(in_reply_to)
+
+    if mid is not None and mid in references:
+        references = [r for r in references if r != mid]
+        in_reply_to = [r for r in in_reply_to if r != mid]
+
+    return MessageIds(mid, references, in_reply_to)
+
+def _plain_mbox(path):
+    from mailtree.sources import SOURCES
+    return not os.path.isdir(path) and os.path.splitext(path)[1].lower() not in SOURCES
+
+def create_mailtree(path, headers_only=False, workers=1, stats=None):
+    """Build a MailForest out of the mbox at path
+
+    With headers_only, message bodies are skipped and only the headers
+    needed for threading are parsed.  With more than one worker the mbox
+    is split between that many processes, which implies headers_only;
+    workers=None uses every CPU.
+
+    path can also be a Maildir, a compressed mbox or a list of archives,
+    which are read with mailtree.sources by up to workers threads.
+
+    stats is a mailtree.stats.Stats to measure the run with, its sinks
+    get the report once the forest is built.
+    """
     top_messages = MailForest()
-    top_messages.fill_tree(box)
+    if stats is not None:
+        stats.attach(top_messages)
+
+    try:
+        if not isinstance(path, basestring) or not _plain_mbox(path):
+            from mailtree.sources import fill_sources
+            if isinstance(path, basestring):
+                path = [path]
+            fill_sources(path, workers, top_messages)
+
+        elif workers != 1:
+            from mailtree.parallel import parallel_fill
+            parallel_fill(path, workers, top_messages)
+
+        else:
+            if headers_only:
+                box = scan_mbox(path)
+            else:
+                import mailbox
+                box = mailbox.mbox(path)
+
+            top_messages.fill_tree(box)
+    finally:
+        if stats is not None:
+            stats.detach(top_messages)
+
+    if stats is not None:
+        stats.emit()
 
     return top_messages
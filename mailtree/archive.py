@@ -0,0 +1,368 @@
+"""Render a MailForest as a static HTML archive
+
+    build_archive(forest, 'public/')
+
+writes:
+
+    index.html              every thread, most recently active first
+    months/YYYY-MM.html     the messages dated in a month
+    threads/<name>.html     a thread, replies nested under their parent
+    messages/<name>.html    a message, with its body when the node knows
+                            where it was read from
+
+Page names are a hash of the message id of the root, or of the message.
+Threads are rendered by a pool of worker processes, each writing the pages
+of the threads it is given as it goes.
+
+A manifest kept next to index.html records a hash of the content of every
+tree.  The next build only renders the trees whose hash changed, as they
+received replies or were grafted together, removes the pages of the trees
+that were grafted into another one and rewrites the month listings those
+trees appear in.
+"""
+import cgi
+import collections
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+from mailtree import _codec
+from mailtree.scanner import MboxReader
+
+MANIFEST = '.mailtree-archive.json'
+MANIFEST_VERSION = 1
+
+BuildReport = collections.namedtuple('BuildReport', 'rendered unchanged removed months')
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+</head>
+<body>
+<p class="nav"><a href="%(top)sindex.html">Threads</a></p>
+<h1>%(title)s</h1>
+%(content)s
+</body>
+</html>
+"""
+
+
+def page_name(message_id):
+    """Return the name of the page of message_id, without a suffix"""
+    return hashlib.sha1(message_id).hexdigest()[:20]
+
+
+def tree_hash(tree):
+    """Return a hash of everything the pages of tree show"""
+    digest = hashlib.sha1()
+    for depth, node in tree.walk():
+        # Not the length, the last message of an mbox grows by a newline
+        # when another one is appended
+        digest.update(repr((depth, node.message_id, node.isEmpty, node.author,
+                            node.subject, node.date, node.source, node.offset)))
+        digest.update('\0')
+
+    return digest.hexdigest()
+
+
+def _month(date):
+    return time.strftime('%Y-%m', time.gmtime(date))
+
+
+def _date(date):
+    if date is None:
+        return ''
+
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(date))
+
+
+def _escape(s):
+    if s is None:
+        return ''
+    if isinstance(s, str):
+        s = s.decode('utf-8', 'replace')
+
+    return cgi.escape(s, quote=True)
+
+
+def _subject(node):
+    return _escape(node.subject) or '(no subject)'
+
+
+def _page(title, content, top='../'):
+    return (PAGE % {'title': title, 'content': content, 'top': top}).encode('utf-8')
+
+
+def _write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _link(node, top='../'):
+    return '<a href="%smessages/%s.html">%s</a>' % (top, page_name(node.message_id),
+                                                    _subject(node))
+
+
+def _body(node, reader):
+    if node.source is None:
+        return None
+
+    try:
+        msg = node.message(reader)
+    except (IOError, ValueError):
+        return None
+
+    for part in msg.walk():
+        if part.get_content_type() == 'text/plain':
+            payload = part.get_payload(decode=True) or ''
+            charset = _codec(part.get_content_charset() or 'utf-8', 'utf-8')
+            return payload.decode(charset, 'replace')
+
+    return None
+
+
+def thread_page(tree):
+    """Return the HTML of the page of tree"""
+    lines = ['<ul class="thread">']
+    level = 0
+    for depth, node in tree.walk():
+        # Orphans start over at depth 0, under the root
+        depth += 1
+        while level < depth:
+            lines.append('<ul>')
+            level += 1
+        while level > depth:
+            lines.append('</ul>')
+            level -= 1
+
+        if node.isEmpty:
+            lines.append('<li><em>(message not archived)</em></li>')
+        else:
+            lines.append('<li>%s &mdash; %s, %s</li>' % (_link(node), _escape(node.author),
+                                                          _date(node.date)))
+    lines.extend(['</ul>'] * (level + 1))
+
+    title = next((_subject(n) for d, n in tree.walk() if not n.isEmpty), '(no subject)')
+    return _page(title, '\n'.join(lines))
+
+
+def message_page(tree, node, parent, children, reader=None):
+    """Return the HTML of the page of node, a message of tree"""
+    content = ['<dl class="headers">',
+               '<dt>From</dt><dd>%s</dd>' % _escape(node.author),
+               '<dt>Date</dt><dd>%s</dd>' % _date(node.date),
+               '<dt>Message-Id</dt><dd>%s</dd>' % _escape(node.message_id),
+               '</dl>']
+
+    body = _body(node, reader)
+    if body is not None:
+        content.append('<pre class="body">%s</pre>' % _escape(body))
+
+    content.append('<p class="thread"><a href="../threads/%s.html">Whole thread</a></p>'
+                   % page_name(tree.parent.message_id))
+    if parent is not None and not parent.isEmpty:
+        content.append('<p class="parent">In reply to %s</p>' % _link(parent))
+    replies = [_link(c) for c in children if not c.isEmpty]
+    if replies:
+        content.append('<ul class="replies">%s</ul>'
+                       % ''.join('<li>%s</li>' % r for r in replies))
+
+    return _page(_subject(node), '\n'.join(content))
+
+
+def render_tree(tree, path, reader=None):
+    """Write the thread page and the message pages of tree under path"""
+    _write(os.path.join(path, 'threads', page_name(tree.parent.message_id) + '.html'),
+           thread_page(tree))
+
+    parents = {}
+    for depth, node in tree.walk():
+        for child in node._children or ():
+            parents[child.message_id] = node
+
+    for depth, node in tree.walk():
+        if node.isEmpty:
+            continue
+
+        _write(os.path.join(path, 'messages', page_name(node.message_id) + '.html'),
+               message_page(tree, node, parents.get(node.message_id),
+                            node._children or (), reader))
+
+
+_reader = None
+
+
+def _render_task(args):
+    global _reader
+    if _reader is None:
+        _reader = MboxReader()
+
+    tree, path = args
+    render_tree(tree, path, _reader)
+
+
+def month_page(month, nodes):
+    """Return the HTML of the listing of the (tree, node) pairs of month"""
+    lines = ['<table class="month">']
+    for tree, node in sorted(nodes, key=lambda entry: (entry[1].date, entry[1].message_id)):
+        lines.append('<tr><td>%s</td><td>%s</td><td>%s</td>'
+                     '<td><a href="../threads/%s.html">thread</a></td></tr>'
+                     % (_date(node.date), _link(node), _escape(node.author),
+                        page_name(tree.parent.message_id)))
+    lines.append('</table>')
+
+    return _page(month, '\n'.join(lines))
+
+
+def index_page(threads, months):
+    """
+    Return the HTML of the index, threads being (last date, tree) pairs
+    and months the months with a listing
+    """
+    lines = ['<p class="months">%s</p>' % ' '.join(
+        '<a href="months/%s.html">%s</a>' % (m, m) for m in sorted(months, reverse=True))]
+    lines.append('<table class="threads">')
+    for last, tree in sorted(threads, key=lambda entry: (entry[0], entry[1].message_id),
+                             reverse=True):
+        nodes = [n for d, n in tree.walk() if not n.isEmpty]
+        lines.append('<tr><td>%s</td><td><a href="threads/%s.html">%s</a></td><td>%d</td></tr>'
+                     % (_date(last), page_name(tree.parent.message_id),
+                        _subject(nodes[0]) if nodes else '(no subject)', len(nodes)))
+    lines.append('</table>')
+
+    return _page('Threads', '\n'.join(lines), top='')
+
+
+def _load_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+    except IOError:
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+
+    return manifest['trees']
+
+
+def build_archive(forest, path, workers=None, reader=None, force=False):
+    """
+    Render forest as a static HTML archive in the directory path
+
+    Only the trees which changed since the last build into path are
+    rendered, all of them with force.  workers processes render them,
+    defaulting to the number of CPUs; with one the work is done here,
+    reading message bodies out of reader, an MboxReader, if given.
+    Returns a BuildReport of the number of trees rendered, left as they
+    were and removed, and of the month listings written.
+    """
+    for sub in ('threads', 'messages', 'months'):
+        if not os.path.isdir(os.path.join(path, sub)):
+            os.makedirs(os.path.join(path, sub))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    old = {} if force else _load_manifest(path)
+    trees = {}
+    changed = []
+    months = set()
+    for root, tree in forest.roots.iteritems():
+        name = page_name(root)
+        digest = tree_hash(tree)
+        tree_months = sorted(set(_month(n.date) for n in tree.nodes.itervalues()
+                                 if not n.isEmpty and n.date is not None))
+        trees[name] = {'hash': digest, 'months': tree_months}
+
+        previous = old.get(name)
+        if previous is None or previous['hash'] != digest:
+            changed.append(tree)
+            months.update(tree_months)
+            if previous is not None:
+                months.update(previous['months'])
+
+    removed = [name for name in old if name not in trees]
+    for name in removed:
+        months.update(old[name]['months'])
+        thread = os.path.join(path, 'threads', name + '.html')
+        if os.path.exists(thread):
+            os.unlink(thread)
+
+    if workers <= 1 or len(changed) <= 1:
+        own_reader = reader is None
+        if own_reader:
+            reader = MboxReader()
+        try:
+            for tree in changed:
+                render_tree(tree, path, reader)
+        finally:
+            if own_reader:
+                reader.close()
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for done in pool.imap_unordered(_render_task, [(t, path) for t in changed],
+                                            chunksize=16):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    # Month listings hold messages of every tree, so they are built here
+    listings = dict((month, []) for month in months)
+    last = []
+    for tree in forest.roots.itervalues():
+        dates = []
+        for node in tree.nodes.itervalues():
+            if node.isEmpty or node.date is None:
+                continue
+            dates.append(node.date)
+            entries = listings.get(_month(node.date))
+            if entries is not None:
+                entries.append((tree, node))
+        last.append((max(dates) if dates else None, tree))
+
+    for month, nodes in listings.iteritems():
+        page = os.path.join(path, 'months', month + '.html')
+        if nodes:
+            _write(page, month_page(month, nodes))
+        elif os.path.exists(page):
+            os.unlink(page)
+
+    all_months = set(m for entry in trees.itervalues() for m in entry['months'])
+    _write(os.path.join(path, 'index.html'), index_page(last, all_months))
+
+    # The manifest goes last, an interrupted build starts over next time
+    _write(os.path.join(path, MANIFEST), json.dumps({'version': MANIFEST_VERSION,
+                                                      'trees': trees}))
+
+    return BuildReport(len(changed), len(trees) - len(changed), len(removed), len(months))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="usage: %prog [options] directory archive...")
+    parser.add_option('-j', '--workers', type='int',
+                      help="processes rendering pages [default: one per CPU]")
+    parser.add_option('--force', action='store_true',
+                      help="render every thread, changed or not")
+    values, args = parser.parse_args(argv[1:])
+    if len(args) < 2:
+        parser.error("a directory and an archive are needed")
+
+    from mailtree.sources import fill_sources
+    forest = fill_sources(args[1:], values.workers)
+    report = build_archive(forest, args[0], values.workers, force=values.force)
+    print "%d threads rendered, %d unchanged, %d removed, %d months listed" % report
+
+
+if __name__ == '__main__':
+    main(sys.argv)
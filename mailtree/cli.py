@@ -0,0 +1,327 @@
+"""The mailtree command: thread archives into JSON lines
+
+    mailtree [options] archive...
+
+Every archive is threaded into one MailForest and the threads are written
+to standard output as JSON lines, one per thread or, with --format
+message, one per message with its parent and depth.  Archives can be
+mboxes, compressed mboxes or Maildirs, see mailtree.sources.
+
+Without --window every thread is written once all the archives are read.
+With --window N a thread is written as soon as N messages went by without
+reaching it, so the output of a huge archive streams while it is read.
+A thread reached again after being written is written again, whole, and
+replaces what was written before; a written thread grafted into another
+one is followed by a {"root": ..., "merged_into": ...} line.
+
+With --incremental, the forest is loaded from the --snapshot file, only
+the messages appended to each mbox since the last run are threaded and
+only the threads they reached are written.  A single plain mbox threaded
+by several processes, with --workers, is written once it is all merged.
+
+The modules doing the work are only imported once the options have been
+parsed, so --help and option errors answer at once.
+"""
+import errno
+import json
+import optparse
+import os
+import sys
+
+from collections import OrderedDict
+
+FORMATS = ('thread', 'message')
+
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+
+    return s
+
+
+def thread_record(tree):
+    """Return the JSON record of tree"""
+    ids = []
+    dates = []
+    subject = None
+    for depth, node in tree.walk():
+        if node.isEmpty:
+            continue
+        ids.append(_text(node.message_id))
+        if subject is None:
+            subject = _text(node.subject)
+        if node.date is not None:
+            dates.append(node.date)
+
+    return {
+        'root': _text(tree.parent.message_id),
+        'subject': subject,
+        'authors': [_text(a) for a in tree.authors],
+        'first': min(dates) if dates else None,
+        'last': max(dates) if dates else None,
+        'messages': len(ids),
+        'message_ids': ids,
+    }
+
+
+def message_records(tree):
+    """
+    Yield the JSON record of every node of tree, parents first
+
+    Orphans, whose parent is unknown, come after the nodes the root
+    reaches, with no parent and a depth counted from them.
+    """
+    root = _text(tree.parent.message_id)
+    path = []
+    for depth, node in tree.walk():
+        del path[depth:]
+        message_id = _text(node.message_id)
+        yield {
+            'message_id': message_id,
+            'root': root,
+            'parent': path[-1] if path else None,
+            'depth': depth,
+            'empty': node.isEmpty,
+            'author': None if node.isEmpty else _text(node.author),
+            'subject': None if node.isEmpty else _text(node.subject),
+            'date': None if node.isEmpty else node.date,
+        }
+        path.append(message_id)
+
+
+class ThreadWriter(object):
+    """
+    Writes the trees of a MailForest as JSON lines once they settle
+
+    Add it to the listeners of the forest and thread the messages given
+    by feed.  A tree is written once window messages went by without
+    reaching it, or by flush.  Without a window only flush writes.
+    """
+    def __init__(self, forest, out, format='thread', window=None):
+        if format not in FORMATS:
+            raise ValueError("unknown format %r" % format)
+
+        self.forest = forest
+        self.out = out
+        self.format = format
+        self.window = window
+        self.pending = OrderedDict()    # root -> message count when last reached
+        self.written = set()
+        self.count = 0
+        self.lines = 0
+
+    def __call__(self, event, tree, other):
+        root = tree.parent.message_id
+
+        if event == 'grafted':
+            absorbed = other.parent.message_id
+            self.pending.pop(absorbed, None)
+            if absorbed in self.written:
+                self.written.discard(absorbed)
+                if self.format == 'thread':
+                    self._write({'root': _text(absorbed), 'merged_into': _text(root)})
+
+        # Keep pending ordered by the last time a tree was reached
+        self.pending.pop(root, None)
+        self.pending[root] = self.count
+
+    def feed(self, records):
+        """Yield records, writing the trees which settled in between"""
+        window = self.window
+        pending = self.pending
+
+        for record in records:
+            self.count += 1
+            yield record
+
+            if window is not None:
+                while pending:
+                    root, last = next(pending.iteritems())
+                    if last > self.count - window:
+                        break
+                    del pending[root]
+                    self.write_tree(root)
+
+    def flush(self):
+        """Write every tree reached since it was last written"""
+        while self.pending:
+            root, last = self.pending.popitem(last=False)
+            self.write_tree(root)
+
+    def write_tree(self, root):
+        tree = self.forest.roots[root]
+        self.written.add(root)
+
+        if self.format == 'thread':
+            self._write(thread_record(tree))
+        else:
+            for record in message_records(tree):
+                self._write(record)
+
+    def _write(self, record):
+        self.out.write(json.dumps(record, sort_keys=True) + '\n')
+        self.lines += 1
+
+
+def _parser():
+    parser = optparse.OptionParser(prog="mailtree",
+                                   usage="usage: %prog [options] archive...",
+                                   description="Thread email archives and write "
+                                   "the threads as JSON lines.")
+    parser.add_option('-f', '--format', choices=FORMATS, default='thread',
+                      help="write one line per thread or per message "
+                      "[default: %default]")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="write to FILE instead of standard output")
+    parser.add_option('-j', '--workers', type='int', default=1,
+                      help="threads reading the archives, or processes threading "
+                      "a single mbox; 0 for one per CPU [default: %default]")
+    parser.add_option('-w', '--window', type='int', metavar='N',
+                      help="write a thread once N messages went by without reaching it")
+    parser.add_option('-s', '--snapshot', metavar='FILE',
+                      help="save the forest to FILE, see mailtree.snapshot")
+    parser.add_option('-i', '--incremental', action='store_true',
+                      help="only thread what was appended to the mboxes since the "
+                      "snapshot was saved")
+    parser.add_option('--state', metavar='FILE',
+                      help="where --incremental keeps its progress "
+                      "[default: the snapshot path with .state appended]")
+    parser.add_option('--stats', metavar='FILE',
+                      help="append timings and counters to FILE as a JSON line")
+
+    return parser
+
+
+def _fill(forest, writer, paths, workers):
+    from mailtree import _plain_mbox
+    from mailtree.sources import read_sources
+
+    if len(paths) == 1 and workers != 1 and _plain_mbox(paths[0]):
+        from mailtree.parallel import parallel_fill
+        parallel_fill(paths[0], workers, forest)
+    else:
+        forest.fill_tree(writer.feed(read_sources(paths, workers)))
+
+
+def _load_states(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_states(states, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(states, f)
+    os.rename(path + '.tmp', path)
+
+
+def _fill_incremental(forest, writer, paths, states):
+    from mailtree.incremental import IngestState, update_mailtree
+
+    for path in paths:
+        state = states.get(path)
+        if state is not None:
+            state = IngestState(**state)
+
+        state, changes = update_mailtree(forest, path, state)
+        states[path] = state.__dict__
+        writer.flush()
+
+
+def run(options, paths, out):
+    from mailtree import MailForest
+    from mailtree.snapshot import save_forest, load_forest
+
+    workers = options.workers or None
+    forest = None
+    if options.incremental and os.path.exists(options.snapshot):
+        forest = load_forest(options.snapshot)
+    if forest is None:
+        forest = MailForest()
+
+    writer = ThreadWriter(forest, out, options.format, options.window)
+    forest.listeners.append(writer)
+
+    stats = None
+    if options.stats:
+        from mailtree.stats import Stats, JsonLinesSink
+        stats = Stats([JsonLinesSink(options.stats)])
+        stats.attach(forest)
+
+    if options.incremental:
+        state_path = options.state or options.snapshot + '.state'
+        states = _load_states(state_path)
+
+    try:
+        if options.incremental:
+            _fill_incremental(forest, writer, paths, states)
+        else:
+            _fill(forest, writer, paths, workers)
+            writer.flush()
+    finally:
+        if stats is not None:
+            stats.detach(forest)
+        forest.listeners.remove(writer)
+
+    # The snapshot goes first, a state ahead of it would lose messages
+    if options.snapshot:
+        save_forest(forest, options.snapshot)
+    if options.incremental:
+        _save_states(states, state_path)
+    if stats is not None:
+        stats.emit()
+
+    return forest
+
+
+def main(argv=None):
+    """Run the mailtree command, return its exit status"""
+    parser = _parser()
+    options, paths = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if not paths:
+        parser.error("no archive given")
+    if options.workers < 0:
+        parser.error("--workers can't be negative")
+    if options.window is not None and options.window < 1:
+        parser.error("--window must be at least 1")
+    if options.incremental and not options.snapshot:
+        parser.error("--incremental needs a --snapshot")
+
+    if options.incremental:
+        from mailtree import _plain_mbox
+        for path in paths:
+            if not _plain_mbox(path):
+                parser.error("--incremental only reads plain mboxes, not %s" % path)
+
+    out = sys.stdout
+    if options.output:
+        out = open(options.output, 'w')
+
+    try:
+        run(options, paths, out)
+        out.flush()
+
+    except IOError as e:
+        if e.errno == errno.EPIPE:
+            # Whoever reads the output has seen enough
+            return 0
+        sys.stderr.write("%s: %s\n" % (parser.get_prog_name(), e))
+        return 1
+
+    except (OSError, ValueError) as e:
+        sys.stderr.write("%s: %s\n" % (parser.get_prog_name(), e))
+        return 1
+
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""Flatten a MailForest into NumPy arrays for bulk analysis
+
+    columns = export_forest(forest)
+    columns.depth_histogram()
+    columns.thread_sizes()
+
+Every node of the forest becomes one row.  Rows are laid out tree by tree,
+each tree in depth-first order from its root and then from each of its
+orphans, so the rows below a node are the ones right after it:
+
+    message_ids     list of the message id of every row
+    parent          row of the parent, -1 for roots and orphans
+    root            row of the root of the tree
+    depth           depth below the root, or below the orphan
+    date            UTC timestamp, NaN when unknown
+    author          code of the author in authors, -1 for placeholders
+    empty           True for placeholders of messages never seen
+
+authors lists the authors by code, keyed with indexes.author_key.  The
+aggregates are computed on the arrays with NumPy, without going back to
+the nodes.  NumPy is an optional dependency, install mailtree[numpy].
+"""
+import array
+
+from mailtree.indexes import author_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ForestColumns(object):
+    """The columns of a forest, see export_forest"""
+    def __init__(self, message_ids, parent, root, depth, date, author, empty, authors):
+        self.message_ids = message_ids
+        self.parent = parent
+        self.root = root
+        self.depth = depth
+        self.date = date
+        self.author = author
+        self.empty = empty
+        self.authors = authors
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def roots(self):
+        """Return the rows of the roots of the trees"""
+        return numpy.flatnonzero(self.root == numpy.arange(len(self)))
+
+    def subtree_sizes(self):
+        """Return the number of messages in the subtree of every row, itself included"""
+        sizes = (~self.empty).astype(numpy.int64)
+        rows = numpy.flatnonzero(self.parent >= 0)
+        if not len(rows):
+            return sizes
+
+        # Rows with a parent grouped by depth, found with one sort, then
+        # children pass their count up one level at a time, deepest first
+        depth = self.depth[rows]
+        rows = rows[numpy.argsort(depth, kind='mergesort')]
+        ends = numpy.cumsum(numpy.bincount(depth))
+        for level in xrange(len(ends) - 1, 0, -1):
+            level_rows = rows[ends[level - 1]:ends[level]]
+            numpy.add.at(sizes, self.parent[level_rows], sizes[level_rows])
+
+        return sizes
+
+    def thread_sizes(self):
+        """Return the number of messages of every tree, in the order of roots()"""
+        counts = numpy.bincount(self.root, weights=~self.empty, minlength=len(self))
+        return counts[self.roots()].astype(numpy.int64)
+
+    def thread_depths(self):
+        """Return the depth of the deepest message of every tree, in the order of roots()"""
+        depths = numpy.zeros(len(self), dtype=numpy.int64)
+        rows = numpy.flatnonzero(~self.empty)
+        numpy.maximum.at(depths, self.root[rows], self.depth[rows])
+
+        return depths[self.roots()]
+
+    def depth_histogram(self):
+        """Return the number of messages at every depth"""
+        return numpy.bincount(self.depth[~self.empty])
+
+    def time_to_first_reply(self):
+        """
+        Return the seconds between every row and its earliest direct reply
+
+        NaN for rows without a dated reply, or without a date.
+        """
+        first = numpy.full(len(self), numpy.inf)
+        rows = numpy.flatnonzero((self.parent >= 0) & ~self.empty & ~numpy.isnan(self.date))
+        numpy.minimum.at(first, self.parent[rows], self.date[rows])
+
+        latency = first - self.date
+        latency[numpy.isinf(first)] = numpy.nan
+
+        return latency
+
+    def replies_by_author(self):
+        """Return the number of replies each author wrote, by author code"""
+        replies = (self.parent >= 0) & ~self.empty
+        return numpy.bincount(self.author[replies], minlength=len(self.authors))
+
+    def messages_by_author(self):
+        """Return the number of messages each author wrote, by author code"""
+        return numpy.bincount(self.author[~self.empty], minlength=len(self.authors))
+
+    def __repr__(self):
+        return "<ForestColumns: %d rows, %d authors>" % (len(self), len(self.authors))
+
+
+def _column(values, dtype):
+    if not len(values):
+        return numpy.zeros(0, dtype=dtype)
+
+    return numpy.frombuffer(values, dtype=dtype).copy()
+
+
+def export_forest(forest):
+    """
+    Return the ForestColumns of forest
+
+    forest is a MailForest, or anything with a roots mapping of MailTrees
+    such as an SQLiteForest.  Trees come in the order of their root
+    message ids.
+    """
+    if numpy is None:
+        raise ValueError("exporting columns needs numpy, install mailtree[numpy]")
+
+    message_ids = []
+    parent = array.array('i')
+    root = array.array('i')
+    depth = array.array('i')
+    date = array.array('d')
+    author = array.array('i')
+    empty = array.array('b')
+    authors = []
+    codes = {}
+    seen = {}
+
+    nan = float('nan')
+    for key in sorted(forest.roots):
+        tree = forest.roots[key]
+        top = len(message_ids)
+        path = []
+        for level, node in tree.walk():
+            del path[level:]
+            row = len(message_ids)
+
+            message_ids.append(node.message_id)
+            parent.append(path[-1] if path else -1)
+            root.append(top)
+            depth.append(level)
+            empty.append(node.isEmpty)
+            if node.isEmpty:
+                date.append(nan)
+                author.append(-1)
+            else:
+                when = node.date
+                date.append(nan if when is None else when)
+                code = seen.get(node.author)
+                if code is None:
+                    # The same From header keeps coming back, parse it once
+                    name = author_key(node.author)
+                    code = codes.get(name)
+                    if code is None:
+                        code = codes[name] = len(authors)
+                        authors.append(name)
+                    seen[node.author] = code
+                author.append(code)
+
+            path.append(row)
+
+    return ForestColumns(message_ids, _column(parent, numpy.intc), _column(root, numpy.intc),
+                         _column(depth, numpy.intc), _column(date, numpy.float64),
+                         _column(author, numpy.intc), _column(empty, numpy.int8).astype(bool),
+                         authors)
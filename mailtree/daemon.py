@@ -0,0 +1,388 @@
+"""Thread messages into a MailForest as they are delivered
+
+IngestService keeps a MailForest in memory and feeds it messages received
+over SMTP or LMTP, or dropped as files into spool directories.  Messages
+are queued and threaded in batches: a batch is threaded as soon as it is
+full, or at most max_delay seconds after its first message arrived, so
+latency stays bounded under load while a busy server threads many
+messages at a time.  After every batch the subscribers are given the
+ChangeSet of the trees that were created, grafted or replied to.
+
+Everything runs in one thread on an asyncore loop with a map of its own:
+
+    service = IngestService()
+    service.listen(('127.0.0.1', 2525))
+    service.listen('/var/run/mailtree.sock', lmtp=True)
+    service.watch('/var/spool/mailtree')
+    service.subscribers.append(publish)
+    service.serve_forever()
+"""
+import asynchat
+import asyncore
+import email
+import errno
+import functools
+import os
+import socket
+import stat
+import time
+
+from mailtree import MailForest, message_ids
+from mailtree.incremental import ChangeSet
+from mailtree.scanner import parse_headers, header_end, MessageHeaders
+
+
+def parse_message(data):
+    """Return a MessageHeaders record for the raw message data"""
+    if data.startswith('From '):
+        # An mbox "From " line
+        data = data[data.find('\n') + 1:]
+
+    end = header_end(data)
+    if data.startswith('\n') or data.startswith('\r\n'):
+        end = 0
+
+    return MessageHeaders(parse_headers(data[:end]), 0, len(data))
+
+
+class IngestChannel(asynchat.async_chat):
+    """One SMTP or LMTP session
+
+    Only what a local delivery agent needs is implemented: HELO, EHLO or
+    LHLO, MAIL, RCPT, DATA, RSET, NOOP and QUIT, with pipelining.  An LMTP
+    client gets one reply per recipient once the message is queued.
+    """
+    def __init__(self, service, sock, lmtp=False, map=None):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.service = service
+        self.lmtp = lmtp
+        self.incoming = []
+        self.in_data = False
+        self.lines = []
+        self.reset()
+
+        self.set_terminator('\r\n')
+        self.reply('220 %s %s mailtree ready' % (socket.gethostname(),
+                                                 'LMTP' if lmtp else 'ESMTP'))
+
+    def reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+
+    def reply(self, line):
+        self.push(line + '\r\n')
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming)
+        self.incoming = []
+
+        if self.in_data:
+            if line == '.':
+                self.in_data = False
+                lines, self.lines = self.lines, []
+                self.end_data(lines)
+            else:
+                # Undo the dot-stuffing
+                self.lines.append(line[1:] if line.startswith('.') else line)
+            return
+
+        command, sep, arg = line.partition(' ')
+        method = getattr(self, 'smtp_' + command.upper(), None)
+        if method is None:
+            self.reply('500 5.5.1 Command not recognized')
+        else:
+            method(arg.strip())
+
+    def end_data(self, lines):
+        self.service.submit('\n'.join(lines) + '\n')
+        for rcpt in (self.rcpttos if self.lmtp else [None]):
+            self.reply('250 2.0.0 Ok: queued')
+        self.reset()
+
+    def smtp_HELO(self, arg):
+        if self.lmtp:
+            self.reply('500 5.5.1 Use LHLO')
+            return
+
+        self.reset()
+        self.reply('250 %s' % socket.gethostname())
+
+    def smtp_EHLO(self, arg):
+        if self.lmtp:
+            self.reply('500 5.5.1 Use LHLO')
+            return
+
+        self.reset()
+        self.push('250-%s\r\n250-PIPELINING\r\n250 8BITMIME\r\n' % socket.gethostname())
+
+    def smtp_LHLO(self, arg):
+        if not self.lmtp:
+            self.reply('500 5.5.1 Command not recognized')
+            return
+
+        self.reset()
+        self.push('250-%s\r\n250-PIPELINING\r\n250 8BITMIME\r\n' % socket.gethostname())
+
+    def smtp_MAIL(self, arg):
+        if not arg.upper().startswith('FROM:'):
+            self.reply('501 5.5.4 Syntax: MAIL FROM:<address>')
+            return
+
+        self.reset()
+        self.mailfrom = arg[5:].strip()
+        self.reply('250 2.1.0 Ok')
+
+    def smtp_RCPT(self, arg):
+        if self.mailfrom is None:
+            self.reply('503 5.5.1 Need MAIL first')
+        elif not arg.upper().startswith('TO:'):
+            self.reply('501 5.5.4 Syntax: RCPT TO:<address>')
+        else:
+            self.rcpttos.append(arg[3:].strip())
+            self.reply('250 2.1.5 Ok')
+
+    def smtp_DATA(self, arg):
+        if not self.rcpttos:
+            self.reply('503 5.5.1 Need RCPT first')
+            return
+
+        # Read line by line, a message with no lines ends on the first one
+        self.in_data = True
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+    def smtp_RSET(self, arg):
+        self.reset()
+        self.reply('250 2.0.0 Ok')
+
+    def smtp_NOOP(self, arg):
+        self.reply('250 2.0.0 Ok')
+
+    def smtp_QUIT(self, arg):
+        self.reply('221 2.0.0 Bye')
+        self.close_when_done()
+
+    def handle_error(self):
+        self.service.errors += 1
+        self.close()
+
+
+class IngestServer(asyncore.dispatcher):
+    """Accepts SMTP or LMTP sessions on a TCP or a Unix socket
+
+    address is a (host, port) pair, or the path of a Unix socket; a stale
+    socket left at that path is replaced.  Port 0 picks a free port, the
+    one in use is in address once listening.
+    """
+    def __init__(self, service, address, lmtp=False):
+        asyncore.dispatcher.__init__(self, map=service.map)
+        self.service = service
+        self.lmtp = lmtp
+
+        if isinstance(address, basestring):
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+
+        self.bind(address)
+        self.listen(128)
+        self.address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            IngestChannel(self.service, pair[0], self.lmtp, self.service.map)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class SpoolWatcher(object):
+    """Picks up message files dropped into a directory
+
+    Files are read in name order and deleted once the batch they were
+    queued in is threaded, so a crash before then leaves them to be read
+    again; names starting with a dot are left alone, so writers can create
+    a dot file and rename it once it is complete.  Files in new/ are taken
+    too, so a Maildir can be used as the spool.
+    """
+    def __init__(self, service, path, interval=1.0):
+        self.service = service
+        self.path = path
+        self.interval = interval
+        self.due = 0
+        self.queued = set()
+
+    def scan(self):
+        self.due = time.time() + self.interval
+        count = 0
+
+        for folder in (self.path, os.path.join(self.path, 'new')):
+            if not os.path.isdir(folder):
+                continue
+
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if name.startswith('.') or path in self.queued or not os.path.isfile(path):
+                    continue
+
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+                self.queued.add(path)
+                self.service.submit(data, functools.partial(self.threaded, path))
+                count += 1
+
+        return count
+
+    def threaded(self, path):
+        """Delete the file at path, its message is in the forest"""
+        self.queued.discard(path)
+        os.unlink(path)
+
+
+class IngestService(object):
+    """
+    A long-lived MailForest fed by SMTP and LMTP listeners and spools
+
+    Messages are threaded in batches of at most batch_size, the first
+    message of a batch waiting at most max_delay seconds.  Callables in
+    subscribers are called with the ChangeSet of every batch which changed
+    the forest.  received and errors count the messages queued and the
+    sessions which failed.
+    """
+    def __init__(self, forest=None, batch_size=500, max_delay=0.05):
+        if forest is None:
+            forest = MailForest()
+
+        self.forest = forest
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.subscribers = []
+        self.map = {}
+        self.spools = []
+        self.queue = []
+        self.done = []
+        self.first = None
+        self.received = 0
+        self.errors = 0
+        self.running = False
+
+    def listen(self, address, lmtp=False):
+        """Accept SMTP, or LMTP, sessions at address, see IngestServer"""
+        return IngestServer(self, address, lmtp)
+
+    def watch(self, path, interval=1.0):
+        """Pick up the message files dropped into path every interval seconds"""
+        spool = SpoolWatcher(self, path, interval)
+        self.spools.append(spool)
+        return spool
+
+    def submit(self, data, done=None):
+        """
+        Queue the raw message data for threading
+
+        done, if given, is called without arguments once the batch of the
+        message is threaded.  A message without a Message-Id is kept whole,
+        so the id synthesised for it when threading covers its body too.
+        """
+        record = parse_message(data)
+        if message_ids(record).message_id is None:
+            record = email.message_from_string(data)
+
+        if not self.queue:
+            self.first = time.time()
+        self.queue.append(record)
+        if done is not None:
+            self.done.append(done)
+        self.received += 1
+
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Thread every queued message, return the ChangeSet"""
+        batch, self.queue = self.queue, []
+        done, self.done = self.done, []
+        self.first = None
+
+        changes = ChangeSet()
+        self.forest.listeners.append(changes)
+        try:
+            self.forest.fill_tree(batch)
+        except:
+            # Put the batch back for the next flush, what was threaded
+            # already is skipped as a duplicate then
+            self.queue[:0] = batch
+            self.done[:0] = done
+            self.first = time.time()
+            raise
+        finally:
+            self.forest.listeners.remove(changes)
+
+        for callback in done:
+            callback()
+
+        if len(changes):
+            for subscriber in self.subscribers:
+                subscriber(changes)
+
+        return changes
+
+    def _timeout(self, now):
+        due = [spool.due for spool in self.spools]
+        if self.first is not None:
+            due.append(self.first + self.max_delay)
+
+        return max(min(due + [now + 1.0]) - now, 0)
+
+    def poll(self, timeout=None):
+        """Handle whatever is ready, waiting at most timeout seconds"""
+        now = time.time()
+        wait = self._timeout(now)
+        if timeout is not None:
+            wait = min(wait, timeout)
+
+        if self.map:
+            asyncore.loop(wait, map=self.map, count=1)
+        elif wait:
+            time.sleep(wait)
+
+        now = time.time()
+        for spool in self.spools:
+            if spool.due <= now:
+                spool.scan()
+
+        if self.first is not None and self.first + self.max_delay <= time.time():
+            self.flush()
+
+    def serve_forever(self):
+        """Poll until stop is called"""
+        self.running = True
+        try:
+            while self.running:
+                self.poll()
+        finally:
+            if self.queue:
+                self.flush()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """Close every listener and session, threading anything queued"""
+        for channel in self.map.values():
+            channel.close()
+        if self.queue:
+            self.flush()
@@ -0,0 +1,106 @@
+import collections
+import hashlib
+
+from email.message import Message
+
+from mailtree import message_ids
+from mailtree.scanner import read_message, header_end
+
+# Headers hashed, with the body, to make up an id for mail without one
+CONTENT_HEADERS = ('From', 'Date', 'Subject', 'To', 'References', 'In-Reply-To')
+SYNTHETIC_DOMAIN = 'mailtree.invalid'
+
+
+def _readable(message):
+    # Records of compressed mboxes and Maildirs can't be read back
+    return isinstance(message, Message) or getattr(message, 'source', None) is not None
+
+
+def _body(message):
+    if not _readable(message):
+        return ''
+
+    if isinstance(message, Message):
+        text = message.as_string()
+    else:
+        text = read_message(message.source, message.offset, message.length)
+
+    # Trailing blank lines depend on where in the mbox a message was
+    return text[header_end(text):].rstrip()
+
+
+def synthesise_id(message):
+    """
+    Return a Message-Id for a message which has none
+
+    The id is a digest of a few headers and of the body, so the same
+    message always gets the same id, and copies of it are recognised.
+    """
+    digest = hashlib.sha1()
+    for name in CONTENT_HEADERS:
+        digest.update('%s: %s\n' % (name, message.get(name) or ''))
+    digest.update(hashlib.sha1(_body(message)).digest())
+
+    return '%s@%s' % (digest.hexdigest(), SYNTHETIC_DOMAIN)
+
+
+class Deduplicator(object):
+    """
+    Filters the messages about to be threaded into a MailForest
+
+    A message whose Message-Id was already threaded, a re-delivery or the
+    copy of a cross-post received through another list, is skipped.
+    Messages without a usable Message-Id get one from synthesise_id.
+    Records whose body can't be read back are never taken for copies, as
+    their ids only hash the headers: the n-th with the same id has .n
+    added to it.  messages counts the messages seen, duplicates the ones skipped and
+    synthesised the ones given an id; copies holds the number of skipped
+    copies by message id.
+    """
+    def __init__(self, forest):
+        self.forest = forest
+        self.messages = 0
+        self.duplicates = 0
+        self.synthesised = 0
+        self.copies = collections.Counter()
+        self.unread = collections.Counter()
+
+    def is_duplicate(self, message_id):
+        forest = self.forest
+        if message_id not in forest.keys:
+            return False
+
+        try:
+            node = forest.node(message_id)
+        except KeyError:
+            return False
+
+        return not node.isEmpty
+
+    def filter(self, box):
+        """Yield (message, MessageIds) for the messages of box to thread"""
+        for m in box:
+            self.messages += 1
+            ids = message_ids(m)
+
+            if ids.message_id is None:
+                message_id = synthesise_id(m)
+                if not _readable(m):
+                    self.unread[message_id] += 1
+                    count = self.unread[message_id]
+                    if count > 1:
+                        message_id = message_id.replace('@', '.%d@' % count, 1)
+
+                ids = ids._replace(message_id=message_id)
+                self.synthesised += 1
+
+            if self.is_duplicate(ids.message_id):
+                self.duplicates += 1
+                self.copies[ids.message_id] += 1
+                continue
+
+            yield m, ids
+
+    def __repr__(self):
+        return "<Deduplicator: %d messages, %d duplicates, %d synthesised>" % (
+            self.messages, self.duplicates, self.synthesised)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+
+from mailtree.scanner import scan_mbox
+
+FINGERPRINT_SIZE = 4096
+
+
+class ArchiveChanged(ValueError):
+    """The mbox was rewritten since the IngestState was recorded"""
+
+
+class IngestState(object):
+    """How far into an mbox a MailForest has been filled
+
+    offset and length locate the last message that was ingested, and
+    fingerprint is a hash of its first bytes so that a rewritten mbox can
+    be told apart from one that was only appended to.
+    """
+    def __init__(self, path, offset=0, length=0, fingerprint=None, messages=0):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.fingerprint = fingerprint
+        self.messages = messages
+
+    def check(self, f):
+        """Raise ArchiveChanged unless the last message is still in f"""
+        if self.fingerprint is None:
+            return
+
+        if os.fstat(f.fileno()).st_size < self.offset + self.length:
+            raise ArchiveChanged("%s is shorter than when it was last read" % self.path)
+
+        if fingerprint(f, self.offset, self.length) != self.fingerprint:
+            raise ArchiveChanged("%s was rewritten since it was last read" % self.path)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.__dict__, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def __repr__(self):
+        return "<IngestState: %s@%d>" % (self.path, self.offset)
+
+
+class ChangeSet(object):
+    """
+    Collects the roots of the trees touched while filling a MailForest
+
+    created holds the roots of new trees, grafted the roots of trees that
+    existed before and were grafted into another one, and changed the roots
+    of existing trees that received new messages.  Add it to
+    MailForest.listeners while filling the forest.
+    """
+    def __init__(self):
+        self.created = set()
+        self.grafted = set()
+        self.changed = set()
+
+    def __call__(self, event, tree, other):
+        root = tree.parent.message_id
+
+        if event == 'created':
+            self.created.add(root)
+        elif event == 'grafted':
+            absorbed = other.parent.message_id
+            if absorbed in self.created:
+                self.created.discard(absorbed)
+            else:
+                self.grafted.add(absorbed)
+                self.changed.discard(absorbed)
+
+        if root not in self.created:
+            self.changed.add(root)
+
+    def __len__(self):
+        return len(self.created) + len(self.grafted) + len(self.changed)
+
+    def __repr__(self):
+        return "<ChangeSet: %d created, %d grafted, %d changed>" % (
+            len(self.created), len(self.grafted), len(self.changed))
+
+
+def fingerprint(f, offset, length):
+    f.seek(offset)
+    return hashlib.sha1(f.read(min(length, FINGERPRINT_SIZE))).hexdigest()
+
+
+def update_mailtree(forest, path, state=None):
+    """
+    Thread the messages appended to the mbox at path since state into forest
+
+    Without a state the whole mbox is read.  Returns the IngestState to
+    pass to the next call and a ChangeSet of the trees that were touched.
+    Raises ArchiveChanged if the mbox was not only appended to.
+    """
+    if state is None:
+        state = IngestState(path)
+
+    with open(path, 'rb') as f:
+        state.check(f)
+
+    changes = ChangeSet()
+    scanned = [0, None]     # records scanned and the last one
+
+    def appended():
+        for record in scan_mbox(path, start=state.offset):
+            scanned[0] += 1
+            scanned[1] = record
+            if scanned[0] == 1 and state.fingerprint is not None:
+                # The scan restarts at the last message that was ingested
+                continue
+
+            yield record
+
+    forest.listeners.append(changes)
+    try:
+        forest.fill_tree(appended())
+    finally:
+        forest.listeners.remove(changes)
+
+    added = scanned[0] - (state.fingerprint is not None)
+    if added <= 0:
+        return state, changes
+
+    last = scanned[1]
+    with open(path, 'rb') as f:
+        new_state = IngestState(path, last.offset, last.length,
+                                fingerprint(f, last.offset, last.length),
+                                state.messages + added)
+
+    return new_state, changes
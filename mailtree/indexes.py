@@ -0,0 +1,137 @@
+import bisect
+
+from email.utils import parseaddr
+
+
+def author_key(author):
+    """Return the lower-cased address of a From header, or the header itself"""
+    address = parseaddr(author)[1]
+    if '@' not in address:
+        return author.strip().lower()
+
+    return address.lower()
+
+
+class ForestIndex(object):
+    """
+    Secondary indexes of the trees of a MailForest
+
+    authors maps the address of every author to the set of the roots of the
+    trees they wrote in, and activity holds the (first, last) date of the
+    messages of each tree by its root.  dates is the list of (last date,
+    root) pairs of every tree, sorted, so that recently active threads are
+    found with a bisection.  Trees without any dated message are left out
+    of it.
+
+    Creating one indexes the trees already in the forest and adds it to
+    the listeners of the forest, which keeps it up to date as messages are
+    threaded and trees are grafted.
+    """
+    def __init__(self, forest):
+        self.forest = forest
+        self.authors = {}
+        self.activity = {}
+        self.dates = []
+
+        for root, tree in forest.roots.iteritems():
+            self._add_tree(root, tree)
+
+        forest.listeners.append(self)
+
+    def close(self):
+        """Stop following changes to the forest"""
+        self.forest.listeners.remove(self)
+
+    def __call__(self, event, tree, other):
+        root = tree.parent.message_id
+
+        if event == 'added' and other is not None:
+            self._add_node(root, other)
+
+        elif event in ('created', 'added'):
+            # A new tree, or a whole tree merged in from another forest
+            self._add_tree(root, tree)
+
+        elif event == 'grafted':
+            absorbed = other.parent.message_id
+            for author in other.authors:
+                roots = self.authors.get(author_key(author))
+                if roots is not None:
+                    roots.discard(absorbed)
+                    roots.add(root)
+
+            span = self._forget(absorbed)
+            if span is not None:
+                self._extend(root, *span)
+
+    def _add_tree(self, root, tree):
+        for author in tree.authors:
+            self.authors.setdefault(author_key(author), set()).add(root)
+
+        dates = [n.date for n in tree.nodes.itervalues() if not n.isEmpty]
+        dates = [d for d in dates if d is not None]
+        if dates:
+            self._extend(root, min(dates), max(dates))
+
+    def _add_node(self, root, node):
+        self.authors.setdefault(author_key(node.author), set()).add(root)
+
+        date = node.date
+        if date is not None:
+            self._extend(root, date, date)
+
+    def _forget(self, root):
+        span = self.activity.pop(root, None)
+        if span is not None:
+            del self.dates[bisect.bisect_left(self.dates, (span[1], root))]
+
+        return span
+
+    def _extend(self, root, first, last):
+        span = self.activity.get(root)
+        if span is not None:
+            if span[0] <= first and last <= span[1]:
+                return
+            self._forget(root)
+            first, last = min(first, span[0]), max(last, span[1])
+
+        self.activity[root] = (first, last)
+        # Most messages go to recent threads, so this inserts near the end
+        bisect.insort(self.dates, (last, root))
+
+    def threads_by_author(self, author):
+        """
+        Return the trees author wrote in, most recently active first
+
+        author is a From header or just an address, compared without case.
+        """
+        roots = self.authors.get(author_key(author), ())
+        last = self.activity.get
+
+        return [self.forest.roots[root] for root in
+                sorted(roots, key=lambda r: (last(r, (None, None))[1], r), reverse=True)]
+
+    def threads_between(self, start, end):
+        """
+        Return the trees with messages dated within [start, end), most
+        recently active first
+
+        start and end are UTC timestamps.  A tree counts as active over the
+        whole span between its first and last message.
+        """
+        idx = bisect.bisect_left(self.dates, (start,))
+        ret = []
+        for last, root in reversed(self.dates[idx:]):
+            if self.activity[root][0] < end:
+                ret.append(self.forest.roots[root])
+
+        return ret
+
+    def latest(self, count):
+        """Return the count most recently active trees, newest first"""
+        return [self.forest.roots[root] for last, root in
+                reversed(self.dates[max(len(self.dates) - count, 0):])]
+
+    def __repr__(self):
+        return "<ForestIndex: %d authors, %d dated trees>" % (
+            len(self.authors), len(self.dates))
@@ -0,0 +1,75 @@
+import itertools
+import mmap
+import multiprocessing
+
+from mailtree import MailForest
+from mailtree.scanner import scan_mbox, first_message
+
+
+def split_mbox(path, parts):
+    """
+    Return a list of at most parts (start, end) byte ranges covering the
+    mbox at path
+
+    Every range starts on a "From " line, so each one can be scanned on its
+    own.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return []
+
+        try:
+            size = len(data)
+            starts = []
+            for n in xrange(parts):
+                start = first_message(data, size * n // parts)
+                if start < size and (not starts or start > starts[-1]):
+                    starts.append(start)
+        finally:
+            data.close()
+
+    return zip(starts, starts[1:] + [size])
+
+
+def fill_range(args):
+    """Thread the messages of one byte range of an mbox into a new MailForest"""
+    path, start, end = args
+
+    # A range has fewer messages than bytes, so numbering the nodes from
+    # the start offset keeps arrival order across the merged forests
+    forest = MailForest(arrival=itertools.count(start))
+    forest.fill_tree(scan_mbox(path, start, end))
+
+    return forest
+
+
+def parallel_fill(path, workers=None, forest=None):
+    """
+    Thread the mbox at path with a pool of worker processes
+
+    The mbox is split into one byte range per worker, each worker threads
+    its range into a partial MailForest and the partial forests are merged
+    in file order, into forest if one is given.  workers defaults to the
+    number of CPUs.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if forest is None:
+        forest = MailForest()
+
+    ranges = split_mbox(path, workers)
+    if len(ranges) <= 1:
+        forest.fill_tree(scan_mbox(path))
+        return forest
+
+    pool = multiprocessing.Pool(min(workers, len(ranges)))
+    try:
+        for part in pool.imap(fill_range, [(path, s, e) for s, e in ranges]):
+            forest.merge(part)
+    finally:
+        pool.close()
+        pool.join()
+
+    return forest
@@ -0,0 +1,249 @@
+import mmap
+import re
+
+THREADING_HEADERS = frozenset(['from', 'subject', 'date', 'message-id',
+                               'references', 'in-reply-to'])
+
+_header_re = re.compile(r'[\041-\071\073-\176]+:')
+
+
+class MessageHeaders(object):
+    """The header block of a single message in an mbox file
+
+    Behaves enough like an email.message.Message for MailForest.fill_tree,
+    while only keeping the headers that are needed for threading.  source
+    is the path of the mbox the message was found in.
+    """
+    __slots__ = ('headers', 'offset', 'length', 'source')
+
+    def __init__(self, headers, offset, length, source=None):
+        self.headers = headers
+        self.offset = offset
+        self.length = length
+        self.source = source
+
+    def get(self, name, failobj=None):
+        return self.headers.get(name.lower(), failobj)
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower())
+
+    def __contains__(self, name):
+        return name.lower() in self.headers
+
+    def __repr__(self):
+        return "<MessageHeaders: %s@%d>" % (self.get('Message-Id'), self.offset)
+
+
+def parse_headers(block, wanted=THREADING_HEADERS):
+    """
+    Return a dict of lower-cased header names to values, given the raw
+    header block of a message
+
+    Only the first occurrence of a header is kept, like Message.get does.
+    Folded values keep their line breaks.
+    """
+    headers = {}
+    name = None
+    value = None
+
+    for line in block.split('\n'):
+        if line.endswith('\r'):
+            line = line[:-1]
+
+        if line[:1] in (' ', '\t'):
+            if value is not None:
+                value.append(line)
+            continue
+
+        if name is not None:
+            headers[name] = '\n'.join(value)
+            name = value = None
+
+        if not _header_re.match(line):
+            break
+
+        idx = line.find(':')
+        key = line[:idx].lower()
+        if key in headers or (wanted is not None and key not in wanted):
+            continue
+
+        name = key
+        value = [line[idx + 1:].lstrip()]
+
+    if name is not None:
+        headers[name] = '\n'.join(value)
+
+    return headers
+
+
+def header_end(data, start=0, end=None):
+    """
+    Return the offset of the end of the header block starting at start,
+    just past the blank line ending it, or end if there is none
+    """
+    if end is None:
+        end = len(data)
+
+    idx = data.find('\n\n', start, end)
+    crlf = data.find('\n\r\n', start, end)
+    if crlf != -1 and (idx == -1 or crlf < idx):
+        idx = crlf
+    if idx == -1:
+        return end
+
+    return idx + 1
+
+
+def iter_messages(data, start=0, end=None):
+    """
+    Yield (offset, length, header block) for each message found in an mbox
+    buffer between start and end
+
+    start must point at a "From " line.  Message boundaries are found the
+    same way mailbox.mbox does, by looking for lines starting with "From ".
+    """
+    if end is None:
+        end = len(data)
+
+    pos = start
+    while pos < end:
+        nxt = data.find('\nFrom ', pos, end)
+        stop = end if nxt == -1 else nxt
+
+        hstart = data.find('\n', pos, stop)
+        if hstart == -1:
+            hstart = stop
+        else:
+            hstart += 1
+
+        hend = header_end(data, hstart, stop)
+        length = stop - pos
+        if nxt == -1 and stop < len(data):
+            # end is the start of the next message, drop the separating newline
+            length -= 1
+
+        yield pos, length, data[hstart:hend]
+
+        if nxt == -1:
+            break
+        pos = nxt + 1
+
+
+def first_message(data, start=0, end=None):
+    """Return the offset of the first "From " line at or after start"""
+    if end is None:
+        end = len(data)
+
+    if data[start:start + 5] == 'From ' and (start == 0 or data[start - 1] == '\n'):
+        return start
+
+    idx = data.find('\nFrom ', start, end)
+    if idx == -1:
+        return end
+
+    return idx + 1
+
+
+def scan_mbox(path, start=0, end=None, headers=THREADING_HEADERS):
+    """
+    Yield a MessageHeaders record for every message in the mbox at path
+
+    The file is memory-mapped and only the header block of each message is
+    parsed, bodies are never read into memory.  start and end restrict the
+    scan to a byte range; start is moved forward to the next "From " line.
+    Pass headers=None to keep every header instead of just the ones needed
+    for threading.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return
+
+        try:
+            if end is None or end > len(data):
+                end = len(data)
+
+            start = first_message(data, start, end)
+            for offset, length, block in iter_messages(data, start, end):
+                yield MessageHeaders(parse_headers(block, headers), offset, length, path)
+        finally:
+            data.close()
+
+
+def read_message(path, offset, length):
+    """Return the raw text of the message at offset in the mbox at path"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    _check_message(path, offset, data)
+    return data
+
+
+def _check_message(path, offset, data):
+    if data[:5] != 'From ':
+        raise ValueError("%s has no message at offset %d" % (path, offset))
+
+
+class MboxReader(object):
+    """
+    Reads single messages out of mbox files, keeping the files mapped
+
+    Use one of these when fetching many messages: each lookup is a slice of
+    the mapping instead of an open and a seek.  view returns a buffer onto
+    the mapping, which doesn't copy the message at all but is only valid
+    until the reader is closed.
+    """
+    def __init__(self):
+        self._files = {}
+
+    def _map(self, path):
+        try:
+            return self._files[path][1]
+        except KeyError:
+            pass
+
+        f = open(path, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            f.close()
+            raise
+
+        self._files[path] = (f, data)
+        return data
+
+    def view(self, path, offset, length):
+        data = self._map(path)
+        if offset + length > len(data):
+            # The file grew since it was mapped
+            self.forget(path)
+            data = self._map(path)
+
+        ret = buffer(data, offset, length)
+        _check_message(path, offset, ret[:5])
+
+        return ret
+
+    def read(self, path, offset, length):
+        return str(self.view(path, offset, length))
+
+    def forget(self, path):
+        """Unmap path, it gets mapped again on the next lookup"""
+        f, data = self._files.pop(path, (None, None))
+        if f is not None:
+            data.close()
+            f.close()
+
+    def close(self):
+        for path in self._files.keys():
+            self.forget(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,246 @@
+"""Thread archives on several nodes, then join the threads which span them
+
+Every shard threads its own archives into a partial forest, saved as a
+snapshot with a summary next to it.  A coordinator which can read the
+files of the shards then joins them:
+
+    python -m mailtree.shard thread -n 0 shard0.snapshot lists/a.mbox lists/b.mbox
+    python -m mailtree.shard thread -n 1 shard1.snapshot lists/c.mbox
+    python -m mailtree.shard merge joined.snapshot shard0.snapshot shard1.snapshot
+
+The summary lists, for every tree, the message ids through which it can
+meet a tree of another shard: its root, its orphans and its placeholders.
+A message threaded in two shards has the same parent in both, so going up
+from any message id two shards share ends on one of those in each shard.
+The coordinator looks the ids of every summary up in the key index of the
+other snapshots, unions the trees which share one, and grafts only those
+trees together; every other tree stays in its shard.
+
+merge writes the joined trees to a snapshot of their own, with a manifest
+naming the shards and the trees of each shard they replace.  load_shards
+reads it all back into one MailForest, the same as threading the
+archives of every shard in order.
+"""
+import itertools
+import json
+import optparse
+import os
+import sys
+
+from mailtree import MailForest
+from mailtree.snapshot import SnapshotForest, save_forest, load_forest
+
+SUMMARY_VERSION = 1
+MANIFEST_VERSION = 1
+
+# Nodes of shard n are numbered from n << SHARD_SHIFT, which keeps the
+# arrival order of the shards once they are joined
+SHARD_SHIFT = 40
+
+
+class ShardError(ValueError):
+    """A summary or manifest which can't be read"""
+
+
+def _write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _read(path, version, what):
+    try:
+        with open(path, 'rb') as f:
+            data = json.load(f)
+    except (IOError, ValueError) as e:
+        raise ShardError("can't read the %s %s: %s" % (what, path, e))
+
+    if not isinstance(data, dict) or data.get('version') != version:
+        raise ShardError("%s is not a version %d %s" % (path, version, what))
+
+    return data
+
+
+# Message ids are bytes, latin-1 maps them to JSON strings and back unchanged
+
+def _dump(data):
+    return json.dumps(data, encoding='latin-1')
+
+
+def _bytes(ids):
+    return [i.encode('latin-1') for i in ids]
+
+
+def frontier(tree):
+    """
+    Return the root of tree, then its other placeholders and the messages
+    without a parent
+    """
+    children = set()
+    for node in tree.nodes.itervalues():
+        if node._children:
+            children.update(c.message_id for c in node._children)
+
+    root = tree.parent.message_id
+    return [root] + sorted(message_id for message_id, node in tree.nodes.iteritems()
+                           if message_id != root and (node.isEmpty or message_id not in children))
+
+
+def summarise(forest):
+    """Return the summary of forest, its trees in the order of its snapshot"""
+    return {'version': SUMMARY_VERSION,
+            'trees': [frontier(forest.trees[key]) for key in sorted(forest.trees)]}
+
+
+def summary_path(path):
+    return path + '.summary'
+
+
+def read_summary(path):
+    """Return the frontier of every tree of the shard saved at path"""
+    data = _read(summary_path(path), SUMMARY_VERSION, 'shard summary')
+
+    return [_bytes(ids) for ids in data['trees']]
+
+
+def thread_shard(paths, path, number=0, workers=None):
+    """
+    Thread the archives in paths as shard number, save the forest to a
+    snapshot at path and its summary next to it
+
+    Returns the forest.
+    """
+    from mailtree.sources import fill_sources
+
+    forest = MailForest(arrival=itertools.count(number << SHARD_SHIFT))
+    fill_sources(paths, workers, forest)
+
+    save_forest(forest, path)
+    _write(summary_path(path), _dump(summarise(forest)))
+
+    return forest
+
+
+def plan_merge(shards):
+    """
+    Return the groups of trees which span shards, as sorted lists of
+    (shard, tree number), for the shards saved at the paths in shards
+    """
+    parent = {}
+
+    def find(item):
+        while parent.get(item, item) != item:
+            parent[item] = parent.get(parent[item], parent[item])
+            item = parent[item]
+        return item
+
+    snapshots = [SnapshotForest(path) for path in shards]
+    try:
+        for shard, path in enumerate(shards):
+            others = [(n, s) for n, s in enumerate(snapshots) if n != shard]
+            for tree, ids in enumerate(read_summary(path)):
+                top = find((shard, tree))
+                for message_id in ids:
+                    for other, snapshot in others:
+                        number = snapshot.tree_number(message_id)
+                        if number is None:
+                            continue
+
+                        found = find((other, number))
+                        if found != top:
+                            top, found = min(found, top), max(found, top)
+                            parent[found] = parent.setdefault(top, top)
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+
+    groups = {}
+    for item in parent:
+        groups.setdefault(find(item), []).append(item)
+
+    return sorted(sorted(group) for group in groups.itervalues())
+
+
+def _part(tree):
+    part = MailForest()
+    part.trees[tree.parent.message_id] = tree
+    return part
+
+
+def merge_shards(shards, path):
+    """
+    Join the trees which span the shards saved at the paths in shards
+
+    The joined trees are saved to a snapshot at path, and the manifest
+    next to it.  Returns the MailForest of the joined trees.
+    """
+    groups = plan_merge(shards)
+    replaced = [[] for s in shards]
+    for group in groups:
+        for shard, tree in group:
+            replaced[shard].append(tree)
+
+    # Merged in the order of the shards, as they would have been threaded
+    forest = MailForest()
+    for shard, trees in enumerate(replaced):
+        if not trees:
+            continue
+        with SnapshotForest(shards[shard]) as snapshot:
+            for tree in sorted(trees):
+                forest.merge(_part(snapshot.tree(tree)))
+
+    save_forest(forest, path)
+    _write(manifest_path(path), json.dumps({'version': MANIFEST_VERSION,
+                                            'shards': shards,
+                                            'replaced': [sorted(t) for t in replaced]}))
+
+    return forest
+
+
+def manifest_path(path):
+    return path + '.shards'
+
+
+def load_shards(path):
+    """Read the shards joined by merge_shards at path back into one MailForest"""
+    manifest = _read(manifest_path(path), MANIFEST_VERSION, 'shard manifest')
+
+    forest = MailForest()
+    for shard, replaced in zip(manifest['shards'], manifest['replaced']):
+        replaced = set(replaced)
+        part = MailForest()
+        with SnapshotForest(shard) as snapshot:
+            for number in xrange(len(snapshot)):
+                if number not in replaced:
+                    tree = snapshot.tree(number)
+                    part.trees[tree.parent.message_id] = tree
+        forest.merge(part)
+
+    forest.merge(load_forest(path))
+
+    return forest
+
+
+def main(argv):
+    usage = ("usage: %prog thread [options] shard.snapshot archive...\n"
+             "       %prog merge joined.snapshot shard.snapshot...")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--number', type='int', default=0,
+                      help="number of the shard, which orders its messages [default: 0]")
+    parser.add_option('-j', '--workers', type='int',
+                      help="threads reading the archives [default: one per CPU]")
+    values, args = parser.parse_args(argv[1:])
+    if len(args) < 3 or args[0] not in ('thread', 'merge'):
+        parser.error("thread or merge, an output file and at least one input are needed")
+
+    if args[0] == 'thread':
+        forest = thread_shard(args[2:], args[1], values.number, values.workers)
+        print "%d threads, %d messages" % (len(forest), len(forest.keys))
+    else:
+        forest = merge_shards(args[2:], args[1])
+        print "%d threads joined across shards" % len(forest)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
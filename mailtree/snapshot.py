@@ -0,0 +1,359 @@
+"""Save a MailForest to a compact binary file and load it back
+
+The file starts with a fixed size header followed by a number of sections,
+all little-endian:
+
+    header          magic, format version, section sizes and a CRC32 of
+                    everything after the header
+    string offsets  n_strings + 1 uint64 offsets into the string data
+    nodes           one record per node, grouped by tree: message id, author
+                    and subject string numbers, tree number, first child and
+                    child count, an empty flag, the date (NaN if unknown),
+                    the arrival number, and the source string number, offset
+                    and length of the message (all ones if unknown)
+    children        uint32 node numbers
+    trees           one record per tree: root node, first node, node count,
+                    message id string, first author and author count
+    authors         uint32 string numbers
+    key index       (hash, node number) pairs sorted by hash, to find the
+                    node of a message id without loading anything
+    string data     UTF-8 encoded strings
+
+Every section has a fixed record size, so SnapshotForest can memory-map
+the file and only build the trees that are looked up.  Nothing in the file
+is unpickled.
+"""
+import array
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from mailtree import MailForest, MailTree, MailTreeNode, OrderedSet, _intern
+
+MAGIC = 'MAILTREE'
+VERSION = 3
+
+HEADER = struct.Struct('<8sHHQQQQQQI')
+OFFSET = struct.Struct('<Q')
+NODE = struct.Struct('<IIIIIIBdQIQQ')
+TREE = struct.Struct('<IIIIII')
+KEY = struct.Struct('<QI')
+INDEX = struct.Struct('<I')
+
+NO_SEQ = (1 << 64) - 1
+NO_STRING = (1 << 32) - 1
+
+
+class SnapshotError(ValueError):
+    """The file is not a valid forest snapshot"""
+
+
+def _key_hash(message_id):
+    return OFFSET.unpack(hashlib.md5(message_id).digest()[:OFFSET.size])[0]
+
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+
+    return s
+
+
+def _uint32(items):
+    ret = array.array('I', items)
+    if ret.itemsize != 4:
+        ret = array.array('L', items)
+    if sys.byteorder == 'big':
+        ret.byteswap()
+
+    return ret.tostring()
+
+
+class _StringTable(object):
+    def __init__(self):
+        self.index = {}
+        self.offsets = [0]
+        self.data = []
+        self.size = 0
+
+    def add(self, s):
+        s = _encode(s)
+        if s not in self.index:
+            self.index[s] = len(self.data)
+            self.data.append(s)
+            self.size += len(s)
+            self.offsets.append(self.size)
+
+        return self.index[s]
+
+
+def _layout(n_strings, blob_size, n_nodes, n_children, n_trees, n_authors):
+    sections = {}
+    offset = HEADER.size
+    for name, size in (('offsets', (n_strings + 1) * OFFSET.size),
+                       ('nodes', n_nodes * NODE.size),
+                       ('children', n_children * INDEX.size),
+                       ('trees', n_trees * TREE.size),
+                       ('authors', n_authors * INDEX.size),
+                       ('keys', n_nodes * KEY.size),
+                       ('strings', blob_size)):
+        sections[name] = offset
+        offset += size
+    sections['end'] = offset
+
+    return sections
+
+
+def save_forest(forest, path):
+    """Write forest to a snapshot file at path
+
+    The file is written next to path and renamed over it once complete.
+    """
+    strings = _StringTable()
+    nodes = []
+    children = []
+    trees = []
+    authors = []
+    keys = []
+
+    for tree_key in sorted(forest.trees):
+        tree = forest.trees[tree_key]
+        number = len(trees)
+        first = len(nodes)
+
+        order = sorted(tree.nodes)
+        index = dict((message_id, first + n) for n, message_id in enumerate(order))
+
+        for message_id in order:
+            node = tree.nodes[message_id]
+            kids = [index[c.message_id] for c in node._children or ()]
+            date, seq = node.date, node.seq
+            if node.source is None:
+                location = (NO_STRING, NO_SEQ, NO_SEQ)
+            else:
+                location = (strings.add(node.source), node.offset, node.length)
+            nodes.append(NODE.pack(strings.add(message_id), strings.add(node.author),
+                                   strings.add(node.subject), number,
+                                   len(children), len(kids), node.isEmpty,
+                                   float('nan') if date is None else date,
+                                   NO_SEQ if seq is None else seq, *location))
+            children.extend(kids)
+            keys.append((_key_hash(_encode(message_id)), index[message_id]))
+
+        trees.append(TREE.pack(index[tree.parent.message_id], first, len(order),
+                               strings.add(tree.message_id), len(authors),
+                               len(tree.authors)))
+        authors.extend(strings.add(a) for a in tree.authors)
+
+    keys.sort()
+    sections = [
+        ''.join(OFFSET.pack(o) for o in strings.offsets),
+        ''.join(nodes),
+        _uint32(children),
+        ''.join(trees),
+        _uint32(authors),
+        ''.join(KEY.pack(h, n) for h, n in keys),
+        ''.join(strings.data),
+    ]
+
+    crc = 0
+    for data in sections:
+        crc = zlib.crc32(data, crc)
+
+    header = HEADER.pack(MAGIC, VERSION, 0, len(strings.data), strings.size,
+                         len(nodes), len(children), len(trees), len(authors),
+                         crc & 0xffffffff)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        for data in sections:
+            f.write(data)
+    os.rename(tmp, path)
+
+
+class SnapshotForest(object):
+    """A read-only forest backed by a memory-mapped snapshot file
+
+    Opening one only reads the header; trees are built from the file when
+    they are looked up.  Supports the lookups of MailForest: forest[key],
+    len(forest), key in forest, plus iteration over the trees.
+    """
+    def __init__(self, path, verify=True):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise SnapshotError("%s is empty" % path)
+
+        try:
+            self._open(verify)
+        except:
+            self.close()
+            raise
+
+    def _open(self, verify):
+        data = self._data
+        if len(data) < HEADER.size:
+            raise SnapshotError("%s is too short to be a snapshot" % self.path)
+
+        (magic, version, flags, self.n_strings, blob_size, self.n_nodes,
+         n_children, self.n_trees, n_authors, crc) = HEADER.unpack_from(data)
+
+        if magic != MAGIC:
+            raise SnapshotError("%s is not a forest snapshot" % self.path)
+        if version != VERSION:
+            raise SnapshotError("%s has snapshot version %d, expected %d"
+                                % (self.path, version, VERSION))
+
+        self._sections = _layout(self.n_strings, blob_size, self.n_nodes,
+                                 n_children, self.n_trees, n_authors)
+        if self._sections['end'] != len(data):
+            raise SnapshotError("%s has the wrong size" % self.path)
+
+        if verify and self._checksum() != crc:
+            raise SnapshotError("%s is corrupt" % self.path)
+
+    def _checksum(self):
+        crc = 0
+        data = self._data
+        for start in xrange(HEADER.size, len(data), 1 << 20):
+            crc = zlib.crc32(data[start:start + (1 << 20)], crc)
+
+        return crc & 0xffffffff
+
+    def close(self):
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _string(self, n):
+        start, end = struct.unpack_from('<QQ', self._data,
+                                        self._sections['offsets'] + n * OFFSET.size)
+        base = self._sections['strings']
+
+        return self._data[base + start:base + end]
+
+    def _text(self, n):
+        return self._string(n).decode('utf-8')
+
+    def _index(self, section, n):
+        return INDEX.unpack_from(self._data, self._sections[section] + n * INDEX.size)[0]
+
+    def _node(self, n):
+        return NODE.unpack_from(self._data, self._sections['nodes'] + n * NODE.size)
+
+    def _find(self, message_id):
+        """Return the node number of message_id, or None"""
+        message_id = _encode(message_id)
+        wanted = _key_hash(message_id)
+        base = self._sections['keys']
+
+        lo, hi = 0, self.n_nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(self._data, base + mid * KEY.size)[0] < wanted:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        while lo < self.n_nodes:
+            found, node = KEY.unpack_from(self._data, base + lo * KEY.size)
+            if found != wanted:
+                break
+            if self._string(self._node(node)[0]) == message_id:
+                return node
+            lo += 1
+
+        return None
+
+    def tree(self, n):
+        """Build the MailTree stored as tree number n"""
+        root, first, count, message_id, authors, n_authors = TREE.unpack_from(
+            self._data, self._sections['trees'] + n * TREE.size)
+
+        tree = MailTree(self._string(message_id))
+        tree.authors = OrderedSet(self._text(self._index('authors', authors + a))
+                                  for a in xrange(n_authors))
+        tree.nodes = {}
+
+        records = []
+        for number in xrange(first, first + count):
+            record = self._node(number)
+            node = MailTreeNode(self._string(record[0]))
+            node.author = self._text(record[1])
+            node.subject = self._text(record[2])
+            node.isEmpty = bool(record[6])
+            if not math.isnan(record[7]):
+                node._date = record[7]
+            if record[8] != NO_SEQ:
+                node.seq = record[8]
+            if record[9] != NO_STRING:
+                node.source = _intern(self._string(record[9]))
+                node.offset, node.length = record[10:12]
+            tree.nodes[node.message_id] = node
+            records.append((node, record))
+
+        for node, record in records:
+            kids = record[5]
+            if kids:
+                node.children.update(records[self._index('children', record[4] + c) - first][0]
+                                     for c in xrange(kids))
+
+        tree.parent = records[root - first][0]
+
+        return tree
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if node is None:
+            raise IndexError
+
+        return self.tree(self._node(node)[3])
+
+    def tree_number(self, key):
+        """Return the number of the tree holding message id key, or None"""
+        node = self._find(key)
+        if node is None:
+            return None
+
+        return self._node(node)[3]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return self.n_trees
+
+    def __iter__(self):
+        for n in xrange(self.n_trees):
+            yield self.tree(n)
+
+    def __repr__(self):
+        return "<SnapshotForest: %s, %d trees>" % (self.path, self.n_trees)
+
+
+def load_forest(path, verify=True):
+    """Read the snapshot at path back into a MailForest"""
+    forest = MailForest()
+
+    with SnapshotForest(path, verify) as snapshot:
+        for tree in snapshot:
+            root = tree.parent.message_id
+            forest.trees[root] = forest.roots[root] = tree
+            forest.sizes[root] = len(tree.nodes)
+            for message_id in tree.nodes:
+                forest.keys[message_id] = root
+
+    return forest
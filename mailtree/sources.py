@@ -0,0 +1,251 @@
+"""Read messages out of compressed mboxes, Maildirs and lists of archives
+
+Every source yields MessageHeaders records which MailForest.fill_tree can
+thread.  Plain mbox files go through scan_mbox; other kinds of archive are
+picked by SOURCES, which maps a file name suffix to a function taking the
+path and returning the records, and can be extended.
+"""
+import bz2
+import collections
+import gzip
+import multiprocessing
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from mailtree import MailForest
+from mailtree.scanner import (scan_mbox, parse_headers, first_message,
+                              MessageHeaders, THREADING_HEADERS)
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+CHUNK_SIZE = 1 << 20
+
+
+def _header_end(buf, start):
+    idx = buf.find('\n\n', start)
+    # Only a CRLF blank line before the LF one matters, don't look past it
+    crlf = buf.find('\n\r\n', start, len(buf) if idx == -1 else idx + 2)
+    if crlf != -1 and (idx == -1 or crlf < idx):
+        idx = crlf
+
+    return idx
+
+
+def scan_stream(f, headers=THREADING_HEADERS, chunk_size=CHUNK_SIZE):
+    """
+    Yield a MessageHeaders record for every message of the mbox read from
+    the file object f
+
+    The stream is read in chunks and message bodies are dropped as they
+    go by, so it works on anything with a read method, such as a
+    decompressing file, without the whole mbox being kept in memory.
+    Offsets and lengths are positions in the stream.  Messages are split
+    the same way scan_mbox splits them.
+    """
+    buf = ''
+    base = 0        # stream offset of buf[0]
+    pos = 0         # where in buf to carry on from
+    start = None    # stream offset of the current message
+    record = None   # headers of the current message, once read
+    eof = False
+
+    while not eof:
+        data = f.read(chunk_size)
+        eof = not data
+
+        # Drop what has been scanned once per read.  The character before
+        # pos is kept, first_message needs it to tell a "From " line from
+        # "From " in the middle of one.
+        cut = max(pos - 1, 0)
+        base += cut
+        pos -= cut
+        buf = buf[cut:] + data
+
+        while True:
+            if start is None:
+                idx = first_message(buf, pos)
+                if idx >= len(buf):
+                    # Look again where a "From " line split across reads starts
+                    pos = max(len(buf) - 5, pos)
+                    break
+                pos = idx
+                start = base + pos
+
+            if record is None:
+                hstart = buf.find('\n', pos) + 1
+                if not hstart and not eof:
+                    break
+
+                nxt = buf.find('\nFrom ', hstart - 1) if hstart else -1
+                hend = _header_end(buf, hstart) if hstart else -1
+                if hend == -1 or (nxt != -1 and nxt < hend):
+                    if nxt == -1 and not eof:
+                        break
+                    hend = len(buf) if nxt == -1 else nxt
+                else:
+                    hend += 1
+
+                record = parse_headers(buf[hstart:hend] if hstart else '', headers)
+                pos = max(hend - 1, pos)
+
+            nxt = buf.find('\nFrom ', pos)
+            if nxt == -1:
+                if eof:
+                    yield MessageHeaders(record, start, base + len(buf) - start)
+                    return
+
+                # Only the end of the body is needed to find the next message
+                pos = max(len(buf) - 5, pos)
+                break
+
+            yield MessageHeaders(record, start, base + nxt - start)
+            pos = nxt + 1
+            start = base + pos
+            record = None
+
+def _scan_compressed(opener):
+    def scan(path, headers=THREADING_HEADERS):
+        f = opener(path)
+        try:
+            for record in scan_stream(f, headers):
+                yield record
+        finally:
+            f.close()
+
+    return scan
+
+
+def _open_xz(path):
+    if lzma is None:
+        raise ValueError("reading %s needs the lzma module, or backports.lzma "
+                         "on Python 2" % path)
+
+    return lzma.LZMAFile(path, 'rb')
+
+
+scan_gzip = _scan_compressed(lambda path: gzip.GzipFile(path, 'rb'))
+scan_bz2 = _scan_compressed(lambda path: bz2.BZ2File(path, 'rb'))
+scan_xz = _scan_compressed(_open_xz)
+
+
+def _read_headers(path, chunk_size=8192):
+    with open(path, 'rb') as f:
+        block = ''
+        while True:
+            data = f.read(chunk_size)
+            block += data
+            if not data or _header_end(block, 0) != -1 or block.startswith(('\n', '\r\n')):
+                return block, os.fstat(f.fileno()).st_size
+
+
+def scan_maildir(path, headers=THREADING_HEADERS):
+    """
+    Yield a MessageHeaders record for every message of the Maildir at path
+
+    Messages in new and cur are read in file name order, and only up to
+    the end of their headers.  The records have no source, as the files
+    are not in mbox format.
+    """
+    for sub in ('new', 'cur'):
+        folder = os.path.join(path, sub)
+        if not os.path.isdir(folder):
+            continue
+
+        for name in sorted(os.listdir(folder)):
+            if name.startswith('.'):
+                continue
+
+            block, size = _read_headers(os.path.join(folder, name))
+            yield MessageHeaders(parse_headers(block, headers), 0, size)
+
+
+SOURCES = {
+    '.gz': scan_gzip,
+    '.bz2': scan_bz2,
+    '.xz': scan_xz,
+}
+
+
+def is_maildir(path):
+    return os.path.isdir(os.path.join(path, 'cur')) or os.path.isdir(os.path.join(path, 'new'))
+
+
+def open_source(path, headers=THREADING_HEADERS):
+    """
+    Return the MessageHeaders records of the archive at path
+
+    The kind of archive is worked out from the path: a directory with cur
+    or new in it is a Maildir, a suffix found in SOURCES picks the reader
+    registered for it, anything else is read as a plain mbox.
+    """
+    if os.path.isdir(path):
+        if not is_maildir(path):
+            raise ValueError("%s is not a Maildir" % path)
+        return scan_maildir(path, headers)
+
+    scan = SOURCES.get(os.path.splitext(path)[1].lower())
+    if scan is None:
+        return scan_mbox(path, headers=headers)
+
+    return scan(path, headers)
+
+
+def _read_source(path):
+    return list(open_source(path))
+
+
+def read_sources(paths, workers=None):
+    """
+    Yield the MessageHeaders records of every archive in paths, in order
+
+    Archives are read by a pool of workers threads, which is where the
+    decompression and the disk reads happen.  At most workers archives are
+    read ahead of the one being yielded, which bounds the memory used.
+    workers defaults to the number of CPUs.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if workers <= 1:
+        for path in paths:
+            for record in open_source(path):
+                yield record
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for path in paths:
+            pending.append(pool.apply_async(_read_source, (path,)))
+            if len(pending) > workers:
+                for record in pending.popleft().get():
+                    yield record
+
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def fill_sources(paths, workers=None, forest=None):
+    """
+    Thread the messages of every archive in paths into one MailForest
+
+    The archives are read with read_sources and threaded into forest in
+    the order of paths.
+    """
+    if forest is None:
+        forest = MailForest()
+
+    forest.fill_tree(read_sources(paths, workers))
+
+    return forest
@@ -0,0 +1,208 @@
+"""Measure where the time goes while threading an archive
+
+Nothing is measured unless a Stats is attached to a forest, either with
+Stats.attach or by passing it to create_mailtree:
+
+    stats = Stats(sinks=[JsonLinesSink('ingest.log')])
+    create_mailtree('archive.mbox', stats=stats)
+
+Phases timed, in seconds:
+
+    read      reading and parsing messages out of the mailbox
+    ids       tokenizing Message-Id, References and In-Reply-To, and the
+              duplicate check
+    thread    threading messages into the forest, grafts included
+    graft     grafting trees together
+    decode    decoding headers which weren't in the header cache
+
+The report also counts messages, duplicates, grafts and the nodes they
+moved, parent_key lookups and the links they followed, placeholder nodes
+and header cache hits.  Messages only count when they go through
+MailForest.fill_tree, forests merged in from worker processes don't.  Run
+python -m mailtree.stats on an archive to print the report.
+"""
+import json
+import optparse
+import sys
+import time
+
+import mailtree
+
+from mailtree import create_mailtree
+
+PHASES = ('read', 'ids', 'thread', 'graft', 'decode')
+COUNTERS = ('messages', 'threaded', 'duplicates', 'synthesised', 'grafts',
+            'graft_nodes', 'lookups', 'chain_links', 'placeholders',
+            'header_hits', 'header_misses')
+
+
+class Stats(object):
+    """
+    Timers and counters for the threading of messages into a MailForest
+
+    sinks are called with the report of every emit.  With every set, a
+    report is also emitted after every that many messages.
+    """
+    def __init__(self, sinks=(), every=None):
+        self.sinks = list(sinks)
+        self.every = every
+        self.reset()
+
+    def reset(self):
+        self.timers = dict.fromkeys(PHASES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.elapsed = 0.0
+        self._started = None
+        self._start_counts = None
+
+    def attach(self, forest):
+        """Start measuring the work done on forest"""
+        forest.stats = self
+        mailtree.header_cache.stats = self
+        self._started = time.time()
+        self._start_counts = self._snapshot(forest)
+
+    def detach(self, forest):
+        """Stop measuring forest"""
+        self._update(forest)
+        forest.stats = None
+        if mailtree.header_cache.stats is self:
+            mailtree.header_cache.stats = None
+
+    def _snapshot(self, forest):
+        cache = mailtree.header_cache
+        dedup = forest.dedup
+        return {
+            'nodes': len(forest.keys),
+            'header_hits': cache.hits,
+            'header_misses': cache.misses,
+            'duplicates': dedup.duplicates if dedup else 0,
+            'synthesised': dedup.synthesised if dedup else 0,
+            'threaded': self.counters['threaded'],
+        }
+
+    def _update(self, forest):
+        """Fold the counts kept elsewhere since attach into the counters"""
+        if self._started is None:
+            return
+
+        now = self._snapshot(forest)
+        before = self._start_counts
+        counters = self.counters
+
+        for name in ('header_hits', 'header_misses', 'duplicates', 'synthesised'):
+            counters[name] += now[name] - before[name]
+        # Every message id gets a node, those not threaded are placeholders
+        counters['placeholders'] += ((now['nodes'] - before['nodes'])
+                                     - (now['threaded'] - before['threaded']))
+
+        self.elapsed += time.time() - self._started
+        self._started = time.time()
+        self._start_counts = self._snapshot(forest)
+
+    def fill(self, forest, box):
+        """MailForest.fill_tree, timing every phase"""
+        clock = time.time
+        timers = self.timers
+        counters = self.counters
+        dedup = forest.dedup
+        every = self.every
+        messages = iter(box)
+
+        while True:
+            start = clock()
+            try:
+                m = next(messages)
+            except StopIteration:
+                break
+            read = clock()
+            timers['read'] += read - start
+            counters['messages'] += 1
+
+            for m, ids in dedup.filter((m,)):
+                parsed = clock()
+                timers['ids'] += parsed - read
+                forest.add_message(m, ids)
+                timers['thread'] += clock() - parsed
+                counters['threaded'] += 1
+                break
+            else:
+                timers['ids'] += clock() - read
+
+            if every and counters['messages'] % every == 0:
+                self._update(forest)
+                self.emit()
+
+        self._update(forest)
+
+    def report(self):
+        """Return the timers, counters and rates as a dict"""
+        counters = self.counters
+        elapsed = self.elapsed
+        if self._started is not None:
+            elapsed += time.time() - self._started
+
+        lookups = counters['header_hits'] + counters['header_misses']
+        ret = dict(counters)
+        ret.update({
+            'elapsed': round(elapsed, 6),
+            'phases': dict((name, round(t, 6)) for name, t in self.timers.items()),
+            'messages_per_second': round(counters['messages'] / elapsed, 1) if elapsed else None,
+            'average_graft_size': (float(counters['graft_nodes']) / counters['grafts']
+                                   if counters['grafts'] else None),
+            'average_chain_length': (float(counters['chain_links']) / counters['lookups']
+                                     if counters['lookups'] else None),
+            'header_cache_hit_rate': (float(counters['header_hits']) / lookups
+                                      if lookups else None),
+        })
+
+        return ret
+
+    def emit(self):
+        """Send the report to every sink"""
+        report = self.report()
+        for sink in self.sinks:
+            sink(report)
+
+        return report
+
+    def __repr__(self):
+        return "<Stats: %d messages, %d grafts>" % (self.counters['messages'],
+                                                    self.counters['grafts'])
+
+
+class JsonLinesSink(object):
+    """Appends every report as one line of JSON to a file or file object"""
+    def __init__(self, target):
+        self.target = target
+
+    def __call__(self, report):
+        line = json.dumps(report, sort_keys=True) + '\n'
+        if isinstance(self.target, basestring):
+            with open(self.target, 'a') as f:
+                f.write(line)
+        else:
+            self.target.write(line)
+            self.target.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="usage: %prog [options] archive...")
+    parser.add_option('--headers-only', action='store_true',
+                      help="only parse the headers needed for threading")
+    parser.add_option('--every', type='int',
+                      help="also report after every this many messages")
+    parser.add_option('--json', metavar='FILE',
+                      help="append the reports to FILE as JSON lines")
+    values, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("an archive is needed")
+
+    sinks = [JsonLinesSink(values.json or sys.stdout)]
+    stats = Stats(sinks, values.every)
+    create_mailtree(args[0] if len(args) == 1 else args,
+                    headers_only=values.headers_only, stats=stats)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
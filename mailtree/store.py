@@ -0,0 +1,441 @@
+"""Thread archives larger than memory into a forest kept in SQLite
+
+SQLiteForest threads messages like MailForest, but keeps every message id,
+node, reply edge and author in a SQLite database instead of in dicts, so
+its memory use doesn't grow with the archive:
+
+    forest = SQLiteForest('archive.db')
+    forest.fill_tree(scan_mbox('archive.mbox'))
+    for root, tree in forest.pruned_trees().iteritems():
+        for node in tree.walk_tree():
+            ...
+    forest.close()
+
+Trees come out of it as ordinary MailTree objects, built from the database
+when they are looked up.  A bounded cache keeps the trees looked up most
+recently, and writes are committed in batches of batch_size messages.
+Reopening the file carries on with the forest saved in it.
+"""
+import collections
+import sqlite3
+
+import mailtree
+
+from mailtree import (MailTree, MailTreeNode, OrderedSet, message_ids, get_header,
+                      _intern)
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE trees (
+    id INTEGER PRIMARY KEY,
+    root TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL
+);
+CREATE TABLE nodes (
+    message_id TEXT PRIMARY KEY,
+    tree INTEGER NOT NULL,
+    empty INTEGER NOT NULL DEFAULT 1,
+    author TEXT,
+    subject TEXT,
+    date TEXT,
+    seq INTEGER,
+    parent TEXT,
+    source TEXT,
+    offset INTEGER,
+    length INTEGER
+);
+CREATE INDEX nodes_tree ON nodes (tree);
+CREATE TABLE authors (
+    tree INTEGER NOT NULL,
+    author TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (tree, author)
+);
+"""
+
+
+class StoreError(ValueError):
+    """The file is not a forest database this version can read"""
+
+
+def _paged(db, query, args=(), page=1000):
+    """
+    Yield the rows of query, which selects rowid first, a page at a time
+
+    Nothing is held open between pages, so the forest can be written to
+    while its rows are gone through.
+    """
+    last = 0
+    while True:
+        rows = db.execute(query + ' AND rowid > ? ORDER BY rowid LIMIT ?',
+                          tuple(args) + (last, page)).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        last = rows[-1][0]
+
+
+class _Keys(object):
+    """The message ids of an SQLiteForest, like MailForest.keys"""
+    def __init__(self, forest):
+        self.forest = forest
+
+    def __contains__(self, message_id):
+        return self.forest._tree_id(message_id) is not None
+
+    def __iter__(self):
+        for rowid, message_id in _paged(self.forest.db,
+                                        'SELECT rowid, message_id FROM nodes WHERE 1'):
+            yield message_id
+
+    def __len__(self):
+        return self.forest.db.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+
+
+class _Roots(collections.Mapping):
+    """The trees of an SQLiteForest by the message id of their root"""
+    def __init__(self, forest):
+        self.forest = forest
+
+    def __getitem__(self, root):
+        row = self.forest.db.execute('SELECT id FROM trees WHERE root = ?',
+                                     (root,)).fetchone()
+        if row is None:
+            raise KeyError(root)
+
+        return self.forest._tree(row[0])
+
+    def __contains__(self, root):
+        return self.forest.db.execute('SELECT 1 FROM trees WHERE root = ?',
+                                      (root,)).fetchone() is not None
+
+    def __iter__(self):
+        for tree_id, root in _paged(self.forest.db, 'SELECT id, root FROM trees WHERE 1'):
+            yield root
+
+    def iteritems(self):
+        for tree_id, root in _paged(self.forest.db, 'SELECT id, root FROM trees WHERE 1'):
+            yield root, self.forest._tree(tree_id)
+
+    def itervalues(self):
+        for root, tree in self.iteritems():
+            yield tree
+
+    def __len__(self):
+        return len(self.forest)
+
+
+class SQLiteForest(object):
+    """
+    A forest of MailTrees stored in the SQLite database at path
+
+    Supports what the readers of a MailForest use: forest[key] for the
+    tree holding a message id, len(forest), node, keys, pruned_trees and
+    roots, plus fill_tree and add_message to thread messages.  Listeners
+    get the same events as with MailForest, which means building the
+    trees concerned from the database on every change.
+
+    cache_size bounds the number of trees kept built in memory and
+    batch_size the number of messages threaded between commits.
+    """
+    def __init__(self, path, cache_size=1000, batch_size=10000):
+        self.path = path
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.listeners = []
+        self.dedup = None
+        self.stats = None
+        self.keys = _Keys(self)
+        self.roots = _Roots(self)
+        self._cache = collections.OrderedDict()
+        self._uncommitted = 0
+
+        self.db = sqlite3.connect(path)
+        # Message ids are byte strings, they are stored as they are
+        self.db.text_factory = str
+        try:
+            self._open()
+        except:
+            self.db.close()
+            raise
+
+    def _open(self):
+        db = self.db
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            if db.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+                raise StoreError("%s is not a forest database" % self.path)
+            db.executescript(SCHEMA)
+            db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+            db.commit()
+        elif version != SCHEMA_VERSION:
+            raise StoreError("%s has schema version %d, expected %d"
+                             % (self.path, version, SCHEMA_VERSION))
+
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+
+        self._count = db.execute('SELECT COUNT(*) FROM trees').fetchone()[0]
+        self._pos = db.execute('SELECT MAX(pos) FROM authors').fetchone()[0] or 0
+
+    def commit(self):
+        """Write the messages threaded since the last commit to the file"""
+        self.db.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def notify(self, event, tree, other=None):
+        for listener in self.listeners:
+            listener(event, tree, other)
+
+    def _tree_id(self, message_id):
+        row = self.db.execute('SELECT tree FROM nodes WHERE message_id = ?',
+                              (message_id,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def _tree(self, tree_id):
+        """Return the MailTree stored as tree_id, out of the cache if it's there"""
+        cache = self._cache
+        tree = cache.pop(tree_id, None)
+        if tree is None:
+            tree = self._build(tree_id)
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[tree_id] = tree
+
+        return tree
+
+    def _build(self, tree_id):
+        db = self.db
+        root = db.execute('SELECT root FROM trees WHERE id = ?', (tree_id,)).fetchone()[0]
+
+        tree = MailTree(root)
+        tree.authors = OrderedSet(
+            row[0].decode('utf-8') for row in
+            db.execute('SELECT author FROM authors WHERE tree = ? ORDER BY pos', (tree_id,)))
+        tree.nodes = nodes = {}
+
+        # Ordered by arrival, which is the order replies were attached in
+        rows = db.execute('SELECT message_id, empty, author, subject, date, seq, parent, '
+                          'source, offset, length FROM nodes WHERE tree = ? ORDER BY seq',
+                          (tree_id,)).fetchall()
+        for (message_id, empty, author, subject, date, seq, parent,
+             source, offset, length) in rows:
+            node = MailTreeNode(message_id)
+            if not empty:
+                node.isEmpty = False
+                node.author = author.decode('utf-8')
+                node.subject = subject.decode('utf-8')
+                node._date = date
+                node.seq = seq
+                if source is not None:
+                    node.source = _intern(source)
+                    node.offset, node.length = offset, length
+            nodes[node.message_id] = node
+
+        for row in rows:
+            if row[6] is not None:
+                nodes[row[6]].children.append(nodes[row[0]])
+
+        tree.parent = nodes[root]
+
+        return tree
+
+    def _forget(self, tree_id):
+        self._cache.pop(tree_id, None)
+
+    def __getitem__(self, key):
+        tree_id = self._tree_id(key)
+        if tree_id is None:
+            raise IndexError
+
+        return self._tree(tree_id)
+
+    def __len__(self):
+        return self._count
+
+    def node(self, message_id):
+        """Return the MailTreeNode of message_id, without its children"""
+        row = self.db.execute('SELECT message_id, empty, author, subject, date, seq, '
+                              'source, offset, length FROM nodes WHERE message_id = ?',
+                              (message_id,)).fetchone()
+        if row is None:
+            raise KeyError(message_id)
+
+        node = MailTreeNode(row[0])
+        if not row[1]:
+            node.isEmpty = False
+            node.author = row[2].decode('utf-8')
+            node.subject = row[3].decode('utf-8')
+            node._date, node.seq = row[4], row[5]
+            if row[6] is not None:
+                node.source = _intern(row[6])
+                node.offset, node.length = row[7], row[8]
+
+        return node
+
+    def pruned_trees(self):
+        """Return a mapping of every tree by the message id of its root"""
+        return self.roots
+
+    def _create(self, root):
+        cursor = self.db.execute('INSERT INTO trees (root, size) VALUES (?, 1)', (root,))
+        tree_id = cursor.lastrowid
+        self.db.execute('INSERT INTO nodes (message_id, tree) VALUES (?, ?)', (root, tree_id))
+        self._count += 1
+        if self.listeners:
+            self.notify('created', self._tree(tree_id))
+
+        return tree_id
+
+    def _tree_key(self, key):
+        tree_id = self._tree_id(key)
+        if tree_id is None:
+            tree_id = self._create(key)
+
+        return tree_id
+
+    def _add_key(self, key, tree_id):
+        other = self._tree_id(key)
+        if other is None:
+            self.db.execute('INSERT INTO nodes (message_id, tree) VALUES (?, ?)', (key, tree_id))
+            self.db.execute('UPDATE trees SET size = size + 1 WHERE id = ?', (tree_id,))
+            return tree_id
+
+        if other == tree_id:
+            return tree_id
+
+        return self._graft(tree_id, other)
+
+    def _graft(self, tree_id, other):
+        """
+        Graft the tree other into tree_id, return the id of the result
+
+        Its root is the root of tree_id, but the rows of the smaller of the
+        two trees are the ones moved to the other.
+        """
+        db = self.db
+        if self.listeners:
+            grafted = self._tree(other)
+
+        root, size = db.execute('SELECT root, size FROM trees WHERE id = ?',
+                                (tree_id,)).fetchone()
+        other_size = db.execute('SELECT size FROM trees WHERE id = ?', (other,)).fetchone()[0]
+        self._merge_authors(tree_id, other)
+
+        keep, drop = tree_id, other
+        if other_size > size:
+            keep, drop = other, tree_id
+
+        db.execute('UPDATE nodes SET tree = ? WHERE tree = ?', (keep, drop))
+        db.execute('UPDATE authors SET tree = ? WHERE tree = ?', (keep, drop))
+        db.execute('DELETE FROM trees WHERE id = ?', (drop,))
+        db.execute('UPDATE trees SET root = ?, size = ? WHERE id = ?',
+                   (root, size + other_size, keep))
+
+        self._forget(tree_id)
+        self._forget(other)
+        self._count -= 1
+        if self.listeners:
+            self.notify('grafted', self._tree(keep), grafted)
+
+        return keep
+
+    def _merge_authors(self, tree_id, other):
+        # pos numbers the authors as they came, like MailTree.graft every
+        # author keeps the earliest of the two.  _graft moves them all
+        # under one tree after
+        db = self.db
+        db.execute('UPDATE authors SET pos = MIN(pos, (SELECT o.pos FROM authors o '
+                   'WHERE o.tree = ? AND o.author = authors.author)) '
+                   'WHERE tree = ? AND author IN (SELECT author FROM authors WHERE tree = ?)',
+                   (other, tree_id, other))
+        db.execute('INSERT OR IGNORE INTO authors (tree, author, pos) '
+                   'SELECT ?, author, pos FROM authors WHERE tree = ?', (tree_id, other))
+        db.execute('DELETE FROM authors WHERE tree = ?', (other,))
+
+    def _add_author(self, tree_id, author):
+        cursor = self.db.execute('INSERT OR IGNORE INTO authors (tree, author, pos) '
+                                 'VALUES (?, ?, ?)', (tree_id, author, self._pos + 1))
+        if cursor.rowcount:
+            self._pos += 1
+
+    def _hydrate(self, message_id, tree_id, message, author, ids):
+        parent = ids.in_reply_to[0] if len(ids.in_reply_to) else None
+        source = getattr(message, 'source', None)
+        offset = length = None
+        if source is not None:
+            offset, length = message.offset, message.length
+
+        self.db.execute('UPDATE nodes SET empty = 0, author = ?, subject = ?, date = ?, '
+                        'seq = ?, parent = ?, source = ?, offset = ?, length = ? '
+                        'WHERE message_id = ? AND empty',
+                        (author, get_header(message.get('Subject')), message.get('Date'),
+                         next(mailtree._arrival), parent, source, offset, length,
+                         message_id))
+
+    def fill_tree(self, box):
+        """Thread every message of box into the forest, see MailForest.fill_tree"""
+        if self.dedup is None:
+            from mailtree.dedup import Deduplicator
+            self.dedup = Deduplicator(self)
+
+        for m, ids in self.dedup.filter(box):
+            self.add_message(m, ids)
+
+        self.commit()
+
+    def add_message(self, m, ids=None):
+        """
+        Thread a single message into the forest, like MailForest.add_message
+
+        Returns the message id of the root of its tree, building the tree
+        is left to whoever needs it.
+        """
+        if ids is None:
+            ids = message_ids(m)
+        msg_id = ids.message_id
+        if msg_id is None:
+            raise ValueError("message has no Message-Id")
+
+        references = ids.references
+        if len(references) > 0:
+            tree_id = self._tree_key(references[0])
+            for ref in references[1:]:
+                tree_id = self._add_key(ref, tree_id)
+            tree_id = self._add_key(msg_id, tree_id)
+        else:
+            tree_id = self._tree_id(msg_id)
+            if tree_id is None:
+                tree_id = self._create(msg_id)
+
+        author = get_header(m.get('From'))
+        self._add_author(tree_id, author)
+        self._hydrate(msg_id, tree_id, m, author, ids)
+        self._forget(tree_id)
+
+        if self.listeners:
+            tree = self._tree(tree_id)
+            self.notify('added', tree, tree.nodes[msg_id])
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.batch_size:
+            self.commit()
+
+        return self.db.execute('SELECT root FROM trees WHERE id = ?', (tree_id,)).fetchone()[0]
+
+    def __repr__(self):
+        return "<SQLiteForest: %s, %d trees>" % (self.path, self._count)
@@ -0,0 +1,100 @@
+import re
+
+from mailtree import get_header
+
+WINDOW = 30 * 86400
+
+# Reply and forward markers, in a few languages, and list tags like [list]
+_prefix_re = re.compile(r'''
+    \s* (?: (?: re | fwd? | aw | sv | vs | antw | rif | wg ) \s* (?: \[\d+\] | \(\d+\) )? \s* :
+          | \[ [^\]]* \] )
+''', re.X | re.I | re.U)
+_suffix_re = re.compile(r'\s*\((?:fwd|was:[^)]*)\)\s*$', re.I | re.U)
+_space_re = re.compile(r'\s+', re.U)
+
+
+def normalise_subject(subject):
+    """
+    Return subject without reply and forward markers or list tags,
+    lower-cased and with its whitespace collapsed
+
+    subject can be a raw header, which is decoded with get_header first.
+    """
+    if not isinstance(subject, unicode):
+        subject = get_header(subject)
+
+    while True:
+        match = _prefix_re.match(subject)
+        if match is None:
+            break
+        subject = subject[match.end():]
+
+    subject = _suffix_re.sub(u'', subject)
+
+    return _space_re.sub(u' ', subject).strip().lower()
+
+
+def _first_message(tree):
+    """Return the subject and date of the first message of tree"""
+    root = tree.parent
+    if not root.isEmpty:
+        return root.subject, root.date
+
+    # The root was never seen, use the earliest message that was
+    first = None
+    for node in tree.nodes.itervalues():
+        if not node.isEmpty and (first is None or node.seq < first.seq):
+            first = node
+    if first is None:
+        return None, None
+
+    return first.subject, first.date
+
+
+def _last_date(tree):
+    dates = [n.date for n in tree.nodes.itervalues() if not n.isEmpty]
+    dates = [d for d in dates if d is not None]
+
+    return max(dates) if dates else None
+
+
+def gather_subjects(forest, window=WINDOW):
+    """
+    Graft together the trees of forest whose first messages have the same
+    normalised subject
+
+    Trees are gone through by the date of their first message, and a hash
+    index maps every normalised subject to the root of the thread it last
+    went to.  A tree joins that thread if it started at most window seconds
+    after the last message of the thread, its root becoming a child of the
+    thread's root; otherwise it takes the subject over.  Trees without a
+    date are left alone unless window is None, which turns the time limit
+    off.  Returns the number of trees that were grafted.
+    """
+    trees = []
+    for root, tree in forest.roots.iteritems():
+        subject, date = _first_message(tree)
+        if subject is None:
+            continue
+        subject = normalise_subject(subject)
+        if subject and (date is not None or window is None):
+            trees.append((date, root, subject))
+    trees.sort()
+
+    index = {}
+    grafted = 0
+    for date, root, subject in trees:
+        last = _last_date(forest.roots[root])
+        found = index.get(subject)
+        if found is not None:
+            key, thread_last = found
+            if window is None or (thread_last is not None and date - thread_last <= window):
+                forest.graft(key, root)
+                grafted += 1
+                if thread_last is not None and (last is None or thread_last > last):
+                    last = thread_last
+                root = key
+
+        index[subject] = (root, last)
+
+    return grafted
@@ -0,0 +1,74 @@
+"""Fixtures shared by the tests"""
+from email.message import Message
+from email.utils import formatdate
+
+DAY = 86400
+
+FROM_LINE = 'From author@example.com Mon Jan  1 00:00:00 2001\n'
+
+
+def message(msg_id, author=None, day=None, references=(), in_reply_to=None,
+            subject='Test', body='body'):
+    """
+    Return an email.message.Message
+
+    msg_id and the references are given without angle brackets, and a
+    msg_id of None leaves the Message-Id out.  author is the local part of
+    the From address, day the Date in days since the epoch.  In-Reply-To
+    defaults to the last reference.
+    """
+    msg = Message()
+    if author is None:
+        msg['From'] = 'Author <author@example.com>'
+    else:
+        msg['From'] = 'Author %s <%s@example.com>' % (author.upper(), author)
+    if msg_id is not None:
+        msg['Message-Id'] = '<%s>' % msg_id
+    if day is not None:
+        msg['Date'] = formatdate(day * DAY)
+    msg['Subject'] = subject
+    if references:
+        msg['References'] = ' '.join('<%s>' % r for r in references)
+        if in_reply_to is None:
+            in_reply_to = references[-1]
+    if in_reply_to:
+        msg['In-Reply-To'] = '<%s>' % in_reply_to
+    msg.set_payload(body)
+
+    return msg
+
+
+def message_text(msg_id, in_reply_to=None, body='body\n.leading dot\n'):
+    """Return the text of a message, see message"""
+    return message(msg_id, in_reply_to=in_reply_to, body=body).as_string()
+
+
+def mbox_message(msg_id, in_reply_to=None):
+    """Return a message as it is stored in an mbox, "From " line included"""
+    return FROM_LINE + message_text(msg_id, in_reply_to) + '\n'
+
+
+def shape(forest):
+    """
+    Return everything threading decides about forest, in the order it
+    decided it: the trees by root with the children and authors of their
+    nodes, and the root of every message id
+    """
+    trees = {}
+    for tree in forest.trees.values():
+        nodes = {}
+        for key, node in tree.nodes.items():
+            children = [c.message_id for c in node._children or ()]
+            nodes[key] = (node.isEmpty, node.author, node.subject, children)
+        trees[tree.parent.message_id] = (nodes, list(tree.authors))
+
+    roots = dict((key, forest[key].parent.message_id) for key in forest.keys)
+
+    return trees, roots
+
+
+def tree_shape(tree):
+    """Return the walk of tree with what every node holds, its ids and its authors"""
+    return ([(d, n.message_id, n.isEmpty, n.author, n.subject, n.date, n.source, n.offset)
+             for d, n in tree.depth_first()],
+            set(tree.nodes), list(tree.authors))
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from mailtree import MailForest, MailTreeNode, MailTree
-from mailtree import parse_message_ids
+from mailtree import parse_message_ids, message_ids, get_header, HeaderCache
 
 from email.message import Message
 
+import pickle
 import unittest
 
 from mock import Mock
@@ -54,6 +55,22 @@ class TestMailTreeNode(unittest.TestCase):
         mtn.hydrate(self.msgU, tree)
         self.assertEqual(mtn.author, u'ŚöƜē Ņămē <name@example.com>')
 
+    def test_compact_placeholder(self):
+        mtn = MailTreeNode('abcde')
+
+        self.assertFalse(hasattr(mtn, '__dict__'))
+        self.assertTrue(mtn._children is None)
+        self.assertEqual(mtn.children, [])
+
+    def test_pickle(self):
+        mtn = MailTreeNode('abcde')
+        mtn.hydrate(self.msg, Mock())
+        mtn.children.append(MailTreeNode('efg'))
+
+        copy = pickle.loads(pickle.dumps(mtn, 2))
+        self.assertEqual(copy.author, 'From test <from@example.com>')
+        self.assertEqual(copy.children[0].message_id, 'efg')
+
 
 class TestMailTree(unittest.TestCase):
     def setUp(self):
@@ -84,6 +101,20 @@ class TestMailTree(unittest.TestCase):
 
         self.assertEqual(mt.authors, ['My Name Is <name@example.com>'])
 
+    def test_graft_keeps_children_of_both(self):
+        mt = MailTree('abcd1@example.com', self.msgA)
+        other = MailTree('abcd1@example.com')
+        other.addChild(self.msgB, ['abcd1@example.com'])
+        other.addChild(self.msgC, ['abcd1@example.com'])
+        mt.graft(other)
+
+        self.assertTrue(mt.parent is mt.nodes['abcd1@example.com'])
+        self.assertEqual(mt.parent.author, 'From test <from1@example.com>')
+        self.assertEqual([c.message_id for c in mt.parent.children], ['abcd2@example.com'])
+        self.assertEqual(sorted(mt.authors), ['From test <from1@example.com>',
+                                              'From test <from2@example.com>',
+                                              'From test <from3@example.com>'])
+
     def test_add_multi_authors(self):
         mt = MailTree('abc@efg')
         mt.add_author('author1@example.com')
@@ -92,6 +123,12 @@ class TestMailTree(unittest.TestCase):
 
         self.assertEqual(mt.authors, ['author1@example.com', 'author2@example.com'])
 
+    def test_authors_are_shared_with_nodes(self):
+        mt = MailTree('abcd1@example.com', self.msgA)
+        mt.addChild(self.msgB)
+
+        self.assertTrue(mt.add_author('From test <from1@example.com>') is mt.parent.author)
+
     def test_add_encoded_author(self):
         mt = MailTree('abc@efg')
 
@@ -344,6 +381,226 @@ class TestMailForest(unittest.TestCase):
         self.assertEqual(mf['abcd1@example.com'].nodes['abcd2@example.com'].children[0].message_id, "abcd5@example.com")
         self.assertEqual(len(mf['abcd1@example.com'].nodes['abcd2@example.com'].children), 1)
 
+    def test_parent_key_compresses_path(self):
+        mf = MailForest()
+        mf.keys = {'a': 'b', 'b': 'c', 'c': 'd', 'd': 'd'}
+
+        self.assertEqual(mf.parent_key('a'), 'd')
+        self.assertEqual(mf.keys, {'a': 'd', 'b': 'd', 'c': 'd', 'd': 'd'})
+
+    def test_graft_smaller_into_larger(self):
+        msgF = Message()
+        msgF['From'] = 'From test <from6@example.com>'
+        msgF['Message-Id'] = '<abcd6@example.com>'
+        msgF['In-Reply-To'] = '<abcd2@example.com>'
+
+        mf = MailForest()
+        mf.fill_tree([self.msgE, msgF])
+        self.assertEqual(len(mf), 1)
+        mf.fill_tree([self.msgB])
+
+        self.assertEqual(len(mf), 1)
+        self.assertEqual(mf.parent_key('abcd1@example.com'), 'abcd2@example.com')
+        self.assertEqual(mf.sizes, {'abcd2@example.com': 4})
+
+        tree = mf['abcd5@example.com']
+        self.assertEqual(tree.message_id, 'abcd1@example.com')
+        self.assertEqual(tree.parent.message_id, 'abcd1@example.com')
+        self.assertEqual(tree.nodes['abcd1@example.com'].children[0].message_id, "abcd2@example.com")
+        self.assertEqual(len(tree.nodes['abcd2@example.com'].children), 2)
+
+    def test_later_reference_joins_trees(self):
+        del self.msgE['References']
+        self.msgE['References'] = '<abcd6@example.com> <abcd2@example.com>'
+
+        mf = MailForest()
+        mf.fill_tree([self.msgA, self.msgB, self.msgE])
+
+        self.assertEqual(len(mf), 1)
+        self.assertEqual(mf['abcd1@example.com'].message_id, 'abcd6@example.com')
+        self.assertEqual(mf['abcd2@example.com'].nodes['abcd2@example.com'].children[0].message_id, "abcd5@example.com")
+
+    def test_root_arrives_after_being_referenced(self):
+        mf = MailForest()
+        mf.fill_tree([self.msgD, self.msgA])
+
+        self.assertEqual(len(mf), 1)
+        self.assertEqual(mf['abcd4@example.com'].parent.author, "From test <from1@example.com>")
+
+    def test_pruned_trees(self):
+        mf = MailForest()
+        mf.fill_tree([self.msgE, self.msgC, self.msgD])
+
+        self.assertEqual(sorted(mf.pruned_trees()), ['abcd1@example.com'])
+        self.assertTrue(mf.pruned_trees()['abcd1@example.com'] is mf['abcd5@example.com'])
+
+        mf.pruned_trees().clear()
+        self.assertEqual(sorted(mf.roots), ['abcd1@example.com'])
+
+    def test_graft_trees(self):
+        mf = MailForest()
+        mf.fill_tree([self.msgA, self.msgE])
+
+        tree = mf.graft('abcd1@example.com', 'abcd5@example.com')
+        self.assertEqual(len(mf), 1)
+        self.assertTrue(mf['abcd5@example.com'] is tree)
+        self.assertEqual([n.message_id for n in tree.parent.children], ['abcd2@example.com'])
+        self.assertEqual(tree.orphans(), [])
+        self.assertTrue(mf.graft('abcd2@example.com', 'abcd5@example.com') is tree)
+        self.assertRaises(IndexError, mf.graft, 'abcd1@example.com', 'missing@example.com')
+
+    def test_graft_author_order(self):
+        # Every reply arrives before its parent, each pair grafted into the chain
+        messages = []
+        for n in range(0, 400, 2):
+            for k in (n + 1, n):
+                m = Message()
+                m['From'] = 'From test <from%d@example.com>' % (k % 150)
+                m['Message-Id'] = '<chain%d@example.com>' % k
+                if k:
+                    m['In-Reply-To'] = '<chain%d@example.com>' % (k - 1)
+                messages.append(m)
+
+        mf = MailForest()
+        mf.fill_tree(messages)
+
+        self.assertEqual(len(mf), 1)
+        authors = []
+        for m in messages:
+            if m['From'] not in authors:
+                authors.append(m['From'])
+        self.assertEqual(list(mf['chain0@example.com'].authors), authors)
+
+    def test_long_reversed_chain(self):
+        messages = []
+        for n in range(9999, -1, -1):
+            m = Message()
+            m['From'] = 'From test <from%d@example.com>' % (n % 100)
+            m['Message-Id'] = '<chain%d@example.com>' % n
+            if n:
+                m['In-Reply-To'] = '<chain%d@example.com>' % (n - 1)
+            messages.append(m)
+
+        mf = MailForest()
+        mf.fill_tree(messages)
+
+        self.assertEqual(len(mf), 1)
+        tree = mf['chain5000@example.com']
+        self.assertEqual(tree.parent.message_id, 'chain0@example.com')
+        self.assertEqual(len(tree.nodes), 10000)
+        self.assertEqual(len(tree.authors), 100)
+        self.assertEqual(tree.nodes['chain5000@example.com'].children[0].message_id, 'chain5001@example.com')
+
+
+class TestWalk(unittest.TestCase):
+    def message(self, msg_id, in_reply_to=None, date=None):
+        msg = Message()
+        msg['From'] = 'Author <author@example.com>'
+        msg['Message-Id'] = '<%s>' % msg_id
+        if in_reply_to:
+            msg['In-Reply-To'] = '<%s>' % in_reply_to
+        if date:
+            msg['Date'] = date
+        return msg
+
+    def forest(self, *messages):
+        mf = MailForest()
+        mf.fill_tree(self.message(*m) for m in messages)
+        return mf
+
+    def walk(self, walk, **kwargs):
+        return [(d, n.message_id) for d, n in walk(**kwargs)]
+
+    def test_depth_first(self):
+        mt = self.forest(('a',), ('b', 'a'), ('c', 'b'), ('d', 'a'), ('e', 'c'))['a']
+
+        self.assertEqual(self.walk(mt.depth_first),
+                         [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'e'), (1, 'd')])
+        self.assertEqual([n.message_id for n in mt.walk_tree()], ['a', 'b', 'c', 'e', 'd'])
+        self.assertEqual(self.walk(mt.walk), self.walk(mt.depth_first))
+
+    def test_breadth_first(self):
+        mt = self.forest(('a',), ('b', 'a'), ('c', 'b'), ('d', 'a'), ('e', 'c'))['a']
+
+        self.assertEqual(self.walk(mt.breadth_first),
+                         [(0, 'a'), (1, 'b'), (1, 'd'), (2, 'c'), (3, 'e')])
+
+    def test_start(self):
+        mt = self.forest(('a',), ('b', 'a'), ('c', 'b'), ('d', 'a'))['a']
+
+        self.assertEqual(self.walk(mt.depth_first, start=mt.nodes['b']),
+                         [(0, 'b'), (1, 'c')])
+
+    def test_order(self):
+        mt = self.forest(('a',),
+                         ('b', 'a', 'Mon, 01 Jan 2001 12:00:00 +0000'),
+                         ('c', 'a', 'Mon, 01 Jan 2001 12:00:00 +0200'),
+                         ('d', 'a'))['a']
+
+        self.assertEqual(mt.nodes['c'].date, 978343200.0)
+        self.assertEqual(mt.nodes['d'].date, None)
+
+        self.assertEqual(self.walk(mt.depth_first, order='date'),
+                         [(0, 'a'), (1, 'c'), (1, 'b'), (1, 'd')])
+        self.assertEqual(self.walk(mt.breadth_first, order='arrival'),
+                         [(0, 'a'), (1, 'b'), (1, 'c'), (1, 'd')])
+        self.assertEqual(self.walk(mt.depth_first, order=lambda n: -ord(n.message_id)),
+                         [(0, 'a'), (1, 'd'), (1, 'c'), (1, 'b')])
+        self.assertRaises(ValueError, list, mt.depth_first(order='size'))
+
+    def test_invalid_date(self):
+        mt = self.forest(('a', None, 'not a date'))['a']
+
+        self.assertEqual(mt.parent.date, None)
+
+    def test_cycle(self):
+        mt = self.forest(('a',), ('b', 'a'), ('c', 'b'))['a']
+        mt.nodes['c'].children.append(mt.nodes['a'])
+
+        self.assertEqual(self.walk(mt.depth_first), [(0, 'a'), (1, 'b'), (2, 'c')])
+        self.assertEqual(self.walk(mt.breadth_first), [(0, 'a'), (1, 'b'), (2, 'c')])
+        self.assertEqual([(n.message_id, c.message_id) for n, c in mt.cycles()],
+                         [('c', 'a')])
+
+    def test_orphans(self):
+        # b never arrives, so nothing links c to the root
+        mf = MailForest()
+        mf.fill_tree([self.message('a')])
+        msg = self.message('c', 'b')
+        msg['References'] = '<a> <b>'
+        mf.add_message(msg)
+        mf.add_message(self.message('d', 'c'))
+        mt = mf['a']
+
+        self.assertEqual(self.walk(mt.depth_first), [(0, 'a')])
+        self.assertEqual([n.message_id for n in mt.orphans()], ['b'])
+        self.assertEqual(self.walk(mt.depth_first, start=mt.orphans()[0]),
+                         [(0, 'b'), (1, 'c'), (2, 'd')])
+        self.assertEqual(mt.cycles(), [])
+        self.assertEqual(self.walk(mt.walk), [(0, 'a'), (0, 'b'), (1, 'c'), (2, 'd')])
+
+    def test_detached_cycle(self):
+        mt = self.forest(('a',), ('b', 'a'))['a']
+        for key in ('x', 'y'):
+            mt._add_node(key)
+        mt.nodes['x'].children.append(mt.nodes['y'])
+        mt.nodes['y'].children.append(mt.nodes['x'])
+
+        self.assertEqual([n.message_id for n in mt.orphans()], ['x'])
+        self.assertEqual(len(mt.cycles()), 1)
+
+    def test_no_orphans(self):
+        mt = self.forest(('a',), ('b', 'a'))['a']
+
+        self.assertEqual(mt.orphans(), [])
+
+    def test_pickle_keeps_order(self):
+        mt = self.forest(('a',), ('b', 'a', 'Mon, 01 Jan 2001 12:00:00 +0000'))['a']
+        copy = pickle.loads(pickle.dumps(mt, 2))
+
+        self.assertEqual(copy.nodes['b'].date, 978350400.0)
+        self.assertEqual(copy.nodes['b'].seq, mt.nodes['b'].seq)
+
 
 class TestMessageIDParser(unittest.TestCase):
     def test_simple(self):
@@ -380,3 +637,118 @@ class TestMessageIDParser(unittest.TestCase):
 
         self.assertTrue(isinstance(ret, list))
         self.assertEqual(ret, [])
+
+    def test_none(self):
+        self.assertEqual(parse_message_ids(None), [])
+
+    def test_brackets_in_comment(self):
+        ids = "<abc@efg> (see <not@an-id> (nested <also@not>)) <blah@narf>"
+
+        self.assertEqual(parse_message_ids(ids), ['abc@efg', 'blah@narf'])
+
+    def test_quoted_string(self):
+        ids = '"Someone <not@an-id>" <abc@efg> <"quoted>local"@efg>'
+
+        self.assertEqual(parse_message_ids(ids), ['abc@efg', '"quoted>local"@efg'])
+
+    def test_folded_id(self):
+        ids = "<abc@\n\tefg> < jhk@efg >"
+
+        self.assertEqual(parse_message_ids(ids), ['abc@efg', 'jhk@efg'])
+
+    def test_domain_case(self):
+        ids = "<ABC@Example.COM>"
+
+        self.assertEqual(parse_message_ids(ids), ['ABC@example.com'])
+
+    def test_missing_close(self):
+        ids = "<abc@efg <efg@efg> <jhk@efg"
+
+        self.assertEqual(parse_message_ids(ids), ['abc@efg', 'efg@efg', 'jhk@efg'])
+
+    def test_empty_id(self):
+        self.assertEqual(parse_message_ids("<> < > <abc@efg>"), ['abc@efg'])
+
+
+class TestMessageIds(unittest.TestCase):
+    def test_message_ids(self):
+        msg = Message()
+        msg['Message-Id'] = '<abcd3@example.com>'
+        msg['References'] = '<abcd1@example.com> <abcd3@example.com>'
+        msg['In-Reply-To'] = '<abcd2@example.com>'
+
+        ids = message_ids(msg)
+        self.assertEqual(ids.message_id, 'abcd3@example.com')
+        self.assertEqual(ids.references, ['abcd1@example.com', 'abcd2@example.com'])
+        self.assertEqual(ids.in_reply_to, ['abcd2@example.com'])
+
+    def test_no_message_id(self):
+        self.assertEqual(message_ids(Message()).message_id, None)
+
+
+class TestHeaderCache(unittest.TestCase):
+    def test_decode(self):
+        cache = HeaderCache()
+
+        self.assertEqual(cache.get('=?utf-8?b?xZrDtsacxJMgxYXEg23EkyA8bmFtZUBleGFtcGxlLmNvbT4=?='),
+                         u'ŚöƜē Ņămē <name@example.com>')
+        self.assertEqual(cache.get('Plain <plain@example.com>'), u'Plain <plain@example.com>')
+        self.assertEqual(cache.get(None), u'')
+
+    def test_counters(self):
+        cache = HeaderCache()
+        first = cache.get('=?iso-8859-1?q?Andr=E9?=')
+        second = cache.get('=?iso-8859-1?q?Andr=E9?=')
+
+        self.assertTrue(first is second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = HeaderCache(2)
+        cache.get('a')
+        cache.get('b')
+        cache.get('a')
+        cache.get('c')
+
+        self.assertEqual(len(cache), 2)
+        cache.get('a')
+        cache.get('c')
+        self.assertEqual(cache.misses, 3)
+        cache.get('b')
+        self.assertEqual(cache.misses, 4)
+
+    def test_resize(self):
+        cache = HeaderCache()
+        for header in 'abcdef':
+            cache.get(header)
+        cache.resize(3)
+
+        self.assertEqual(len(cache), 3)
+        cache.get('f')
+        self.assertEqual(cache.hits, 1)
+
+    def test_disabled(self):
+        cache = HeaderCache(0)
+        cache.get('a')
+        cache.get('a')
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 2)
+
+    def test_unknown_charset(self):
+        self.assertEqual(get_header('=?x-no-such-charset?q?abc?='), u'abc')
+
+    def test_not_a_charset(self):
+        for codec in ('hex', 'zlib', 'base64', 'rot13', 'idna', 'undefined'):
+            self.assertEqual(get_header('=?%s?q?zz?= <a@b>' % codec), u'zz<a@b>')
+
+        msg = Message()
+        msg['From'] = '=?hex?q?zz?= <a@b>'
+        msg['Message-Id'] = '<a@b>'
+        forest = MailForest()
+        forest.fill_tree([msg])
+        self.assertEqual(forest['a@b'].parent.author, u'zz<a@b>')
+
+    def test_invalid_bytes(self):
+        self.assertEqual(get_header('=?utf-8?q?caf=E9?='), u'caf\ufffd')
+        self.assertEqual(get_header('caf\xe9'), u'caf\ufffd')
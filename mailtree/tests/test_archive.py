@@ -0,0 +1,149 @@
+from mailtree import MailForest
+from mailtree.archive import build_archive, page_name, tree_hash, MANIFEST
+from mailtree.scanner import scan_mbox
+from mailtree.tests.test_parallel import write_corpus
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def pages(path):
+    ret = {}
+    for folder, dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(folder, name)
+            with open(full, 'rb') as f:
+                ret[os.path.relpath(full, path)] = f.read()
+
+    return ret
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mbox = os.path.join(self.dir, 'archive.mbox')
+        self.out = os.path.join(self.dir, 'html')
+        write_corpus(self.mbox, count=120)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def forest(self):
+        forest = MailForest()
+        forest.fill_tree(scan_mbox(self.mbox))
+        return forest
+
+    def append(self, msg_id, in_reply_to=None, subject='Re: thread', body='Body\n',
+               content_type=None):
+        with open(self.mbox, 'a') as f:
+            f.write('From author@example.com Mon Jan  1 00:00:00 2001\n')
+            f.write('From: Late <late@example.com>\n')
+            f.write('Date: Tue, 02 Jan 2001 10:00:00 +0000\n')
+            f.write('Message-Id: <%s>\n' % msg_id)
+            f.write('Subject: %s\n' % subject)
+            if in_reply_to:
+                f.write('In-Reply-To: <%s>\n' % in_reply_to)
+            if content_type:
+                f.write('Content-Type: %s\n' % content_type)
+            f.write('\n%s\n' % body)
+
+    def test_pages(self):
+        self.append('new@example.com', subject='<b>Tags</b>', body='x < y & z')
+        forest = self.forest()
+        report = build_archive(forest, self.out, workers=1)
+
+        self.assertEqual(report.rendered, len(forest))
+        self.assertEqual(report.months, 1)
+        written = pages(self.out)
+        self.assertTrue('index.html' in written)
+        self.assertTrue(MANIFEST in written)
+        self.assertTrue(os.path.join('months', '2001-01.html') in written)
+        for root in forest.roots:
+            self.assertTrue(os.path.join('threads', page_name(root) + '.html') in written)
+        for key, node in forest.keys.iteritems():
+            node = forest.node(key)
+            self.assertEqual(os.path.join('messages', page_name(key) + '.html') in written,
+                             not node.isEmpty)
+
+        page = written[os.path.join('messages', page_name('new@example.com') + '.html')]
+        self.assertTrue('&lt;b&gt;Tags&lt;/b&gt;' in page)
+        self.assertTrue('x &lt; y &amp; z' in page)
+
+    def test_unknown_charset(self):
+        for n, charset in enumerate(('x-no-such-charset', 'zlib', 'hex', 'base64')):
+            self.append('new%d@example.com' % n, body='caf\xc3\xa9',
+                        content_type='text/plain; charset="%s"' % charset)
+        build_archive(self.forest(), self.out, workers=1)
+
+        for n in range(4):
+            name = page_name('new%d@example.com' % n) + '.html'
+            with open(os.path.join(self.out, 'messages', name)) as f:
+                self.assertTrue('caf\xc3\xa9' in f.read())
+
+    def test_unchanged(self):
+        build_archive(self.forest(), self.out, workers=1)
+        before = pages(self.out)
+
+        report = build_archive(self.forest(), self.out, workers=1)
+        self.assertEqual(report.rendered, 0)
+        self.assertEqual(report.months, 0)
+        self.assertEqual(pages(self.out), before)
+
+    def test_reply(self):
+        forest = self.forest()
+        build_archive(forest, self.out, workers=1)
+        root = forest['m0@example.com'].parent.message_id
+
+        self.append('reply@example.com', 'm0@example.com')
+        forest = self.forest()
+        report = build_archive(forest, self.out, workers=1)
+
+        self.assertEqual(report.rendered, 1)
+        self.assertEqual(report.unchanged, len(forest) - 1)
+        with open(os.path.join(self.out, 'threads', page_name(root) + '.html')) as f:
+            self.assertTrue(page_name('reply@example.com') in f.read())
+
+    def test_graft(self):
+        forest = self.forest()
+        build_archive(forest, self.out, workers=1)
+        roots = sorted(forest.roots)
+        absorbed = roots[1]
+        thread = os.path.join(self.out, 'threads', page_name(absorbed) + '.html')
+        self.assertTrue(os.path.exists(thread))
+
+        forest.graft(roots[0], absorbed)
+        report = build_archive(forest, self.out, workers=1)
+
+        self.assertEqual(report.rendered, 1)
+        self.assertEqual(report.removed, 1)
+        self.assertFalse(os.path.exists(thread))
+
+    def test_workers(self):
+        forest = self.forest()
+        serial = os.path.join(self.dir, 'serial')
+        build_archive(forest, serial, workers=1)
+        build_archive(forest, self.out, workers=2)
+
+        self.assertEqual(pages(self.out), pages(serial))
+
+    def test_force(self):
+        forest = self.forest()
+        build_archive(forest, self.out, workers=1)
+        report = build_archive(forest, self.out, workers=1, force=True)
+
+        self.assertEqual(report.rendered, len(forest))
+
+    def test_tree_hash(self):
+        forest = self.forest()
+        tree = forest['m0@example.com']
+        digest = tree_hash(tree)
+
+        self.assertEqual(tree_hash(self.forest()['m0@example.com']), digest)
+        self.append('reply@example.com', 'm0@example.com')
+        self.assertNotEqual(tree_hash(self.forest()['m0@example.com']), digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+from mailtree import MailForest
+from mailtree.cli import main, thread_record
+from mailtree.scanner import scan_mbox
+from mailtree.snapshot import load_forest
+from mailtree.tests.test_parallel import write_corpus
+
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mbox = os.path.join(self.dir, 'archive.mbox')
+        self.output = os.path.join(self.dir, 'out.jl')
+        write_corpus(self.mbox, count=200)
+
+        self.serial = MailForest()
+        self.serial.fill_tree(scan_mbox(self.mbox))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_cli(self, *args):
+        self.assertEqual(main(['-o', self.output] + list(args)), 0)
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def expected(self):
+        return dict((root, json.loads(json.dumps(thread_record(tree))))
+                    for root, tree in self.serial.roots.items())
+
+    def test_threads(self):
+        lines = self.run_cli(self.mbox)
+
+        self.assertEqual(dict((r['root'], r) for r in lines), self.expected())
+        self.assertEqual(len(lines), len(self.serial))
+
+    def test_window(self):
+        lines = self.run_cli('--window', '5', self.mbox)
+
+        # Later lines replace earlier ones and merged threads go away
+        threads = {}
+        for record in lines:
+            if 'merged_into' in record:
+                del threads[record['root']]
+            else:
+                threads[record['root']] = record
+        self.assertEqual(threads, self.expected())
+        self.assertTrue(len(lines) > len(self.serial))
+
+    def test_messages(self):
+        lines = self.run_cli('--format', 'message', self.mbox)
+        by_id = dict((r['message_id'], r) for r in lines)
+
+        self.assertEqual(len(lines), len(self.serial.keys))
+        self.assertEqual(set(by_id), set(self.serial.keys))
+        for record in lines:
+            self.assertEqual(record['root'], self.serial[record['message_id']].parent.message_id)
+            if record['parent'] is None:
+                continue
+            parent = by_id[record['parent']]
+            self.assertEqual(record['depth'], parent['depth'] + 1)
+            self.assertEqual(record['root'], parent['root'])
+
+    def test_sources(self):
+        other = os.path.join(self.dir, 'other.mbox')
+        write_corpus(other, count=50, seed=4)
+        self.serial.fill_tree(scan_mbox(other))
+
+        lines = self.run_cli('--workers', '2', self.mbox, other)
+        self.assertEqual(dict((r['root'], r) for r in lines), self.expected())
+
+    def test_snapshot(self):
+        snapshot = os.path.join(self.dir, 'forest.snap')
+        self.run_cli('--snapshot', snapshot, self.mbox)
+
+        self.assertEqual(sorted(load_forest(snapshot).roots), sorted(self.serial.roots))
+
+    def test_incremental(self):
+        snapshot = os.path.join(self.dir, 'forest.snap')
+        with open(self.mbox) as f:
+            data = f.read()
+        half = data.index('\nFrom ', len(data) // 2) + 1
+        with open(self.mbox, 'w') as f:
+            f.write(data[:half])
+
+        first = self.run_cli('--incremental', '--snapshot', snapshot, self.mbox)
+        self.assertTrue(os.path.exists(snapshot + '.state'))
+        self.assertEqual(self.run_cli('-i', '-s', snapshot, self.mbox), [])
+
+        with open(self.mbox, 'a') as f:
+            f.write(data[half:])
+        second = self.run_cli('-i', '-s', snapshot, self.mbox)
+
+        # Every thread of the second run is whole, none is written twice
+        expected = self.expected()
+        roots = [r['root'] for r in second]
+        self.assertEqual(len(roots), len(set(roots)))
+        for record in second:
+            self.assertEqual(record, expected[record['root']])
+        self.assertTrue(0 < len(second) < len(expected))
+        self.assertEqual(sorted(load_forest(snapshot).roots), sorted(expected))
+
+    def test_errors(self):
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.check_errors()
+        finally:
+            sys.stderr = stderr
+
+    def check_errors(self):
+        self.assertRaises(SystemExit, main, [])
+        self.assertRaises(SystemExit, main, ['--incremental', self.mbox])
+        self.assertRaises(SystemExit, main, ['--window', '0', self.mbox])
+        self.assertEqual(main(['-o', self.output, os.path.join(self.dir, 'missing')]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+from mailtree import MailForest
+from mailtree.columns import export_forest, numpy
+from mailtree.indexes import author_key
+from mailtree.tests import message, DAY
+from mailtree.tests.test_indexes import corpus
+
+import unittest
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestColumns(unittest.TestCase):
+    def setUp(self):
+        self.forest = MailForest()
+        self.forest.fill_tree(corpus())
+        self.columns = export_forest(self.forest)
+
+    def walk(self):
+        """(root, depth, node, subtree) of every node, the slow way"""
+        ret = []
+        for root in sorted(self.forest.roots):
+            tree = self.forest.roots[root]
+            for depth, node in tree.walk():
+                subtree = [n for d, n in tree.depth_first(start=node) if not n.isEmpty]
+                ret.append((root, depth, node, len(subtree)))
+
+        return ret
+
+    def test_rows(self):
+        columns = self.columns
+        walk = self.walk()
+
+        self.assertEqual(len(columns), len(self.forest.keys))
+        self.assertEqual(columns.message_ids[:len(walk)], [n.message_id for r, d, n, s in walk])
+        self.assertEqual(list(columns.depth[:len(walk)]), [d for r, d, n, s in walk])
+        for row, (root, depth, node, size) in enumerate(walk):
+            self.assertEqual(columns.message_ids[columns.root[row]], root)
+            if depth:
+                parent = columns.parent[row]
+                self.assertTrue(node in self.forest.node(columns.message_ids[parent]).children)
+            if not node.isEmpty:
+                self.assertEqual(columns.date[row], node.date)
+                self.assertEqual(columns.authors[columns.author[row]], author_key(node.author))
+
+    def test_subtree_sizes(self):
+        sizes = self.columns.subtree_sizes()
+        for row, (root, depth, node, size) in enumerate(self.walk()):
+            self.assertEqual(sizes[row], size)
+
+    def test_threads(self):
+        columns = self.columns
+        roots = columns.roots()
+
+        self.assertEqual([columns.message_ids[r] for r in roots], sorted(self.forest.roots))
+        self.assertEqual(list(columns.thread_sizes()),
+                         [sum(1 for n in self.forest.roots[r].nodes.values() if not n.isEmpty)
+                          for r in sorted(self.forest.roots)])
+        self.assertEqual(columns.thread_depths().max(), columns.depth[~columns.empty].max())
+
+    def test_depth_histogram(self):
+        histogram = {}
+        for root, depth, node, size in self.walk():
+            if not node.isEmpty:
+                histogram[depth] = histogram.get(depth, 0) + 1
+
+        self.assertEqual(list(self.columns.depth_histogram()),
+                         [histogram.get(d, 0) for d in range(max(histogram) + 1)])
+
+    def test_time_to_first_reply(self):
+        forest = MailForest()
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 3, ['a']),
+                          message('c', 'z', 2, ['a']), message('d', 'x', 5, ['a', 'c']),
+                          message('e', 'y', 4)])
+        columns = export_forest(forest)
+        latency = dict(zip(columns.message_ids, columns.time_to_first_reply()))
+
+        self.assertEqual(latency['a'], DAY)
+        self.assertEqual(latency['c'], 3 * DAY)
+        self.assertTrue(numpy.isnan(latency['b']))
+        self.assertTrue(numpy.isnan(latency['e']))
+
+        replies = dict(zip(columns.authors, columns.replies_by_author()))
+        self.assertEqual(replies, {'x@example.com': 1, 'y@example.com': 1,
+                                   'z@example.com': 1})
+        messages = dict(zip(columns.authors, columns.messages_by_author()))
+        self.assertEqual(messages['x@example.com'], 2)
+
+    def test_empty(self):
+        columns = export_forest(MailForest())
+
+        self.assertEqual(len(columns), 0)
+        self.assertEqual(len(columns.subtree_sizes()), 0)
+        self.assertEqual(len(columns.roots()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
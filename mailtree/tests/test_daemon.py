@@ -0,0 +1,265 @@
+from mailtree.daemon import IngestService, parse_message
+from mailtree.tests import message_text, FROM_LINE
+
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+
+class Sender(threading.Thread):
+    """Runs a function in the background while the test polls the service"""
+    def __init__(self, func):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
+
+
+class TestIngestService(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.service = IngestService(batch_size=50, max_delay=0.01)
+        self.changes = []
+        self.service.subscribers.append(self.changes.append)
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.dir)
+
+    def run_sender(self, func):
+        sender = Sender(func)
+        sender.start()
+        deadline = time.time() + 10
+        while sender.is_alive() and time.time() < deadline:
+            self.service.poll(0.01)
+        sender.join(1)
+        for i in range(5):
+            self.service.poll(0.01)
+
+        if sender.error is not None:
+            raise sender.error
+        return sender.result
+
+    def created(self):
+        return set().union(*[c.created for c in self.changes])
+
+    def test_smtp(self):
+        server = self.service.listen(('127.0.0.1', 0))
+
+        def send():
+            client = smtplib.SMTP(*server.address)
+            client.sendmail('a@example.com', ['list@example.com'],
+                            message_text('a@example.com'))
+            client.sendmail('b@example.com', ['list@example.com'],
+                            message_text('b@example.com', 'a@example.com'))
+            client.quit()
+
+        self.run_sender(send)
+
+        self.assertEqual(self.service.received, 2)
+        self.assertEqual(len(self.service.forest), 1)
+        self.assertEqual(self.service.forest['b@example.com'].parent.message_id, 'a@example.com')
+        self.assertEqual(self.created(), set(['a@example.com']))
+
+    def test_lmtp(self):
+        path = os.path.join(self.dir, 'lmtp.sock')
+        self.service.listen(path, lmtp=True)
+
+        def send():
+            client = smtplib.LMTP(path)
+            client.sendmail('a@example.com', ['x@example.com'], message_text('a@example.com'))
+            client.sendmail('a@example.com', ['x@example.com'], 'Subject: none\n\nbody\n')
+            client.sendmail('a@example.com', ['x@example.com'], 'Subject: none\n\nother\n')
+            client.quit()
+
+        self.run_sender(send)
+        self.assertEqual(self.service.received, 3)
+        self.assertTrue('a@example.com' in self.service.forest.keys)
+        # Messages without a Message-Id are given one from their content
+        self.assertEqual(self.service.forest.dedup.synthesised, 2)
+        self.assertEqual(len(self.service.forest), 3)
+
+    def test_lmtp_reply_per_recipient(self):
+        # smtplib only reads one reply after DATA, so talk LMTP by hand
+        path = os.path.join(self.dir, 'lmtp.sock')
+        self.service.listen(path, lmtp=True)
+
+        def send():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall('LHLO test\r\nMAIL FROM:<a@example.com>\r\n'
+                         'RCPT TO:<x@example.com>\r\nRCPT TO:<y@example.com>\r\nDATA\r\n' +
+                         message_text('a@example.com').replace('\n', '\r\n') + '.\r\nQUIT\r\n')
+            data = ''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            return data
+
+        self.assertEqual(self.run_sender(send).count('250 2.0.0 Ok: queued'), 2)
+        self.assertEqual(self.service.received, 1)
+
+    def test_lmtp_needs_lhlo(self):
+        server = self.service.listen(('127.0.0.1', 0), lmtp=True)
+
+        def send():
+            client = smtplib.SMTP(*server.address)
+            code = client.helo()[0]
+            client.quit()
+            return code
+
+        self.assertEqual(self.run_sender(send), 500)
+
+    def test_empty_data(self):
+        server = self.service.listen(('127.0.0.1', 0))
+
+        def send():
+            sock = socket.create_connection(server.address)
+            sock.sendall('HELO test\r\nMAIL FROM:<a@example.com>\r\n'
+                         'RCPT TO:<list@example.com>\r\nDATA\r\n.\r\nQUIT\r\n')
+            data = ''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            return data
+
+        replies = self.run_sender(send)
+        self.assertEqual(replies.count('250 2.0.0 Ok: queued'), 1)
+        self.assertTrue('221' in replies)
+        self.assertEqual(self.service.received, 1)
+
+    def test_pipelined_sender(self):
+        # A stand-in MTA writing every command at once without waiting
+        server = self.service.listen(('127.0.0.1', 0))
+        count = 300
+
+        def send():
+            sock = socket.create_connection(server.address)
+            commands = ['EHLO test']
+            for n in range(count):
+                parent = 'm%d@example.com' % (n // 2) if n else None
+                body = message_text('m%d@example.com' % n, parent)
+                commands += ['MAIL FROM:<a@example.com>', 'RCPT TO:<list@example.com>', 'DATA',
+                             body.replace('\n', '\r\n').replace('\r\n.', '\r\n..') + '.']
+            commands.append('QUIT')
+            sock.sendall('\r\n'.join(commands) + '\r\n')
+
+            data = ''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            return data
+
+        replies = self.run_sender(send)
+
+        self.assertEqual(replies.count('250 2.0.0 Ok: queued'), count)
+        self.assertEqual(self.service.received, count)
+        self.assertEqual(len(self.service.forest), 1)
+        self.assertTrue(len(self.changes) > 1)
+
+    def test_spool(self):
+        spool = os.path.join(self.dir, 'spool')
+        os.makedirs(os.path.join(spool, 'new'))
+        self.service.watch(spool, interval=0.01)
+
+        with open(os.path.join(spool, '1'), 'w') as f:
+            f.write(FROM_LINE + message_text('a@example.com'))
+        with open(os.path.join(spool, 'new', '2'), 'w') as f:
+            f.write(message_text('b@example.com', 'a@example.com'))
+        with open(os.path.join(spool, '.3'), 'w') as f:
+            f.write(message_text('c@example.com'))
+
+        for i in range(5):
+            self.service.poll(0.02)
+
+        self.assertEqual(self.service.received, 2)
+        self.assertEqual(sorted(os.listdir(spool)), ['.3', 'new'])
+        self.assertEqual(os.listdir(os.path.join(spool, 'new')), [])
+        self.assertEqual(self.service.forest['b@example.com'].parent.message_id, 'a@example.com')
+
+    def test_spool_kept_until_threaded(self):
+        spool = os.path.join(self.dir, 'spool')
+        os.makedirs(spool)
+        spooler = self.service.watch(spool)
+        self.service.max_delay = 60
+
+        with open(os.path.join(spool, '1'), 'w') as f:
+            f.write(message_text('a@example.com'))
+        self.assertEqual(spooler.scan(), 1)
+        self.assertEqual(spooler.scan(), 0)
+        self.assertEqual(os.listdir(spool), ['1'])
+
+        self.service.flush()
+        self.assertEqual(os.listdir(spool), [])
+        self.assertEqual(spooler.queued, set())
+        self.assertTrue('a@example.com' in self.service.forest.keys)
+
+    def test_spool_kept_when_threading_fails(self):
+        spool = os.path.join(self.dir, 'spool')
+        os.makedirs(spool)
+        spooler = self.service.watch(spool)
+        self.service.max_delay = 60
+
+        with open(os.path.join(spool, '1'), 'w') as f:
+            f.write(message_text('a@example.com'))
+        self.assertEqual(spooler.scan(), 1)
+
+        def fail(messages):
+            raise IOError('disk full')
+        self.service.forest.fill_tree = fail
+        self.assertRaises(IOError, self.service.flush)
+        self.assertEqual(len(self.service.queue), 1)
+        self.assertEqual(os.listdir(spool), ['1'])
+
+        del self.service.forest.fill_tree
+        self.service.flush()
+        self.assertEqual(os.listdir(spool), [])
+        self.assertEqual(spooler.queued, set())
+        self.assertTrue('a@example.com' in self.service.forest.keys)
+
+    def test_batching(self):
+        self.service.max_delay = 60
+        for n in range(120):
+            self.service.submit(message_text('m%d@example.com' % n))
+
+        self.assertEqual(len(self.changes), 2)
+        self.assertEqual(len(self.service.queue), 20)
+
+        self.service.close()
+        self.assertEqual(len(self.changes), 3)
+        self.assertEqual(len(self.service.forest), 120)
+
+    def test_max_delay(self):
+        self.service.submit(message_text('a@example.com'))
+        self.assertEqual(self.changes, [])
+
+        time.sleep(0.02)
+        self.service.poll(0)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_parse_message(self):
+        record = parse_message('Message-Id: <a@b>\r\nSubject: x\r\n\r\nMessage-Id: <c@d>\r\n')
+
+        self.assertEqual(record.get('Message-Id'), '<a@b>')
+        self.assertEqual(parse_message('\nMessage-Id: <a@b>\n').headers, {})
@@ -0,0 +1,112 @@
+from mailtree import MailForest
+from mailtree.dedup import synthesise_id, Deduplicator
+from mailtree.scanner import scan_mbox
+from mailtree.sources import scan_stream
+from mailtree.tests import message
+
+import os
+import StringIO
+import tempfile
+import unittest
+
+
+def broken(msg_id, body):
+    msg = message(None, body=body)
+    msg['Message-Id'] = msg_id
+
+    return msg
+
+
+class TestDedup(unittest.TestCase):
+    def test_duplicates_skipped(self):
+        mf = MailForest()
+        events = []
+        mf.listeners.append(lambda event, tree, other: events.append(event))
+
+        first, reply = message('a@example.com'), message('b@example.com', in_reply_to='a@example.com')
+        mf.fill_tree([first, reply, message('a@example.com'), reply])
+        mf.fill_tree([message('a@example.com')])
+
+        self.assertEqual(mf.dedup.messages, 5)
+        self.assertEqual(mf.dedup.duplicates, 3)
+        self.assertEqual(mf.dedup.copies['a@example.com'], 2)
+        self.assertEqual(events.count('added'), 2)
+        self.assertEqual(len(mf['a@example.com'].nodes), 2)
+
+    def test_placeholder_is_not_a_duplicate(self):
+        mf = MailForest()
+        mf.fill_tree([message('b@example.com', in_reply_to='a@example.com'),
+                      message('a@example.com')])
+
+        self.assertEqual(mf.dedup.duplicates, 0)
+        self.assertFalse(mf['a@example.com'].parent.isEmpty)
+
+    def test_missing_and_broken_ids(self):
+        mf = MailForest()
+        mf.fill_tree([message(None, body='one'), broken('<>', 'two'),
+                      broken('no brackets', 'three'), message(None, body='one')])
+
+        self.assertEqual(mf.dedup.synthesised, 4)
+        self.assertEqual(mf.dedup.duplicates, 1)
+        self.assertEqual(len(mf), 3)
+        for key in mf.roots:
+            self.assertTrue(key.endswith('@mailtree.invalid'))
+
+    def test_synthesised_ids_are_stable(self):
+        one = synthesise_id(message(None, body='one'))
+
+        self.assertEqual(synthesise_id(message(None, body='one')), one)
+        self.assertNotEqual(synthesise_id(message(None, body='two')), one)
+        self.assertNotEqual(synthesise_id(message(None, body='one', subject='Other')), one)
+
+    def test_reply_to_synthesised(self):
+        mf = MailForest()
+        mf.fill_tree([message(None), message('b@example.com', in_reply_to='a@example.com')])
+
+        self.assertEqual(len(mf), 2)
+        self.assertEqual(mf.dedup.synthesised, 1)
+
+    def test_records_hash_their_body(self):
+        data = ''
+        for body in ('one', 'two', 'one'):
+            data += 'From a@example.com Mon Jan  1 00:00:00 2001\nSubject: Test\n\n%s\n\n' % body
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        try:
+            mf = MailForest()
+            mf.fill_tree(scan_mbox(path))
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(len(mf), 2)
+        self.assertEqual(mf.dedup.duplicates, 1)
+
+    def test_unreadable_records(self):
+        # A compressed mbox gives records with no source to read bodies from
+        data = ''
+        for body in ('one', 'other', 'one'):
+            data += 'From a@example.com Mon Jan  1 00:00:00 2001\nSubject: Test\n\n%s\n\n' % body
+
+        forests = [MailForest(), MailForest()]
+        for mf in forests:
+            mf.fill_tree(scan_stream(StringIO.StringIO(data)))
+
+        # Without their bodies they can't be told from copies, so all are kept
+        mf = forests[0]
+        self.assertEqual(len(mf), 3)
+        self.assertEqual(mf.dedup.duplicates, 0)
+        self.assertEqual(mf.dedup.synthesised, 3)
+        # and given the same ids every time
+        self.assertEqual(sorted(mf.roots), sorted(forests[1].roots))
+
+    def test_filter(self):
+        mf = MailForest()
+        dedup = Deduplicator(mf)
+        mf.fill_tree([message('a@example.com')])
+
+        kept = [ids.message_id for m, ids in dedup.filter([message('a@example.com'),
+                                                           message('c@example.com')])]
+        self.assertEqual(kept, ['c@example.com'])
+        self.assertEqual(dedup.duplicates, 1)
@@ -0,0 +1,92 @@
+from mailtree import MailForest
+from mailtree.incremental import update_mailtree, IngestState, ArchiveChanged
+from mailtree.tests import mbox_message
+
+import os
+import tempfile
+import unittest
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.append(mbox_message('a@example.com'), mbox_message('b@example.com', 'a@example.com'),
+                    mbox_message('d@example.com', 'c@example.com'))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def append(self, *messages):
+        with open(self.path, 'a') as f:
+            f.write(''.join(messages))
+
+    def test_first_run(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+
+        self.assertEqual(state.messages, 3)
+        self.assertEqual(changes.created, set(['a@example.com', 'c@example.com']))
+        self.assertEqual(changes.grafted, set())
+        self.assertEqual(changes.changed, set())
+        self.assertEqual(len(mf), 2)
+
+    def test_append(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+
+        self.append(mbox_message('e@example.com', 'b@example.com'),
+                    mbox_message('c@example.com', 'a@example.com'),
+                    mbox_message('f@example.com'))
+        state, changes = update_mailtree(mf, self.path, state)
+
+        self.assertEqual(state.messages, 6)
+        self.assertEqual(changes.created, set(['f@example.com']))
+        self.assertEqual(changes.grafted, set(['c@example.com']))
+        self.assertEqual(changes.changed, set(['a@example.com']))
+        self.assertEqual(len(mf), 2)
+        self.assertEqual(mf['d@example.com'].parent.message_id, 'a@example.com')
+
+    def test_nothing_appended(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+        again, changes = update_mailtree(mf, self.path, state)
+
+        self.assertTrue(again is state)
+        self.assertEqual(len(changes), 0)
+
+    def test_rewritten(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+
+        with open(self.path, 'w') as f:
+            f.write(mbox_message('x@example.com') * 3)
+
+        self.assertRaises(ArchiveChanged, update_mailtree, mf, self.path, state)
+
+    def test_truncated(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+
+        with open(self.path, 'w') as f:
+            f.write(mbox_message('a@example.com'))
+
+        self.assertRaises(ArchiveChanged, update_mailtree, mf, self.path, state)
+
+    def test_save_state(self):
+        mf = MailForest()
+        state, changes = update_mailtree(mf, self.path)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            state.save(path)
+            loaded = IngestState.load(path)
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(loaded.__dict__, state.__dict__)
+
+        self.append(mbox_message('f@example.com'))
+        state, changes = update_mailtree(mf, self.path, loaded)
+        self.assertEqual(changes.created, set(['f@example.com']))
@@ -0,0 +1,137 @@
+from mailtree import MailForest
+from mailtree.indexes import ForestIndex, author_key
+from mailtree.tests import message, DAY
+
+import random
+import unittest
+
+
+def corpus(count=300, seed=3):
+    rnd = random.Random(seed)
+    chains = []
+    for n in range(count):
+        if not chains or rnd.random() < 0.2:
+            chain = []
+        else:
+            parent = rnd.choice(chains[-30:])
+            chain = parent[1] + [parent[0]]
+        chains.append(('m%d' % n, chain))
+
+    messages = [message(msg_id, 'a%d' % rnd.randrange(8), n // 10, chain)
+                for n, (msg_id, chain) in enumerate(chains)]
+    rnd.shuffle(messages)
+
+    return messages
+
+
+def expected(forest):
+    """Build the indexes of forest from scratch"""
+    authors = {}
+    activity = {}
+    for root, tree in forest.roots.items():
+        for node in tree.nodes.values():
+            if node.isEmpty:
+                continue
+            authors.setdefault(author_key(node.author), set()).add(root)
+            span = activity.get(root, (node.date, node.date))
+            activity[root] = (min(span[0], node.date), max(span[1], node.date))
+
+    return authors, activity
+
+
+class TestForestIndex(unittest.TestCase):
+    def check(self, forest, index):
+        authors, activity = expected(forest)
+
+        self.assertEqual(index.authors, authors)
+        self.assertEqual(index.activity, activity)
+        self.assertEqual(index.dates, sorted((last, root) for root, (first, last)
+                                             in activity.items()))
+
+    def test_incremental(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        forest.fill_tree(corpus())
+
+        self.check(forest, index)
+
+    def test_existing_trees(self):
+        forest = MailForest()
+        forest.fill_tree(corpus())
+
+        self.check(forest, ForestIndex(forest))
+
+    def test_merge(self):
+        messages = corpus()
+        forest = MailForest()
+        index = ForestIndex(forest)
+        for start in range(0, len(messages), 70):
+            part = MailForest()
+            part.fill_tree(messages[start:start + 70])
+            forest.merge(part)
+
+        self.check(forest, index)
+
+    def test_close(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        index.close()
+        forest.fill_tree(corpus())
+
+        self.assertEqual(forest.listeners, [])
+        self.assertEqual(index.authors, {})
+
+    def test_threads_by_author(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 2, ['a']),
+                          message('c', 'y', 5), message('d', 'z', 3)])
+
+        trees = index.threads_by_author('Someone <Y@Example.com>')
+        self.assertEqual([t.parent.message_id for t in trees], ['c', 'a'])
+        self.assertEqual(index.threads_by_author('x@example.com'), [forest['a']])
+        self.assertEqual(index.threads_by_author('nobody@example.com'), [])
+
+    def test_graft_moves_postings(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        forest.fill_tree([message('b', 'y', 2, ['a']), message('c', 'z', 4, ['x'])])
+        forest.add_message(message('x', 'w', 3, ['b']))
+
+        self.assertEqual(len(forest), 1)
+        self.assertEqual(index.authors['z@example.com'], set(['a']))
+        self.assertEqual(index.activity, {'a': (2 * DAY, 4 * DAY)})
+
+    def test_threads_between(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 10, ['a']),
+                          message('c', 'y', 5), message('d', 'z', 20)])
+
+        def between(start, end):
+            return [t.parent.message_id for t in index.threads_between(start * DAY, end * DAY)]
+
+        self.assertEqual(between(4, 6), ['a', 'c'])
+        self.assertEqual(between(0, 2), ['a'])
+        self.assertEqual(between(11, 20), [])
+        self.assertEqual(between(0, 30), ['d', 'a', 'c'])
+
+    def test_latest(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 10, ['a']),
+                          message('c', 'y', 5), message('d', 'z', 20)])
+
+        self.assertEqual([t.parent.message_id for t in index.latest(2)], ['d', 'a'])
+        self.assertEqual(len(index.latest(10)), 3)
+        self.assertEqual(index.latest(0), [])
+
+    def test_undated(self):
+        forest = MailForest()
+        index = ForestIndex(forest)
+        msg = message('a', 'x', 1)
+        del msg['Date']
+        forest.add_message(msg)
+
+        self.assertEqual(index.dates, [])
+        self.assertEqual(index.threads_by_author('x@example.com'), [forest['a']])
@@ -0,0 +1,140 @@
+import mailtree
+from mailtree import MailForest, create_mailtree
+from mailtree.parallel import split_mbox, fill_range, parallel_fill
+from mailtree.scanner import scan_mbox
+from mailtree.tests import shape
+
+import os
+import random
+import tempfile
+import unittest
+
+
+def write_corpus(path, count=400, seed=1):
+    rnd = random.Random(seed)
+    messages = []
+    for n in range(count):
+        if not messages or rnd.random() < 0.15:
+            chain = []
+        else:
+            parent = rnd.choice(messages[-40:])
+            chain = parent[1] + [parent[0]]
+        messages.append(('m%d@example.com' % n, chain))
+
+    # Deliver out of order, and lose a few messages altogether
+    order = sorted(range(count), key=lambda n: n + rnd.randint(0, 30))
+    with open(path, 'w') as f:
+        for n in order:
+            if rnd.random() < 0.05:
+                continue
+
+            msg_id, chain = messages[n]
+            f.write('From author@example.com Mon Jan  1 00:00:00 2001\n')
+            f.write('From: Author %d <author%d@example.com>\n' % (n % 7, n % 7))
+            f.write('Message-Id: <%s>\n' % msg_id)
+            f.write('Subject: Re: thread\n')
+            if chain:
+                if rnd.random() < 0.7:
+                    f.write('References: %s\n' % ' '.join('<%s>' % c for c in chain))
+                f.write('In-Reply-To: <%s>\n' % chain[-1])
+            f.write('\nBody of %s\n\n' % msg_id)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        write_corpus(self.path)
+
+        self.serial = MailForest()
+        self.serial.fill_tree(scan_mbox(self.path))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_split(self):
+        ranges = split_mbox(self.path, 4)
+        data = open(self.path).read()
+
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for start, end in ranges:
+            self.assertTrue(data[start:].startswith('From author'))
+
+        count = sum(len(list(scan_mbox(self.path, s, e))) for s, e in ranges)
+        self.assertEqual(count, len(list(scan_mbox(self.path))))
+
+    def test_split_more_parts_than_messages(self):
+        data = 'From a\nMessage-Id: <a@b>\n\nbody\n'
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+        self.assertEqual(split_mbox(self.path, 8), [(0, len(data))])
+
+    def test_merge_matches_serial(self):
+        for parts in (2, 3, 7, 16):
+            forest = MailForest()
+            for start, end in split_mbox(self.path, parts):
+                forest.merge(fill_range((self.path, start, end)))
+
+            self.assertEqual(shape(forest), shape(self.serial))
+            self.assertEqual(sorted(forest.roots), sorted(shape(forest)[0]))
+
+    def test_walks_match_serial(self):
+        for seed in range(1, 6):
+            write_corpus(self.path, seed=seed)
+            serial = MailForest()
+            serial.fill_tree(scan_mbox(self.path))
+            walks = dict((root, [n.message_id for n in tree.walk_tree()])
+                         for root, tree in serial.roots.items())
+
+            for parts in (2, 5):
+                forest = MailForest()
+                for start, end in split_mbox(self.path, parts):
+                    forest.merge(fill_range((self.path, start, end)))
+
+                self.assertEqual(dict((root, [n.message_id for n in tree.walk_tree()])
+                                      for root, tree in forest.roots.items()), walks)
+                self.assertEqual(shape(forest), shape(serial))
+
+    def test_fill_range_keeps_the_counter(self):
+        before = next(mailtree._arrival)
+        fill_range((self.path, 0, os.path.getsize(self.path)))
+
+        self.assertEqual(next(mailtree._arrival), before + 1)
+
+    def test_merge_copies(self):
+        # Ranges which overlap thread the same messages twice
+        data = open(self.path).read()
+        middle = data.index('From author', len(data) // 2)
+        end = data.index('From author', len(data) * 3 // 4)
+
+        forest = MailForest()
+        forest.merge(fill_range((self.path, 0, end)))
+        forest.merge(fill_range((self.path, middle, len(data))))
+
+        self.assertEqual(shape(forest), shape(self.serial))
+        for tree in forest.trees.values():
+            for node in tree.nodes.values():
+                for child in node._children or ():
+                    self.assertTrue(tree.nodes[child.message_id] is child)
+
+    def test_arrival_follows_file_order(self):
+        forest = MailForest()
+        for start, end in split_mbox(self.path, 4):
+            forest.merge(fill_range((self.path, start, end)))
+
+        order = [r['message-id'].strip('<>') for r in scan_mbox(self.path)]
+        seqs = [forest[key].nodes[key].seq for key in order]
+        self.assertEqual(seqs, sorted(seqs))
+
+    def test_parallel_fill(self):
+        forest = parallel_fill(self.path, 3)
+
+        self.assertEqual(shape(forest), shape(self.serial))
+
+    def test_create_mailtree_workers(self):
+        forest = create_mailtree(self.path, workers=2)
+
+        self.assertEqual(len(forest), len(self.serial))
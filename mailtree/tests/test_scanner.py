@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from mailtree import create_mailtree
+from mailtree.scanner import scan_mbox, parse_headers, read_message, MboxReader
+
+import mailbox
+import os
+import tempfile
+import unittest
+
+MBOX = """From from1@example.com Mon Jan  1 00:00:00 2001
+From: From test <from1@example.com>
+Message-Id: <abcd1@example.com>
+Subject: This is an example
+
+my payloadA
+
+From from2@example.com Mon Jan  1 00:00:00 2001
+From: From test <from2@example.com>
+Message-Id: <abcd2@example.com>
+Subject: Re: This is an example
+In-Reply-To: <abcd1@example.com>
+References: <abcd1@example.com>
+X-Mailer: test
+
+my payloadB
+>From here on this is still the body
+
+From from4@example.com Mon Jan  1 00:00:00 2001
+From: =?utf-8?b?xZrDtsacxJMgxYXEg23EkyA8bmFtZUBleGFtcGxlLmNvbT4=?=
+Message-Id: <abcd4@example.com>
+Subject: Re: This is an example
+In-Reply-To: <abcd2@example.com>
+References: <abcd1@example.com>
+\t<abcd2@example.com>
+
+my payloadD
+"""
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, MBOX)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_scan(self):
+        records = list(scan_mbox(self.path))
+
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0].get('Message-Id'), '<abcd1@example.com>')
+        self.assertEqual(records[1]['subject'], 'Re: This is an example')
+        self.assertEqual(records[1].get('X-Mailer'), None)
+        self.assertEqual(records[2].get('References'), '<abcd1@example.com>\n\t<abcd2@example.com>')
+
+    def test_offsets(self):
+        box = mailbox.mbox(self.path)
+
+        for record, key in zip(scan_mbox(self.path), box.iterkeys()):
+            self.assertEqual(MBOX[record.offset:record.offset + record.length],
+                             box.get_string(key, from_=True))
+
+    def test_range(self):
+        second = MBOX.index('From from2')
+        records = list(scan_mbox(self.path, start=1))
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].offset, second)
+
+    def test_empty(self):
+        open(self.path, 'w').close()
+
+        self.assertEqual(list(scan_mbox(self.path)), [])
+
+    def test_all_headers(self):
+        record = list(scan_mbox(self.path, headers=None))[1]
+
+        self.assertEqual(record.get('X-Mailer'), 'test')
+
+    def test_parse_headers_stops_at_body(self):
+        headers = parse_headers("Subject: a\nnot a header\nFrom: b\n")
+
+        self.assertEqual(headers, {'subject': 'a'})
+
+    def test_create_mailtree_headers_only(self):
+        full = create_mailtree(self.path)
+        mf = create_mailtree(self.path, headers_only=True)
+
+        self.assertEqual(len(mf), len(full))
+        self.assertEqual(sorted(mf['abcd4@example.com'].nodes),
+                         sorted(full['abcd4@example.com'].nodes))
+        self.assertEqual(mf['abcd1@example.com'].nodes['abcd4@example.com'].author,
+                         u'ŚöƜē Ņămē <name@example.com>')
+        self.assertEqual(mf['abcd1@example.com'].authors, full['abcd1@example.com'].authors)
+
+
+class TestLazyBodies(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, MBOX)
+        os.close(fd)
+
+        self.mf = create_mailtree(self.path, headers_only=True)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_location(self):
+        node = self.mf.node('abcd2@example.com')
+
+        self.assertEqual(node.source, self.path)
+        self.assertEqual(node.offset, MBOX.index('From from2'))
+        self.assertEqual(self.mf.node('abcd1@example.com').source, self.path)
+
+    def test_raw_message(self):
+        raw = self.mf.raw_message('abcd2@example.com')
+
+        self.assertTrue(raw.startswith('From from2@example.com'))
+        self.assertTrue(raw.endswith('>From here on this is still the body\n'))
+        self.assertEqual(read_message(self.path, 0, 10), MBOX[:10])
+
+    def test_message(self):
+        msg = self.mf.message('abcd4@example.com')
+
+        self.assertEqual(msg['Message-Id'], '<abcd4@example.com>')
+        self.assertEqual(msg.get_from(), 'from4@example.com Mon Jan  1 00:00:00 2001')
+        self.assertEqual(msg.get_payload(), 'my payloadD\n')
+
+    def test_reader(self):
+        with MboxReader() as reader:
+            for node in self.mf['abcd1@example.com'].walk_tree():
+                self.assertEqual(node.raw_message(reader), node.raw_message())
+
+            view = reader.view(self.path, 0, 5)
+            self.assertEqual(str(view), 'From ')
+
+    def test_reader_sees_appended_messages(self):
+        with MboxReader() as reader:
+            reader.read(self.path, 0, 5)
+            with open(self.path, 'a') as f:
+                f.write('\nFrom new@example.com Mon Jan  1 00:00:00 2001\n\nnew\n')
+
+            self.assertEqual(reader.read(self.path, len(MBOX) + 1, 5), 'From ')
+
+    def test_unknown_location(self):
+        mf = create_mailtree(self.path)
+
+        self.assertRaises(ValueError, mf.raw_message, 'abcd1@example.com')
+
+    def test_archive_changed(self):
+        with open(self.path, 'w') as f:
+            f.write('x' * len(MBOX))
+
+        self.assertRaises(ValueError, self.mf.raw_message, 'abcd2@example.com')
+        with MboxReader() as reader:
+            self.assertRaises(ValueError, self.mf.raw_message, 'abcd2@example.com', reader)
@@ -0,0 +1,125 @@
+import mailtree
+from mailtree.shard import (thread_shard, plan_merge, merge_shards, load_shards,
+                            read_summary, frontier, ShardError)
+from mailtree.snapshot import SnapshotForest
+from mailtree.sources import fill_sources
+from mailtree.tests import shape
+from mailtree.tests.test_parallel import write_corpus
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+def write_lists(path, names, seed=2):
+    """Spread the messages of a corpus over lists, cross-posting some"""
+    corpus = os.path.join(path, 'corpus.mbox')
+    write_corpus(corpus, count=400)
+    with open(corpus) as f:
+        messages = ['From author@' + m for m in f.read().split('From author@')[1:]]
+
+    rnd = random.Random(seed)
+    lists = [[] for name in names]
+    for msg in messages:
+        chosen = rnd.sample(range(len(names)), 2 if rnd.random() < 0.2 else 1)
+        for n in chosen:
+            lists[n].append(msg)
+
+    paths = []
+    for name, msgs in zip(names, lists):
+        paths.append(os.path.join(path, name))
+        with open(paths[-1], 'w') as f:
+            f.write(''.join(msgs))
+
+    return paths
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lists = write_lists(self.dir, ['a.mbox', 'b.mbox', 'c.mbox', 'd.mbox'])
+        self.serial = fill_sources(self.lists, workers=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_same_as_serial(self):
+        shards = [self.path('shard0'), self.path('shard1'), self.path('shard2')]
+        thread_shard(self.lists[:2], shards[0], 0, workers=1)
+        thread_shard(self.lists[2:3], shards[1], 1, workers=1)
+        thread_shard(self.lists[3:], shards[2], 2, workers=1)
+
+        joined = merge_shards(shards, self.path('joined'))
+        forest = load_shards(self.path('joined'))
+
+        self.assertTrue(0 < len(joined) < len(forest))
+        self.assertEqual(shape(forest), shape(self.serial))
+        self.assertEqual(len(forest.keys), len(self.serial.keys))
+
+    def test_counter(self):
+        before = next(mailtree._arrival)
+        thread_shard(self.lists[:1], self.path('shard3'), 3, workers=1)
+
+        self.assertEqual(next(mailtree._arrival), before + 1)
+
+    def test_plan(self):
+        shards = [self.path('shard0'), self.path('shard1')]
+        thread_shard(self.lists[:1], shards[0], 0, workers=1)
+        thread_shard(self.lists[1:2], shards[1], 1, workers=1)
+
+        groups = plan_merge(shards)
+        members = set(item for group in groups for item in group)
+        with SnapshotForest(shards[0]) as first:
+            with SnapshotForest(shards[1]) as second:
+                for tree in first:
+                    number = first.tree_number(tree.parent.message_id)
+                    spans = any(message_id in second for message_id in tree.nodes)
+                    self.assertEqual((0, number) in members, spans)
+
+        for group in groups:
+            self.assertEqual(set(shard for shard, tree in group), set([0, 1]))
+
+    def test_summary(self):
+        thread_shard(self.lists[:1], self.path('shard0'), workers=1)
+        summary = read_summary(self.path('shard0'))
+
+        with SnapshotForest(self.path('shard0')) as snapshot:
+            self.assertEqual(len(summary), len(snapshot))
+            for ids, tree in zip(summary, snapshot):
+                self.assertEqual(ids, frontier(tree))
+                self.assertEqual(ids[0], tree.parent.message_id)
+                self.assertTrue(len(ids) < len(tree.nodes) or len(tree.nodes) == 1)
+
+        os.remove(self.path('shard0.summary'))
+        self.assertRaises(ShardError, read_summary, self.path('shard0'))
+
+    def test_processes(self):
+        top = os.path.dirname(os.path.dirname(os.path.abspath(mailtree.__file__)))
+        env = dict(os.environ, PYTHONPATH=top)
+        command = [sys.executable, '-m', 'mailtree.shard']
+
+        shards = [self.path('shard0'), self.path('shard1')]
+        devnull = open(os.devnull, 'w')
+        try:
+            nodes = [subprocess.Popen(command + ['thread', '-n', '0', '-j', '1', shards[0]]
+                                      + self.lists[:2], env=env, stdout=devnull),
+                     subprocess.Popen(command + ['thread', '-n', '1', '-j', '1', shards[1]]
+                                      + self.lists[2:], env=env, stdout=devnull)]
+            self.assertEqual([node.wait() for node in nodes], [0, 0])
+            self.assertEqual(subprocess.call(command + ['merge', self.path('joined')] + shards,
+                                             env=env, stdout=devnull), 0)
+        finally:
+            devnull.close()
+
+        self.assertEqual(shape(load_shards(self.path('joined'))), shape(self.serial))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from mailtree import MailForest
+from mailtree.scanner import scan_mbox
+from mailtree.snapshot import save_forest, load_forest, SnapshotForest, SnapshotError
+from mailtree.tests import shape
+from mailtree.tests.test_parallel import write_corpus
+
+from email.message import Message
+
+import os
+import tempfile
+import unittest
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        fd, self.mbox = tempfile.mkstemp()
+        os.close(fd)
+        write_corpus(self.mbox)
+
+        self.forest = MailForest()
+        self.forest.fill_tree(scan_mbox(self.mbox))
+
+        msg = Message()
+        msg['From'] = '=?utf-8?b?xZrDtsacxJMgxYXEg23EkyA8bmFtZUBleGFtcGxlLmNvbT4=?='
+        msg['Message-Id'] = '<unicode@example.com>'
+        msg['Subject'] = 'Unicode'
+        self.forest.add_message(msg)
+
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        save_forest(self.forest, self.path)
+
+    def tearDown(self):
+        os.unlink(self.mbox)
+        os.unlink(self.path)
+
+    def corrupt(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def test_round_trip(self):
+        forest = load_forest(self.path)
+
+        self.assertEqual(shape(forest), shape(self.forest))
+        self.assertEqual(forest['unicode@example.com'].parent.author,
+                         u'ŚöƜē Ņămē <name@example.com>')
+
+        for key in ('m10@example.com', 'm200@example.com', 'unicode@example.com'):
+            node, original = forest[key].nodes[key], self.forest[key].nodes[key]
+            self.assertEqual((node.date, node.seq), (original.date, original.seq))
+
+    def test_lazy_lookup(self):
+        with SnapshotForest(self.path) as snapshot:
+            self.assertEqual(len(snapshot), len(self.forest))
+            self.assertTrue('m10@example.com' in snapshot)
+            self.assertFalse('missing@example.com' in snapshot)
+            self.assertRaises(IndexError, snapshot.__getitem__, 'missing@example.com')
+
+            for key in ('m10@example.com', 'm200@example.com', 'unicode@example.com'):
+                tree = snapshot[key]
+                self.assertEqual(tree.parent.message_id, self.forest[key].parent.message_id)
+                self.assertEqual(sorted(tree.nodes), sorted(self.forest[key].nodes))
+                self.assertEqual(list(tree.authors), list(self.forest[key].authors))
+
+    def test_empty_forest(self):
+        save_forest(MailForest(), self.path)
+
+        self.assertEqual(len(load_forest(self.path)), 0)
+
+    def test_corrupt(self):
+        size = os.path.getsize(self.path)
+        self.corrupt(size - 5, 'X')
+
+        self.assertRaises(SnapshotError, load_forest, self.path)
+        self.assertEqual(len(SnapshotForest(self.path, verify=False)), len(self.forest))
+
+    def test_bad_magic(self):
+        self.corrupt(0, 'NOTATREE')
+
+        self.assertRaises(SnapshotError, load_forest, self.path)
+
+    def test_bad_version(self):
+        self.corrupt(8, '\xff')
+
+        self.assertRaises(SnapshotError, load_forest, self.path)
+
+    def test_truncated(self):
+        with open(self.path, 'r+b') as f:
+            f.truncate(100)
+
+        self.assertRaises(SnapshotError, load_forest, self.path)
@@ -0,0 +1,142 @@
+from mailtree import MailForest, create_mailtree
+from mailtree.scanner import scan_mbox
+from mailtree.sources import (scan_stream, scan_maildir, open_source, fill_sources,
+                              lzma, SOURCES)
+from mailtree.tests import shape
+from mailtree.tests.test_parallel import write_corpus
+
+import bz2
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+
+def records(source):
+    return [(r.offset, r.length, r.headers) for r in source]
+
+
+def unordered(forest):
+    """shape, but blind to the order messages arrived in"""
+    trees, roots = shape(forest)
+    for root, (nodes, authors) in trees.items():
+        nodes = dict((key, (empty, author, subject, sorted(children)))
+                     for key, (empty, author, subject, children) in nodes.items())
+        trees[root] = (nodes, sorted(authors))
+
+    return trees, roots
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mbox = os.path.join(self.dir, 'archive.mbox')
+        write_corpus(self.mbox, count=150)
+
+        with open(self.mbox, 'rb') as f:
+            self.data = f.read()
+
+        self.serial = MailForest()
+        self.serial.fill_tree(scan_mbox(self.mbox))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_stream_matches_scan(self):
+        want = records(scan_mbox(self.mbox))
+        for chunk_size in (1, 5, 6, 7, 100, 1 << 20):
+            got = records(scan_stream(StringIO.StringIO(self.data), chunk_size=chunk_size))
+            self.assertEqual(got, want)
+
+    def test_stream_edge_cases(self):
+        for data in ('', 'From a\n', 'From a\nSubject: x',
+                     'From a\nSubject: x\nFrom b\nSubject: y\n\nbody\n',
+                     'From a\r\nSubject: x\r\n\r\nbody\r\nFrom b\r\n\r\n'):
+            with open(self.mbox, 'wb') as f:
+                f.write(data)
+
+            for chunk_size in (1, 3, 1 << 20):
+                self.assertEqual(records(scan_stream(StringIO.StringIO(data),
+                                                     chunk_size=chunk_size)),
+                                 records(scan_mbox(self.mbox)))
+
+    def test_stream_preamble(self):
+        data = 'junk before the first message, not From a line\nxFrom b\n' + self.data
+        with open(self.mbox, 'wb') as f:
+            f.write(data)
+
+        want = records(scan_mbox(self.mbox))
+        self.assertEqual(want[0][0], data.index('\nFrom ') + 1)
+        for chunk_size in range(1, 12):
+            got = records(scan_stream(StringIO.StringIO(data), chunk_size=chunk_size))
+            self.assertEqual(got, want)
+
+    def check_compressed(self, suffix, opener):
+        path = self.mbox + suffix
+        f = opener(path, 'wb')
+        f.write(self.data)
+        f.close()
+
+        self.assertEqual(records(open_source(path)), records(scan_mbox(self.mbox)))
+        self.assertEqual(shape(create_mailtree(path)), shape(self.serial))
+
+    def test_gzip(self):
+        self.check_compressed('.gz', gzip.GzipFile)
+
+    def test_bz2(self):
+        self.check_compressed('.bz2', bz2.BZ2File)
+
+    @unittest.skipIf(lzma is None, "needs lzma")
+    def test_xz(self):
+        self.check_compressed('.xz', lzma.LZMAFile)
+
+    def make_maildir(self):
+        path = os.path.join(self.dir, 'Maildir')
+        for sub in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(path, sub))
+
+        for n, record in enumerate(scan_mbox(self.mbox)):
+            text = self.data[record.offset:record.offset + record.length]
+            text = text.split('\n', 1)[1]
+            sub = 'new' if n % 3 else 'cur'
+            with open(os.path.join(path, sub, '%05d.host' % n), 'wb') as f:
+                f.write(text)
+
+        return path
+
+    def test_maildir(self):
+        path = self.make_maildir()
+
+        got = [r.headers for r in scan_maildir(path)]
+        self.assertEqual(sorted(got), sorted(r.headers for r in scan_mbox(self.mbox)))
+        # A Maildir has no order, the files come in another one
+        self.assertEqual(unordered(create_mailtree(path)), unordered(self.serial))
+
+    def test_not_a_maildir(self):
+        self.assertRaises(ValueError, open_source, self.dir)
+
+    def test_fill_sources(self):
+        # Split the mbox into a plain, a gzip and a bz2 file plus a Maildir
+        starts = [r.offset for r in scan_mbox(self.mbox)]
+        cuts = [0, starts[40], starts[80], starts[120], len(self.data)]
+        parts = []
+        for n, suffix, opener in ((0, '', open), (1, '.gz', gzip.GzipFile),
+                                  (2, '.bz2', bz2.BZ2File), (3, '', open)):
+            path = os.path.join(self.dir, 'part%d.mbox%s' % (n, suffix))
+            f = opener(path, 'wb')
+            f.write(self.data[cuts[n]:cuts[n + 1]])
+            f.close()
+            parts.append(path)
+
+        for workers in (1, 2, 8):
+            self.assertEqual(shape(fill_sources(parts, workers)), shape(self.serial))
+        self.assertEqual(shape(create_mailtree(parts, workers=3)), shape(self.serial))
+
+    def test_register_source(self):
+        SOURCES['.test'] = lambda path, headers: scan_mbox(self.mbox, headers=headers)
+        try:
+            self.assertEqual(records(open_source('x.test')), records(scan_mbox(self.mbox)))
+        finally:
+            del SOURCES['.test']
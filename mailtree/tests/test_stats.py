@@ -0,0 +1,115 @@
+from mailtree import MailForest, create_mailtree
+from mailtree.stats import Stats, JsonLinesSink
+from mailtree.tests import message
+
+import json
+import mailbox
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_counters(self):
+        forest = MailForest()
+        stats = Stats()
+        stats.attach(forest)
+        # c and d start trees of their own, e joins them under b
+        forest.fill_tree([message('a'), message('c', in_reply_to='b'), message('d', in_reply_to='x'),
+                          message('c', in_reply_to='b'), message('x', in_reply_to='b')])
+        stats.detach(forest)
+
+        report = stats.report()
+        self.assertEqual(report['messages'], 5)
+        self.assertEqual(report['threaded'], 4)
+        self.assertEqual(report['duplicates'], 1)
+        self.assertEqual(report['placeholders'], 1)
+        self.assertEqual(report['grafts'], 1)
+        self.assertEqual(report['graft_nodes'], 2)
+        self.assertEqual(report['average_graft_size'], 2.0)
+        self.assertTrue(report['lookups'] > 0)
+        self.assertEqual(sorted(report['phases']),
+                         ['decode', 'graft', 'ids', 'read', 'thread'])
+        self.assertEqual(len(forest), 2)
+
+    def test_chain_links(self):
+        forest = MailForest()
+        stats = Stats()
+        stats.attach(forest)
+        forest.keys.update({'a': 'a', 'b': 'a', 'c': 'b', 'd': 'c'})
+
+        self.assertEqual(forest.parent_key('d'), 'a')
+        self.assertEqual(forest.keys, {'a': 'a', 'b': 'a', 'c': 'a', 'd': 'a'})
+        self.assertEqual(forest.parent_key('d'), 'a')
+        self.assertEqual((stats.counters['lookups'], stats.counters['chain_links']), (2, 4))
+
+    def test_same_forest(self):
+        messages = [message('m%d' % n, in_reply_to='m%d' % (n // 2) if n else None)
+                    for n in range(50)]
+        plain = MailForest()
+        plain.fill_tree(messages)
+
+        measured = MailForest()
+        stats = Stats()
+        stats.attach(measured)
+        measured.fill_tree(messages)
+        stats.detach(measured)
+
+        self.assertEqual(plain.roots.keys(), measured.roots.keys())
+        self.assertEqual([(d, n.message_id) for d, n in plain['m0'].depth_first()],
+                         [(d, n.message_id) for d, n in measured['m0'].depth_first()])
+
+    def test_detach(self):
+        forest = MailForest()
+        stats = Stats()
+        stats.attach(forest)
+        stats.detach(forest)
+        forest.fill_tree([message('a'), message('b', in_reply_to='a')])
+
+        self.assertEqual(stats.counters['messages'], 0)
+        self.assertFalse('parent_key' in forest.__dict__)
+        self.assertTrue(forest.stats is None)
+
+    def test_sinks(self):
+        reports = []
+        out = StringIO.StringIO()
+        stats = Stats([reports.append, JsonLinesSink(out)], every=2)
+        forest = MailForest()
+        stats.attach(forest)
+        forest.fill_tree([message('m%d' % n) for n in range(5)])
+        stats.detach(forest)
+        stats.emit()
+
+        self.assertEqual([r['messages'] for r in reports], [2, 4, 5])
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['messages'] for r in lines], [2, 4, 5])
+
+    def test_create_mailtree(self):
+        path = os.path.join(self.tmpdir, 'box')
+        box = mailbox.mbox(path)
+        for msg in [message('a'), message('b', in_reply_to='a'), message('c', in_reply_to='b')]:
+            box.add(msg)
+        box.close()
+
+        log = os.path.join(self.tmpdir, 'stats.log')
+        stats = Stats([JsonLinesSink(log)])
+        forest = create_mailtree(path, headers_only=True, stats=stats)
+
+        self.assertTrue(forest.stats is None)
+        with open(log) as f:
+            report = json.loads(f.read())
+        self.assertEqual(report['messages'], 3)
+        self.assertEqual(report['threaded'], 3)
+        self.assertTrue(report['phases']['read'] >= 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
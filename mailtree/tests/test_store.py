@@ -0,0 +1,112 @@
+from mailtree import MailForest
+from mailtree.scanner import scan_mbox
+from mailtree.store import SQLiteForest, StoreError
+from mailtree.tests import message, tree_shape
+from mailtree.tests.test_parallel import write_corpus
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+class TestSQLiteForest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'forest.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_same(self, forest, stored):
+        self.assertEqual(len(stored), len(forest))
+        self.assertEqual(sorted(stored.pruned_trees()), sorted(forest.pruned_trees()))
+        self.assertEqual(sorted(stored.keys), sorted(forest.keys))
+        for root, tree in forest.roots.iteritems():
+            self.assertEqual(tree_shape(stored.roots[root]), tree_shape(tree))
+
+    def test_same_as_mailforest(self):
+        mbox = os.path.join(self.dir, 'archive.mbox')
+        write_corpus(mbox, count=300)
+
+        forest = MailForest()
+        forest.fill_tree(scan_mbox(mbox))
+        with SQLiteForest(self.db, cache_size=5, batch_size=7) as stored:
+            stored.fill_tree(scan_mbox(mbox))
+            self.check_same(forest, stored)
+
+    def test_grafts(self):
+        messages = [message('b', 'x', references=['a']), message('d', 'y', references=['c']),
+                    message('e', 'z', references=['c', 'd']), message('f', 'w', references=['b']),
+                    message('g', 'y', references=['a', 'b', 'x', 'c'], in_reply_to='c'),
+                    message('a', 'v'), message('c', 'u')]
+        forest = MailForest()
+        forest.fill_tree(messages)
+        with SQLiteForest(self.db) as stored:
+            stored.fill_tree(messages)
+
+            self.assertEqual(len(stored), 1)
+            self.check_same(forest, stored)
+
+    def test_reopen(self):
+        with SQLiteForest(self.db) as stored:
+            stored.fill_tree([message('a'), message('b', 'b', references=['a'], in_reply_to='a')])
+
+        with SQLiteForest(self.db) as stored:
+            stored.add_message(message('c', 'c', references=['a', 'b'], in_reply_to='b'))
+            tree = stored['c']
+
+            self.assertEqual([n.message_id for n in tree.walk_tree()], ['a', 'b', 'c'])
+            self.assertEqual(len(tree.authors), 3)
+
+    def test_batches(self):
+        stored = SQLiteForest(self.db, batch_size=2)
+        stored.add_message(message('a'))
+        stored.add_message(message('b'))
+        stored.add_message(message('c'))
+
+        other = sqlite3.connect(self.db)
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM nodes').fetchone()[0], 2)
+        stored.close()
+        self.assertEqual(other.execute('SELECT COUNT(*) FROM nodes').fetchone()[0], 3)
+        other.close()
+
+    def test_lookups(self):
+        with SQLiteForest(self.db, cache_size=2) as stored:
+            stored.fill_tree([message('a'), message('b', 'b', references=['a'], in_reply_to='a'),
+                              message('c'), message('d'), message('b')])
+
+            self.assertRaises(IndexError, stored.__getitem__, 'x')
+            self.assertEqual(stored['b'].parent.message_id, 'a')
+            self.assertTrue('b' in stored.keys)
+            self.assertFalse('b' in stored.roots)
+            self.assertEqual(stored.node('b').author, 'Author B <b@example.com>')
+            self.assertEqual(stored.dedup.duplicates, 1)
+
+            for key in 'abcd':
+                stored[key]
+            self.assertEqual(len(stored._cache), 2)
+
+    def test_listeners(self):
+        events = []
+        with SQLiteForest(self.db) as stored:
+            stored.listeners.append(lambda event, tree, other:
+                                    events.append((event, tree.parent.message_id)))
+            stored.fill_tree([message('b', 'b', references=['a'], in_reply_to='a'), message('c'),
+                              message('d', 'd', references=['c', 'a'], in_reply_to='a')])
+
+        self.assertEqual(events, [('created', 'a'), ('added', 'a'), ('created', 'c'),
+                                  ('added', 'c'), ('grafted', 'c'), ('added', 'c')])
+
+    def test_not_a_forest(self):
+        db = sqlite3.connect(self.db)
+        db.execute('CREATE TABLE other (x)')
+        db.commit()
+        db.close()
+
+        self.assertRaises(StoreError, SQLiteForest, self.db)
+
+
+if __name__ == '__main__':
+    unittest.main()
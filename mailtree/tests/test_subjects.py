@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from mailtree import MailForest
+from mailtree.subjects import normalise_subject, gather_subjects
+from mailtree.tests import message, DAY
+
+import unittest
+
+
+class TestNormaliseSubject(unittest.TestCase):
+    def test_prefixes(self):
+        for subject in ('Re: Build fails', 'RE: re:Build fails', 'Fwd: Re[2]: build  fails',
+                        '[list] Re: [list] Build fails', 'AW: build fails (fwd)',
+                        'Re:\n\tBuild fails'):
+            self.assertEqual(normalise_subject(subject), u'build fails')
+
+    def test_encoded(self):
+        self.assertEqual(normalise_subject('=?iso-8859-1?q?Re:_caf=E9?='), u'café')
+        self.assertEqual(normalise_subject(u'Re: Café'), u'café')
+
+    def test_only_prefixes(self):
+        self.assertEqual(normalise_subject('Re: [list]'), u'')
+        self.assertEqual(normalise_subject(None), u'')
+
+    def test_keeps_inner_markers(self):
+        self.assertEqual(normalise_subject('About Re: handling'), u'about re: handling')
+
+
+class TestGatherSubjects(unittest.TestCase):
+    def forest(self, *messages):
+        mf = MailForest()
+        mf.fill_tree(messages)
+        return mf
+
+    def test_gather(self):
+        mf = self.forest(message('a', subject='Build fails', day=1),
+                         message('b', subject='Re: build fails', day=2),
+                         message('c', subject='Re: Build fails', day=3, in_reply_to='b'),
+                         message('d', subject='Something else', day=2))
+
+        self.assertEqual(gather_subjects(mf), 1)
+        self.assertEqual(len(mf), 2)
+        self.assertTrue(mf['c'] is mf['a'])
+        self.assertEqual(sorted(mf.roots), ['a', 'd'])
+
+        tree = mf['a']
+        self.assertEqual([(d, n.message_id) for d, n in tree.depth_first()],
+                         [(0, 'a'), (1, 'b'), (2, 'c')])
+        self.assertEqual(tree.orphans(), [])
+
+    def test_window(self):
+        mf = self.forest(message('a', subject='Weekly report', day=1),
+                         message('b', subject='Re: Weekly report', day=20),
+                         message('c', subject='Weekly report', day=100),
+                         message('d', subject='Weekly report', day=110))
+
+        self.assertEqual(gather_subjects(mf, window=30 * DAY), 2)
+        self.assertEqual(sorted(mf.roots), ['a', 'c'])
+        self.assertTrue(mf['d'] is mf['c'])
+
+    def test_window_follows_thread(self):
+        # b extends the thread of a, so c is close enough to join it
+        mf = self.forest(message('a', subject='Topic', day=1),
+                         message('b', subject='Re: Topic', day=25, in_reply_to='a'),
+                         message('c', subject='Re: Topic', day=50))
+
+        self.assertEqual(gather_subjects(mf, window=30 * DAY), 1)
+        self.assertEqual(len(mf), 1)
+
+    def test_undated(self):
+        mf = self.forest(message('a', subject='Topic'), message('b', subject='Re: Topic'))
+
+        self.assertEqual(gather_subjects(mf), 0)
+        self.assertEqual(gather_subjects(mf, window=None), 1)
+        self.assertEqual(len(mf), 1)
+
+    def test_empty_subject(self):
+        mf = self.forest(message('a', subject='Re:', day=1), message('b', subject='', day=1))
+
+        self.assertEqual(gather_subjects(mf), 0)
+
+    def test_placeholder_root(self):
+        # The root of the first thread was never seen, its reply has the subject
+        mf = self.forest(message('b', subject='Re: Topic', day=1, in_reply_to='a'), message('c', subject='Topic', day=2))
+
+        self.assertEqual(gather_subjects(mf), 1)
+        self.assertEqual(sorted(mf.roots), ['a'])
+        self.assertEqual(mf['a'].parent.children[-1].message_id, 'c')
+
+    def test_listeners(self):
+        mf = self.forest(message('a', subject='Topic', day=1), message('b', subject='Re: Topic', day=2))
+        events = []
+        mf.listeners.append(lambda event, tree, other: events.append(
+            (event, tree.parent.message_id, other.parent.message_id)))
+
+        gather_subjects(mf)
+        self.assertEqual(events, [('grafted', 'a', 'b')])
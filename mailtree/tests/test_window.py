@@ -0,0 +1,170 @@
+from mailtree import MailForest
+from mailtree.snapshot import SnapshotForest
+from mailtree.window import WindowedForest, SnapshotSink
+from mailtree.tests import message, tree_shape, DAY
+from mailtree.tests.test_indexes import corpus
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def ordered(count=300):
+    """corpus in the order of the dates, replies within a week"""
+    messages = []
+    for n in range(count):
+        chain = []
+        if n % 5:
+            parent = n - n % 5
+            chain = ['m%d' % parent] + (['m%d' % (n - 1)] if n % 5 > 1 else [])
+        messages.append(message('m%d' % n, 'a%d' % (n % 8), n // 5 * 2 + n % 5, chain))
+
+    return messages
+
+
+class Collect(object):
+    """Consumer keeping the latest copy of every evicted tree"""
+    def __init__(self):
+        self.trees = {}
+        self.calls = 0
+
+    def __call__(self, tree):
+        self.calls += 1
+        for message_id in tree.nodes:
+            self.trees.pop(message_id, None)
+        self.trees[tree.parent.message_id] = tree
+
+
+class TestWindowedForest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_same(self, messages, trees):
+        forest = MailForest()
+        forest.fill_tree(messages)
+
+        self.assertEqual(sorted(trees), sorted(forest.roots))
+        for root, tree in forest.roots.iteritems():
+            self.assertEqual(tree_shape(trees[root]), tree_shape(tree))
+
+    def test_in_order(self):
+        collect = Collect()
+        forest = WindowedForest(window=10 * DAY, consumer=collect)
+        resident = 0
+        for msg in ordered():
+            forest.fill_tree([msg])
+            resident = max(resident, len(forest.trees))
+        forest.finish()
+
+        self.assertEqual(resident, 7)
+        self.assertEqual(len(forest.trees), 0)
+        self.assertEqual(len(forest.keys), 0)
+        self.assertEqual(forest.evicted, 60)
+        self.assertEqual(forest.links, {})
+        self.check_same(ordered(), collect.trees)
+
+    def test_late_reply_links(self):
+        collect = Collect()
+        forest = WindowedForest(window=10 * DAY, consumer=collect)
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 2, ['a']),
+                          message('c', 'z', 30), message('e', 'z', 30),
+                          message('d', 'x', 31, ['a', 'b'])])
+
+        # d starts a tree of its own, below a placeholder for a
+        self.assertEqual(sorted(collect.trees), ['a'])
+        self.assertEqual(sorted(forest.roots), ['a', 'c', 'e'])
+        self.assertEqual(forest.links, {'a': ['a']})
+        self.assertEqual(forest.reopened, 0)
+
+    def test_links_follow_grafts(self):
+        forest = WindowedForest(window=10 * DAY, consumer=Collect())
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 2),
+                          message('c', 'z', 30), message('e', 'z', 30),
+                          message('d', 'x', 31, ['a', 'b'])])
+
+        # d refers to both evicted trees
+        self.assertEqual(forest.links, {'a': ['a', 'b']})
+
+        # The tree of e keeps its root when a reply joins the tree of d to it
+        forest.fill_tree([message('f', 'y', 32, ['e', 'd'])])
+        self.assertEqual(forest.links, {'e': ['a', 'b']})
+        forest.graft('c', 'd')
+        self.assertEqual(forest.links, {'c': ['a', 'b']})
+
+    def test_reopen(self):
+        sink = SnapshotSink(os.path.join(self.dir, 'trees'), batch_size=7)
+        collect = Collect()
+
+        def consumer(tree):
+            sink(tree)
+            collect(tree)
+
+        messages = corpus()
+        forest = WindowedForest(window=3 * DAY, consumer=consumer, reopen=sink.reopen)
+        forest.fill_tree(messages)
+        forest.finish()
+        sink.close()
+
+        self.assertTrue(forest.reopened > 0)
+        self.assertEqual(forest.links, {})
+        self.check_same(corpus(), collect.trees)
+
+        self.assertEqual(sorted(sink.where), sorted(collect.trees))
+        for root, number in sink.where.iteritems():
+            with SnapshotForest(sink.files[number]) as snapshot:
+                self.assertEqual(tree_shape(snapshot[root]), tree_shape(collect.trees[root]))
+
+    def test_copies(self):
+        forest = WindowedForest(window=10 * DAY, consumer=Collect())
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 2, ['a']),
+                          message('c', 'z', 30), message('e', 'z', 30), message('a', 'x', 1),
+                          message('x', 'z', 31, ['x0', 'b'])])
+
+        self.assertEqual(forest.dedup.duplicates, 1)
+        self.assertEqual(forest.dedup.copies['a'], 1)
+        self.assertEqual(forest.links, {'x0': ['a']})
+
+    def test_future_date(self):
+        collect = Collect()
+        forest = WindowedForest(window=10 * DAY, consumer=collect)
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 2, ['a']),
+                          message('s', 'z', 40000), message('c', 'x', 3),
+                          message('d', 'y', 3, ['a', 'b'])])
+
+        self.assertEqual(forest.clock, 3 * DAY)
+        self.assertEqual(forest.evicted, 0)
+        self.assertEqual(sorted(forest.roots), ['a', 'c', 's'])
+        self.assertEqual(forest.links, {})
+
+        # The tree of s is idle as of one window past the clock
+        forest.fill_tree([message('e', 'x', 10), message('f', 'y', 14), message('g', 'x', 24)])
+        self.assertEqual(sorted(collect.trees), ['a', 'c', 'e', 's'])
+
+    def test_quiet_list(self):
+        forest = WindowedForest(window=10 * DAY, consumer=Collect())
+        forest.fill_tree([message('a', 'x', 1), message('b', 'y', 300), message('c', 'z', 301)])
+
+        self.assertEqual(forest.clock, 300 * DAY)
+        self.assertEqual(sorted(forest.roots), ['b', 'c'])
+
+        forest.fill_tree([message('d', 'x', 302, ['b'])])
+        self.assertEqual(sorted(forest.roots), ['b', 'c'])
+
+    def test_undated(self):
+        forest = WindowedForest(window=10 * DAY)
+        first = message('a', 'x', 1)
+        del first['Date']
+        forest.fill_tree([first, message('b', 'y', 2), message('c', 'z', 10)])
+
+        self.assertEqual(sorted(forest.roots), ['a', 'b', 'c'])
+        forest.fill_tree([message('d', 'z', 13)])
+
+        self.assertEqual(sorted(forest.roots), ['c', 'd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
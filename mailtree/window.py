@@ -0,0 +1,315 @@
+"""Thread long archives in one pass, keeping only recent threads in memory
+
+Threads of a mailing list go quiet and hardly ever come back, so
+WindowedForest evicts the trees which had no activity for window seconds
+and hands them to a consumer:
+
+    sink = SnapshotSink('threads/')
+    forest = WindowedForest(window=90 * 86400, consumer=sink, reopen=sink.reopen)
+    forest.fill_tree(scan_mbox('20-years.mbox'))
+    forest.finish()
+    sink.close()
+
+Time is the Date of the messages: the clock is the latest Date threaded so
+far, and a tree is active as of its latest message, or of the clock when a
+message has no usable Date, or of the first Date for the messages before
+it.  Long archives are full of messages dated years ahead, so a Date more
+than a window past the clock only moves it once the next dated message is
+past the window too, as after a list went quiet; until then, and for a
+single such message, the message counts as dated one window past the
+clock.  Memory then depends on the number of threads active within the
+window, plus a few dozen bytes for every message id already evicted.
+
+A message may still refer to an evicted tree.  With a reopen callable,
+which is given the message id of the root of the tree and returns the
+MailTree, the tree is brought back into the forest and the message is
+threaded into it; it is evicted again later, and the consumer gets it
+again.  Without one, the message starts a tree of its own and links maps
+the root of that tree, often a placeholder for the same message, to the
+roots of the evicted trees it refers to; when two such trees are grafted
+together, so are their links.
+Copies of messages which were evicted are counted as duplicates and
+skipped either way.
+"""
+import heapq
+import os
+
+from mailtree import MailForest, message_ids
+from mailtree.snapshot import save_forest, SnapshotForest, _key_hash, _encode
+
+WINDOW = 90 * 86400
+
+
+def _finished_key(message_id):
+    # 63 bits, which keeps the keys plain ints
+    return _key_hash(_encode(message_id)) >> 1
+
+
+class WindowedForest(MailForest):
+    """
+    A MailForest which evicts the trees idle for longer than window seconds
+
+    consumer is called with every evicted tree, and reopen with the root
+    of an evicted tree a late message refers to, see the module.  finished
+    maps a hash of every evicted message id to the number of its tree in
+    finished_roots, negated minus one for placeholders.
+
+    Listeners are not told about evictions.
+    """
+    def __init__(self, window=WINDOW, consumer=None, reopen=None):
+        MailForest.__init__(self)
+        self.window = window
+        self.consumer = consumer
+        self.reopen = reopen
+        self.clock = None
+        self.ahead = None       # (date, message id) dated past the window, not believed yet
+        self.last = {}          # root -> date of its latest message
+        self.queue = []         # (date, root), some out of date
+        self.undated = []       # roots threaded before the first Date
+        self.finished = {}
+        self.finished_roots = []
+        self.links = {}
+        self.evicted = 0
+        self.reopened = 0
+
+    def _graft(self, tree_key, other, adopt=False):
+        absorbed = self.trees[other].parent.message_id
+        tree_key = MailForest._graft(self, tree_key, other, adopt)
+
+        root = self.trees[tree_key].parent.message_id
+        last = self.last.pop(absorbed, None)
+        if last is not None:
+            self._touch(root, last)
+
+        linked = self.links.pop(absorbed, None)
+        if linked is not None:
+            self._link(root, linked)
+
+        return tree_key
+
+    def _link(self, root, linked):
+        links = self.links.setdefault(root, [])
+        links.extend(r for r in linked if r not in links)
+
+    def _touch(self, root, date):
+        last = self.last.get(root)
+        if last is not None and date <= last:
+            return
+
+        self.last[root] = date
+        heapq.heappush(self.queue, (date, root))
+
+    def _finished_tree(self, message_id):
+        """Return (number of the evicted tree, hydrated) for message_id, or None"""
+        number = self.finished.get(_finished_key(message_id))
+        if number is None:
+            return None
+        if number < 0:
+            return ~number, False
+
+        return number, True
+
+    def _late(self, ids):
+        """Return the evicted trees which ids refer to, and whether the message was evicted"""
+        numbers = []
+        copy = False
+        for message_id in [ids.message_id] + list(ids.references):
+            if message_id in self.keys:
+                continue
+
+            found = self._finished_tree(message_id)
+            if found is None:
+                continue
+            if found[1] and message_id == ids.message_id:
+                copy = True
+            if found[0] not in numbers:
+                numbers.append(found[0])
+
+        return numbers, copy
+
+    def _restore(self, tree):
+        part = MailForest()
+        part.trees[tree.parent.message_id] = tree
+        self.merge(part)
+
+        dates = [n.date for n in tree.nodes.itervalues() if not n.isEmpty]
+        dates = [d for d in dates if d is not None]
+        self._touch(self[tree.parent.message_id].parent.message_id,
+                    max(dates) if dates else self.clock)
+        self.reopened += 1
+
+    def add_message(self, m, ids=None):
+        """
+        Thread a message like MailForest.add_message, then evict the trees
+        which went idle
+
+        Returns the tree of the message, or None for a copy of a message
+        which was evicted.
+        """
+        if ids is None:
+            ids = message_ids(m)
+
+        linked = []
+        if self.finished and ids.message_id is not None:
+            numbers, copy = self._late(ids)
+            if numbers and self.reopen is not None:
+                for number in numbers:
+                    self._restore(self.reopen(self.finished_roots[number]))
+                copy = copy and self.dedup is not None and self.dedup.is_duplicate(ids.message_id)
+            else:
+                linked = [self.finished_roots[n] for n in numbers]
+
+            if copy:
+                if self.dedup is not None:
+                    self.dedup.duplicates += 1
+                    self.dedup.copies[ids.message_id] += 1
+                return None
+
+        tree = MailForest.add_message(self, m, ids)
+        root = tree.parent.message_id
+
+        date = tree.nodes[ids.message_id].date
+        if date is not None:
+            self._advance(date, ids.message_id)
+            date = min(date, self.clock + self.window)
+        if linked:
+            self._link(root, linked)
+
+        when = date if date is not None else self.clock
+        if when is not None:
+            self._touch(root, when)
+        else:
+            self.undated.append(root)
+
+        self.expire()
+
+        return tree
+
+    def _advance(self, date, message_id):
+        """Move the clock on for a message dated date, see the module"""
+        ahead = None
+        if self.clock is not None:
+            if date <= self.clock:
+                self.ahead = None
+                return
+
+            if date > self.clock + self.window:
+                if self.ahead is None:
+                    self.ahead = (date, message_id)
+                    return
+                ahead, self.ahead = self.ahead, None
+                date = min(date, ahead[0])
+            else:
+                self.ahead = None
+
+        self.clock = date
+        if self.undated:
+            for key in self.undated:
+                if key in self.keys:
+                    self._touch(self[key].parent.message_id, date)
+            self.undated = []
+
+        # The message which went past the window first was right
+        if ahead is not None and ahead[1] in self.keys:
+            self._touch(self[ahead[1]].parent.message_id,
+                        min(ahead[0], date + self.window))
+
+    def expire(self):
+        """Evict the trees idle for longer than the window"""
+        if self.clock is None:
+            return
+
+        horizon = self.clock - self.window
+        queue = self.queue
+        while queue and queue[0][0] < horizon:
+            date, root = heapq.heappop(queue)
+            if self.last.get(root) == date and root in self.roots:
+                self.evict(root)
+
+    def finish(self):
+        """Evict every tree, as at the end of the archive"""
+        for root in sorted(self.roots):
+            self.evict(root)
+        self.queue = []
+
+    def evict(self, root):
+        """Remove the tree rooted at root and hand it to the consumer"""
+        tree = self.roots.pop(root)
+        tree_key = self.parent_key(root)
+        del self.trees[tree_key]
+        del self.sizes[tree_key]
+        self.last.pop(root, None)
+
+        number = len(self.finished_roots)
+        self.finished_roots.append(root)
+        for message_id, node in tree.nodes.iteritems():
+            del self.keys[message_id]
+            self.finished[_finished_key(message_id)] = ~number if node.isEmpty else number
+        self.evicted += 1
+
+        if self.consumer is not None:
+            self.consumer(tree)
+
+    def __repr__(self):
+        return "<WindowedForest: %d trees, %d evicted>" % (len(self.trees), self.evicted)
+
+
+class SnapshotSink(object):
+    """
+    Saves evicted trees to snapshot files in a directory
+
+    Trees are written batch_size at a time, to files numbered in order.
+    reopen reads a tree back, by the message id of its root.  A tree given
+    again after it was reopened replaces the earlier copy, which stays in
+    its file: where maps the root of every current tree to the number of
+    its file in files.
+    """
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.files = []
+        self.where = {}         # root -> number of the file holding it
+        self.pending = MailForest()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __call__(self, tree):
+        root = tree.parent.message_id
+        # A reopened tree may have been grafted below another root
+        for message_id in tree.nodes:
+            if message_id != root:
+                self.where.pop(message_id, None)
+                if self.pending.trees.pop(message_id, None) is not None:
+                    del self.pending.roots[message_id]
+        self.pending.trees[root] = self.pending.roots[root] = tree
+        if len(self.pending.trees) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the trees given since the last flush"""
+        if not self.pending.trees:
+            return
+
+        name = os.path.join(self.path, 'trees-%06d.snapshot' % len(self.files))
+        save_forest(self.pending, name)
+        for root in self.pending.trees:
+            self.where[root] = len(self.files)
+        self.files.append(name)
+        self.pending = MailForest()
+
+    def reopen(self, root):
+        """Return the tree rooted at root"""
+        tree = self.pending.trees.pop(root, None)
+        if tree is not None:
+            del self.pending.roots[root]
+            return tree
+
+        with SnapshotForest(self.files[self.where[root]]) as snapshot:
+            return snapshot[root]
+
+    def close(self):
+        self.flush()
+
+    def __repr__(self):
+        return "<SnapshotSink: %s, %d files>" % (self.path, len(self.files))
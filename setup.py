@@ -14,6 +14,15 @@ setup(name='mailtree',
       packages=['mailtree'],
       zip_safe=False,
 
+      entry_points={
+          'console_scripts': ['mailtree = mailtree.cli:main'],
+      },
+
+      extras_require={
+          'xz': ['backports.lzma'],
+          'numpy': ['numpy'],
+      },
+
       test_suite='nose.collector',
       tests_require=['nose'],
 